@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Workload-driven index advisor for the SensorThings database. The statements recorded by pg_stat_statements are ranked
+by total execution time and matched against a curated set of indexes for the FROST schema (B-tree, BRIN and GiST).
+Indexes are built without blocking writes and the latency change of the statements they target is reported from the
+pg_stat_statements counters.
+
+license: MIT
+"""
+import re
+from datetime import datetime
+import rich
+
+try:
+    from postgres import sql_literal
+except ModuleNotFoundError:
+    from .postgres import sql_literal
+
+
+class IndexCandidate:
+    def __init__(self, name, table, method, columns, patterns, description, plain_table_only=False):
+        """
+        Index that may help the SensorThings workload
+        :param name: index name (prefixed with odi_)
+        :param table: FROST table
+        :param method: btree, brin or gist
+        :param columns: list of index columns, e.g. ['"DATASTREAM_ID"', '"PHENOMENON_TIME_START" DESC']
+        :param patterns: regular expressions, a statement benefits from the index if it matches all of them
+        :param description: access pattern covered by the index
+        :param plain_table_only: not useful for hypertables (e.g. BRIN on the time column, chunks already do it)
+        """
+        self.name = name
+        self.table = table
+        self.method = method
+        self.columns = columns
+        self.patterns = [re.compile(p, re.IGNORECASE | re.DOTALL) for p in patterns]
+        self.description = description
+        self.plain_table_only = plain_table_only
+
+    def matches(self, query: str) -> bool:
+        return all(p.search(query) for p in self.patterns)
+
+    def column_names(self) -> list:
+        return [re.findall(r'"([^"]+)"', c)[0] for c in self.columns]
+
+    def definition(self, concurrently=True, hypertable=False) -> str:
+        """
+        CREATE INDEX statement. Hypertables do not support CONCURRENTLY, they build the index one chunk at a time
+        (one transaction per chunk) instead
+        """
+        columns = ", ".join(self.columns)
+        if hypertable:
+            return (f'CREATE INDEX IF NOT EXISTS {self.name} ON "{self.table}" USING {self.method} ({columns}) '
+                    f'WITH (timescaledb.transaction_per_chunk);')
+        mode = "CONCURRENTLY " if concurrently else ""
+        return f'CREATE INDEX {mode}IF NOT EXISTS {self.name} ON "{self.table}" USING {self.method} ({columns});'
+
+
+# Access patterns of the FROST queries (generated by jOOQ, e.g. "e0"."DATASTREAM_ID" = $1)
+index_candidates = [
+    IndexCandidate("odi_observations_datastream_time", "OBSERVATIONS", "btree",
+                   ['"DATASTREAM_ID"', '"PHENOMENON_TIME_START" DESC', '"ID"'],
+                   [r'"OBSERVATIONS"', r'"DATASTREAM_ID"\s*(=|in)', r'order by.*"PHENOMENON_TIME_START"'],
+                   "Observations of a datastream ordered by phenomenonTime"),
+    IndexCandidate("odi_observations_time_brin", "OBSERVATIONS", "brin", ['"PHENOMENON_TIME_START"'],
+                   [r'"OBSERVATIONS"', r'"PHENOMENON_TIME_(START|END)"\s*(<|>|between)'],
+                   "Time range filters over all the observations (rows are inserted in time order)",
+                   plain_table_only=True),
+    IndexCandidate("odi_observations_feature", "OBSERVATIONS", "btree", ['"FEATURE_ID"', '"PHENOMENON_TIME_START"'],
+                   [r'"OBSERVATIONS"', r'"FEATURE_ID"\s*(=|in)'],
+                   "Observations of a FeatureOfInterest ($expand / navigation)"),
+    IndexCandidate("odi_locations_geom", "LOCATIONS", "gist", ['"GEOM"'],
+                   [r'"LOCATIONS"', r'st_\w+\(.*"GEOM"'],
+                   "Spatial filters on Locations (st_within, st_intersects...)"),
+    IndexCandidate("odi_features_geom", "FEATURES", "gist", ['"GEOM"'],
+                   [r'"FEATURES"', r'st_\w+\(.*"GEOM"'],
+                   "Spatial filters on FeaturesOfInterest"),
+    IndexCandidate("odi_datastreams_thing", "DATASTREAMS", "btree", ['"THING_ID"'],
+                   [r'"DATASTREAMS"', r'"THING_ID"\s*(=|in)'],
+                   "Datastreams of a Thing ($expand=Datastreams)"),
+    IndexCandidate("odi_datastreams_sensor", "DATASTREAMS", "btree", ['"SENSOR_ID"'],
+                   [r'"DATASTREAMS"', r'"SENSOR_ID"\s*(=|in)'],
+                   "Datastreams of a Sensor"),
+    IndexCandidate("odi_datastreams_obs_property", "DATASTREAMS", "btree", ['"OBS_PROPERTY_ID"'],
+                   [r'"DATASTREAMS"', r'"OBS_PROPERTY_ID"\s*(=|in)'],
+                   "Datastreams of an ObservedProperty"),
+    IndexCandidate("odi_things_locations_location", "THINGS_LOCATIONS", "btree", ['"LOCATION_ID"'],
+                   [r'"THINGS_LOCATIONS"', r'"LOCATION_ID"\s*(=|in)'],
+                   "Things of a Location ($expand=Things)"),
+]
+
+statements_query = """
+SELECT queryid, calls, total_exec_time, mean_exec_time, rows, regexp_replace(query, '\\s+', ' ', 'g')
+FROM pg_stat_statements
+WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database()) AND calls > 0
+ORDER BY total_exec_time DESC
+LIMIT {limit};
+"""
+
+
+class Statement:
+    def __init__(self, row: list):
+        """
+        Statement recorded by pg_stat_statements
+        """
+        self.queryid = row[0]
+        self.calls = int(row[1])
+        self.total_ms = float(row[2])
+        self.mean_ms = float(row[3])
+        self.rows = int(row[4])
+        self.query = row[5]
+
+
+def check_pg_stat_statements(psql):
+    """
+    Creates the pg_stat_statements extension if needed
+    :raises: ValueError if the library is not preloaded by the server
+    """
+    preload = psql.query("SHOW shared_preload_libraries;")
+    if not preload or "pg_stat_statements" not in preload[0][0]:
+        raise ValueError("pg_stat_statements is not in shared_preload_libraries, add it to postgresql.conf (see "
+                         "create_sta_db.sh) and restart the database")
+    psql.run("CREATE EXTENSION IF NOT EXISTS pg_stat_statements;")
+
+
+def top_statements(psql, limit=200) -> list:
+    """
+    Returns the statements with the highest total execution time
+    """
+    return [Statement(row) for row in psql.query(statements_query.format(limit=limit)) if len(row) == 6]
+
+
+def existing_indexes(psql) -> dict:
+    """
+    Returns the valid indexes of the public schema
+    :returns: dict with {<table>: [(<index name>, <method>, [<columns>])]}
+    """
+    rows = psql.query("SELECT t.relname, i.relname, pg_get_indexdef(i.oid) FROM pg_index x "
+                      "JOIN pg_class i ON i.oid = x.indexrelid JOIN pg_class t ON t.oid = x.indrelid "
+                      "JOIN pg_namespace n ON n.oid = t.relnamespace WHERE n.nspname = 'public' AND x.indisvalid;")
+    indexes = {}
+    for table, name, definition in rows:
+        match = re.search(r"USING (\w+) \((.*)\)", definition)
+        if match:
+            columns = [c.strip().split(" ")[0].strip('"') for c in match.group(2).split(",")]
+            indexes.setdefault(table, []).append((name, match.group(1), columns))
+    return indexes
+
+
+def hypertables(psql) -> set:
+    try:
+        return {r[0] for r in psql.query("SELECT hypertable_name FROM timescaledb_information.hypertables;")}
+    except ValueError:  # timescaledb not installed
+        return set()
+
+
+def covered(candidate: IndexCandidate, indexes: dict) -> str:
+    """
+    Returns the name of an existing index that already covers the candidate (same method, and the candidate columns
+    are a prefix of its columns), or an empty string
+    """
+    for name, method, columns in indexes.get(candidate.table, []):
+        if method == candidate.method and columns[:len(candidate.columns)] == candidate.column_names():
+            return name
+    return ""
+
+
+class Advice:
+    def __init__(self, candidate: IndexCandidate, statements: list):
+        """
+        Proposed index and the statements that would benefit from it
+        """
+        self.candidate = candidate
+        self.statements = statements
+        self.total_ms = sum([s.total_ms for s in statements])
+
+
+def advise(psql, statements: list) -> list:
+    """
+    Ranks the index candidates by the total execution time of the statements they would speed up. Candidates
+    already covered by an existing index are skipped.
+    :param psql: Psql object
+    :param statements: list of Statement (see top_statements)
+    :returns: list of Advice, most promising first
+    """
+    indexes = existing_indexes(psql)
+    hyper = hypertables(psql)
+    advices = []
+    for candidate in index_candidates:
+        if candidate.plain_table_only and candidate.table in hyper:
+            continue
+        if covered(candidate, indexes):
+            continue
+        matching = [s for s in statements if candidate.matches(s.query)]
+        if matching:
+            advices.append(Advice(candidate, matching))
+    return sorted(advices, key=lambda a: -a.total_ms)
+
+
+def print_statements(statements: list, top=10, width=100):
+    from rich.markup import escape
+    rich.print(f"\n{'calls':>10} {'total (s)':>10} {'mean (ms)':>10}  statement")
+    for s in statements[:top]:
+        query = s.query if len(s.query) <= width else s.query[:width - 3] + "..."
+        rich.print(f"{s.calls:>10} {s.total_ms / 1000:>10.1f} {s.mean_ms:>10.2f}  [grey42]{escape(query)}")
+
+
+def print_advice(advices: list):
+    if not advices:
+        rich.print("[green]No index to propose, the slow statements are already covered")
+        return
+    rich.print("\nProposed indexes:")
+    for a in advices:
+        c = a.candidate
+        rich.print(f"  [cyan]{c.name}[/cyan] {c.method} on {c.table} ({', '.join(c.columns)})")
+        rich.print(f"      {c.description}: {len(a.statements)} statements, {a.total_ms / 1000:.1f} s in total")
+
+
+def create_index(psql, candidate: IndexCandidate, hypertable=False):
+    """
+    Builds an index without blocking writes. An invalid index left by a failed concurrent build is dropped first.
+    """
+    invalid = psql.query(f"SELECT 1 FROM pg_class c JOIN pg_index x ON x.indexrelid = c.oid "
+                         f"WHERE c.relname = {sql_literal(candidate.name)} AND NOT x.indisvalid;")
+    if invalid:
+        rich.print(f"[yellow]    dropping invalid index {candidate.name} (failed build)")
+        psql.run(f"DROP INDEX CONCURRENTLY IF EXISTS {candidate.name};")
+    # CONCURRENTLY can not run within a transaction, psql runs every statement in autocommit
+    psql.run(candidate.definition(hypertable=hypertable))
+    psql.run(f'ANALYZE "{candidate.table}";')
+
+
+def apply_advice(psql, advices: list, state: dict):
+    """
+    Creates the proposed indexes. The counters of the statements they target are stored in the state, so the
+    latency change can be reported later (see report_latency)
+    :param psql: Psql object connected to the master database
+    :param advices: list of Advice
+    :param state: 'db_advise' section of the ODI state, updated in place
+    """
+    hyper = hypertables(psql)
+    for a in advices:
+        rich.print(f"Creating index {a.candidate.name}...")
+        create_index(psql, a.candidate, hypertable=a.candidate.table in hyper)
+        state[a.candidate.name] = {
+            "date": datetime.now().isoformat(),
+            "statements": {s.queryid: [s.calls, s.total_ms] for s in a.statements}
+        }
+        rich.print(f"[green]    index {a.candidate.name} created")
+
+
+def report_latency(psql, state: dict):
+    """
+    Prints the mean latency of the statements targeted by the indexes created by ODI, before and after the index was
+    created. The latency after is computed from the calls recorded since then (pg_stat_statements is cumulative).
+    """
+    if not state:
+        return
+    current = {s.queryid: s for s in top_statements(psql, limit=10000)}
+    rich.print(f"\n{'index':<34} {'created':<19} {'calls since':>11} {'before (ms)':>12} {'after (ms)':>11}")
+    for name, entry in state.items():
+        before_calls = sum([v[0] for v in entry["statements"].values()])
+        before_ms = sum([v[1] for v in entry["statements"].values()])
+        calls = 0
+        total = 0.0
+        for queryid, (c0, t0) in entry["statements"].items():
+            s = current.get(queryid)
+            if s and s.calls >= c0:  # lower counters mean the statistics were reset
+                calls += s.calls - c0
+                total += s.total_ms - t0
+        before = f"{before_ms / before_calls:.2f}" if before_calls else "-"
+        after = f"{total / calls:.2f}" if calls else "-"
+        rich.print(f"{name:<34} {entry['date'][:19]:<19} {calls:>11} {before:>12} {after:>11}")
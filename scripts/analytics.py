@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Incremental analytics of the proxy access log. Every run only parses the lines written since the previous one (the
+byte offset is saved), handling log rotation, and updates rolling hourly aggregates per location: requests, bytes,
+status classes and latency histograms (mergeable, so any time window can be reported).
+
+license: MIT
+"""
+import os
+import json
+import zlib
+import math
+from datetime import datetime, timedelta, timezone
+import rich
+
+try:
+    from state import OdiState
+    from logrotate import is_gzip
+except ModuleNotFoundError:
+    from .state import OdiState
+    from .logrotate import is_gzip
+
+# Structured log written by the proxy, see log_format odi_tsv and odi_json in nginx.py
+analytics_log = "odi_access.log"
+analytics_state = "odi_analytics.json"
+
+
+def utc_hour(timestamp: str) -> str:
+    """
+    Converts an ISO 8601 timestamp with offset ($time_iso8601, e.g. 2026-10-18T12:30:00+02:00) into its UTC hour,
+    e.g. "2026-10-18T10". Timestamps without offset are taken as UTC.
+    """
+    t = datetime.fromisoformat(timestamp)
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=timezone.utc)
+    return t.astimezone(timezone.utc).strftime("%Y-%m-%dT%H")
+
+
+class LogHistogram:
+    def __init__(self, counts=None, growth=1.05):
+        """
+        Log-bucketed histogram of latencies in milliseconds. Bucket i holds values in (growth^(i-1), growth^i], so the
+        relative error of the quantiles is bounded by the growth factor. Histograms are merged by adding the counts.
+        :param counts: dict with {<bucket index>: count}, keys may be str (loaded from JSON)
+        :param growth: ratio between consecutive bucket bounds
+        """
+        self.growth = growth
+        self.counts = {int(k): v for k, v in counts.items()} if counts else {}
+
+    def add(self, ms: float):
+        index = 0 if ms <= 1 else math.ceil(math.log(ms) / math.log(self.growth))
+        self.counts[index] = self.counts.get(index, 0) + 1
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+    def quantile(self, q: float) -> float:
+        """
+        Returns the upper bound (ms) of the bucket containing the q quantile
+        """
+        total = self.total()
+        if not total:
+            return float("nan")
+        rank = q * total
+        seen = 0
+        for index in sorted(self.counts.keys()):
+            seen += self.counts[index]
+            if seen >= rank:
+                return self.growth ** index
+        return self.growth ** max(self.counts.keys())
+
+    def to_json(self) -> dict:
+        return {str(k): v for k, v in self.counts.items()}
+
+
+def parse_line(line: str) -> dict | None:
+    """
+    Parses a line of the structured access log, in the odi_tsv format:
+    $time_iso8601 $host $request_method $uri $status $body_bytes_sent $request_time $upstream_response_time ...
+    or in the odi_json format (see nginx.py)
+    :returns: dict or None if the line is not valid
+    """
+    try:
+        if line.startswith("{"):
+            r = json.loads(line)
+            fields = [r["time"], r["host"], r["method"], r["uri"], r["status"], r["bytes"], r["request_time"],
+                      r["upstream_time"], r["cache"]]
+        else:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 8:
+                return None
+            fields = fields[:8] + [fields[10] if len(fields) > 10 else ""]
+        uri = fields[3]
+        segment = uri.split("/")[1] if uri.count("/") > 0 else ""
+        # upstream time may be "-" or a list if several upstreams were tried ("0.010, 0.020" or "0.010 : 0.020")
+        upstream = [float(t) for t in fields[7].replace(":", ",").split(",") if t.strip() not in ["", "-"]]
+        return {
+            "hour": utc_hour(fields[0]),
+            "location": f"{fields[1]}/{segment}",
+            "status": int(fields[4]),
+            "bytes": int(fields[5]),
+            "request_time": float(fields[6]),
+            "upstream_time": sum(upstream) if upstream else None,
+            "cache": fields[8] if fields[8] not in ["", "-"] else ""
+        }
+    except (ValueError, IndexError, KeyError, TypeError):
+        return None
+
+
+def read_new_lines(filename: str, position: dict):
+    """
+    Yields the complete lines written after the saved position. If the log was rotated (different inode), the rest of
+    the rotated file (<filename>.1) is read first. If the file was truncated, it is read from the beginning. The
+    position is updated while reading.
+    :param filename: log file
+    :param position: dict with inode and offset, updated in place
+    """
+    if not os.path.exists(filename):
+        return
+    st = os.stat(filename)
+    if position.get("inode") and position["inode"] != st.st_ino:
+        rotated = filename + ".1"
+        if os.path.exists(rotated) and os.stat(rotated).st_ino == position["inode"]:
+            yield from read_lines_from(rotated, position["offset"], position)
+        position["offset"] = 0
+    elif position.get("offset", 0) > st.st_size:
+        position["offset"] = 0  # truncated
+    position["inode"] = st.st_ino
+    yield from read_lines_from(filename, position.get("offset", 0), position)
+
+
+def read_lines_from(filename: str, offset: int, position: dict):
+    if is_gzip(filename):
+        yield from read_gzip_members(filename, offset, position)
+        return
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                break  # line still being written, it will be read in the next run
+            offset += len(raw)
+            position["offset"] = offset
+            yield raw.decode(errors="replace")
+
+
+def read_gzip_members(filename: str, offset: int, position: dict, chunk_size=2 ** 20):
+    """
+    Reads a log written by nginx with gzip=N: every buffer flush appends a new gzip member, so the file can be read
+    incrementally member by member. The offset always points to the start of a member.
+    """
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        data = b""
+        while True:
+            chunk = f.read(chunk_size)
+            data += chunk
+            while data:
+                decompressor = zlib.decompressobj(wbits=31)
+                try:
+                    text = decompressor.decompress(data)
+                except zlib.error as e:
+                    rich.print(f"[red]ERROR: corrupted gzip member in {filename} at byte {f.tell() - len(data)}: {e}")
+                    return
+                if not decompressor.eof:
+                    break  # member still being written (or longer than the data read)
+                data = decompressor.unused_data
+                yield from text.decode(errors="replace").splitlines()
+                position["offset"] = f.tell() - len(data)  # start of the next member
+            if not chunk:
+                break
+
+
+def update_aggregates(aggregates: dict, lines) -> int:
+    """
+    Adds lines to the hourly aggregates
+    :param aggregates: dict with {<location>: {<UTC hour>: aggregate}}, updated in place
+    :param lines: iterable of log lines
+    :returns: number of lines processed
+    """
+    count = 0
+    histograms = {}  # decoded histograms, written back at the end
+    for line in lines:
+        r = parse_line(line)
+        if not r:
+            continue
+        count += 1
+        agg = aggregates.setdefault(r["location"], {}).setdefault(r["hour"], {
+            "requests": 0, "bytes": 0, "status": {}, "cache": {}, "latency": {}, "upstream": {}})
+        agg["requests"] += 1
+        agg["bytes"] += r["bytes"]
+        status = f"{r['status'] // 100}xx"
+        agg["status"][status] = agg["status"].get(status, 0) + 1
+        if r["cache"]:
+            cache = agg.setdefault("cache", {})  # aggregates stored before the cache status was logged
+            cache[r["cache"]] = cache.get(r["cache"], 0) + 1
+        key = (r["location"], r["hour"])
+        if key not in histograms.keys():
+            histograms[key] = (LogHistogram(agg["latency"]), LogHistogram(agg["upstream"]))
+        histograms[key][0].add(1000 * r["request_time"])
+        if r["upstream_time"] is not None:
+            histograms[key][1].add(1000 * r["upstream_time"])
+
+    for (location, hour), (latency, upstream) in histograms.items():
+        aggregates[location][hour]["latency"] = latency.to_json()
+        aggregates[location][hour]["upstream"] = upstream.to_json()
+    return count
+
+
+def prune_aggregates(aggregates: dict, retention_hours: int):
+    """
+    Removes hourly aggregates older than the retention
+    """
+    oldest = (datetime.now(timezone.utc) - timedelta(hours=retention_hours)).strftime("%Y-%m-%dT%H")
+    for location in list(aggregates.keys()):
+        for hour in [h for h in aggregates[location].keys() if h < oldest]:
+            aggregates[location].pop(hour)
+        if not aggregates[location]:
+            aggregates.pop(location)
+
+
+def report(aggregates: dict, hours: int) -> list:
+    """
+    Merges the hourly aggregates of the last hours per location
+    :returns: list of dicts with the location metrics, sorted by number of requests
+    """
+    since = (datetime.now(timezone.utc) - timedelta(hours=hours)).strftime("%Y-%m-%dT%H")
+    rows = []
+    for location, hourly in aggregates.items():
+        selected = [agg for hour, agg in hourly.items() if hour >= since]
+        if not selected:
+            continue
+        latency = LogHistogram()
+        upstream = LogHistogram()
+        status = {}
+        cache = {}
+        for agg in selected:
+            latency.merge(LogHistogram(agg["latency"]))
+            upstream.merge(LogHistogram(agg["upstream"]))
+            for key, count in agg["status"].items():
+                status[key] = status.get(key, 0) + count
+            for key, count in agg.get("cache", {}).items():
+                cache[key] = cache.get(key, 0) + count
+        requests = sum([agg["requests"] for agg in selected])
+        rows.append({
+            "location": location,
+            "requests": requests,
+            "rate": requests / (hours * 3600),
+            "bytes": sum([agg["bytes"] for agg in selected]),
+            "status": {k: status[k] / requests for k in sorted(status.keys())},
+            "p50": latency.quantile(0.5), "p95": latency.quantile(0.95), "p99": latency.quantile(0.99),
+            "upstream_p95": upstream.quantile(0.95),
+            # HIT, STALE, UPDATING and REVALIDATED are served from the cache
+            "cache_hits": sum([cache.get(k, 0) for k in ["HIT", "STALE", "UPDATING", "REVALIDATED"]]) / requests
+        })
+    return sorted(rows, key=lambda row: -row["requests"])
+
+
+def print_report(rows: list, hours: int):
+    if not rows:
+        rich.print(f"[grey42]No requests in the last {hours} hours")
+        return
+    width = max([len(r["location"]) for r in rows] + [8])
+    rich.print(f"Last {hours} hours, latencies in ms")
+    rich.print(f"{'location':<{width}} {'requests':>9} {'req/s':>7} {'MB':>8} {'p50':>7} {'p95':>7} {'p99':>7} "
+               f"{'up p95':>7} {'cached':>7}  status")
+    for r in rows:
+        status = " ".join([f"{k}:{100 * v:.1f}%" for k, v in r["status"].items()])
+        rich.print(f"{r['location']:<{width}} {r['requests']:>9} {r['rate']:>7.2f} {r['bytes'] / 1e6:>8.1f} "
+                   f"{r['p50']:>7.1f} {r['p95']:>7.1f} {r['p99']:>7.1f} {r['upstream_p95']:>7.1f} "
+                   f"{100 * r['cache_hits']:>6.1f}%  {status}")
+
+
+def run_analytics(log_folder: str, hours=24, retention_hours=24 * 7):
+    """
+    Processes the new lines of the proxy log and prints the report of the last hours
+    :param log_folder: proxy log folder (volumes/log of the proxy service)
+    :param hours: report window
+    :param retention_hours: hourly aggregates older than this are removed
+    """
+    state = OdiState(os.path.join(log_folder, analytics_state))
+    position = state.section("position")
+    aggregates = state.section("aggregates")
+    count = update_aggregates(aggregates, read_new_lines(os.path.join(log_folder, analytics_log), position))
+    prune_aggregates(aggregates, retention_hours)
+    state.touch()
+    state.save()
+    rich.print(f"[grey42]{count} new requests processed")
+    print_report(report(aggregates, hours), hours)
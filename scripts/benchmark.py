@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Synthetic-scale benchmarks for the ODI control plane. Creates synthetic deployments with N networks, M hosts and K
+services (each one with a docker-compose file holding several containers and volumes) and measures how long it takes
+to parse, validate, generate the odi.env and nginx.conf contents and plan the setup. Docker is replaced by a stub
+client, so no docker daemon is needed. Results can be stored as JSON to track regressions.
+
+license: MIT
+"""
+from argparse import ArgumentParser
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+from datetime import datetime
+import yaml
+import rich
+
+try:
+    from infrastructure import Infrastructure
+    from utils import load_yaml, set_docker_client
+except ModuleNotFoundError:
+    from scripts.infrastructure import Infrastructure
+    from scripts.utils import load_yaml, set_docker_client
+
+# service types with an NGINX configuration, used to name the synthetic services
+service_types = ["erddap", "grafana", "sta-master", "sta-ts-master", "ckan", "zabbix", "pgadmin", "fileserver", "mmapi"]
+
+proxy_compose = {"services": {"reverse": {"container_name": "proxy", "image": "nginx:stable-bullseye",
+                                          "volumes": ["./nginx.conf:/etc/nginx/nginx.conf:ro"]}}}
+
+
+class StubDockerApi:
+    def __init__(self, images, networks, containers):
+        self.calls = 0
+        self.__images = [{"Id": f"sha256:{i}", "RepoTags": [f"{name}:latest"]} for i, name in enumerate(images)]
+        self.__networks = [{"Name": name} for name in networks]
+        self.__containers = [{"Id": f"{i}", "Names": [f"/{name}"]} for i, name in enumerate(containers)]
+
+    def images(self):
+        self.calls += 1
+        return self.__images
+
+    def networks(self):
+        self.calls += 1
+        return self.__networks
+
+    def containers(self, all=False):
+        self.calls += 1
+        return self.__containers
+
+
+class StubDockerClient:
+    def __init__(self, images=[], networks=[], containers=[]):
+        """
+        Minimal replacement of docker.DockerClient, only implements the low-level calls used by DockerIndex
+        """
+        self.api = StubDockerApi(images, networks, containers)
+
+
+def compose_file(service: str, ncontainers: int, nvolumes: int) -> dict:
+    """
+    Generates a synthetic docker-compose file
+    """
+    services = {}
+    for c in range(ncontainers):
+        services[f"{service}-c{c}"] = {
+            "container_name": f"{service}-c{c}",
+            "image": f"{service}-img{c}",
+            "volumes": [f"./volumes/c{c}/v{v}:/data/v{v}" for v in range(nvolumes)],
+            "networks": [f"bench-net{c % 3}"]
+        }
+    return {"services": services, "networks": {f"bench-net{n}": {"external": True} for n in range(3)}}
+
+
+def synthetic_infrastructure(path: str, nnetworks=1, nhosts=10, nservices=100, nlocal=0, ncontainers=1,
+                             nvolumes=1) -> str:
+    """
+    Creates a synthetic ODI deployment. The current host belongs to the first network and runs the proxy and nlocal
+    services (with its docker-compose files), the rest of services are distributed among the remote hosts.
+    :param path: folder where the deployment is created
+    :param nnetworks: number of networks
+    :param nhosts: number of remote hosts
+    :param nservices: number of services
+    :param nlocal: number of services running in the current host
+    :param ncontainers: containers in each docker-compose file
+    :param nvolumes: volumes in each container
+    :returns: path to the infrastructure.yaml file
+    """
+    hostname = os.uname().nodename
+    nhosts = max(nhosts, 1)
+    networks = {f"net{n}": {} for n in range(nnetworks)}
+    networks["net0"][hostname] = {"ip": "10.0.0.1", "dns": ["proxy.example.org"]}
+    hosts = []
+    for h in range(nhosts):
+        host = f"host{h}"
+        net = f"net{h % nnetworks}"
+        x = h + 2  # 10.0.0.1 is the current host
+        networks[net][host] = {"ip": f"10.{x // 65536}.{(x // 256) % 256}.{x % 256}", "dns": []}
+        hosts.append((host, net))
+
+    services = {"proxy": {"host": hostname, "dns": "proxy.example.org"}}
+    for i in range(nservices):
+        name = f"{service_types[i % len(service_types)]}-{i}"
+        dns = f"service{i}.example.org"
+        if i < nlocal:
+            host, net = hostname, "net0"
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+            with open(os.path.join(path, name, "docker-compose.yaml"), "w") as f:
+                yaml.safe_dump(compose_file(name, ncontainers, nvolumes), f)
+        else:
+            host, net = hosts[i % nhosts]
+        networks[net][host]["dns"].append(dns)
+        services[name] = {"host": host, "dns": dns, "port": 8000 + i % 1000}
+
+    conf = {"infrastructure": {
+        "path": path,
+        "networks": networks,
+        "port_mappings": {},
+        "services": services,
+        "soft_links": {}
+    }}
+
+    os.makedirs(os.path.join(path, "proxy"), exist_ok=True)
+    with open(os.path.join(path, "proxy", "docker-compose.yaml"), "w") as f:
+        yaml.safe_dump(proxy_compose, f)
+
+    filename = os.path.join(path, "infrastructure.yaml")
+    with open(filename, "w") as f:
+        yaml.safe_dump(conf, f)
+    return filename
+
+
+def timeit(f, repeat=1) -> (float, any):
+    """
+    Runs f repeat times, returns the best time and the result
+    """
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        init = time.perf_counter()
+        result = f()
+        best = min(best, time.perf_counter() - init)
+    return best, result
+
+
+def run_benchmark(nnetworks, nhosts, nservices, nlocal, ncontainers, nvolumes, repeat=1) -> dict:
+    """
+    Creates a synthetic deployment and times every stage of the control plane
+    :returns: dict with the parameters and the time (in seconds) spent by each stage
+    """
+    params = {"networks": nnetworks, "hosts": nhosts, "services": nservices, "local_services": nlocal,
+              "containers": ncontainers, "volumes": nvolumes}
+    timings = {}
+    with tempfile.TemporaryDirectory() as path:
+        filename = synthetic_infrastructure(path, nnetworks, nhosts, nservices, nlocal, ncontainers, nvolumes)
+        state_file = os.path.join(path, ".stat.json")
+        yaml_files = [filename] + [os.path.join(path, d, "docker-compose.yaml") for d in os.listdir(path)
+                                   if os.path.isdir(os.path.join(path, d))]
+
+        def cold_load():
+            if os.path.exists(state_file):
+                os.remove(state_file)
+            return Infrastructure(filename)
+
+        def parse_all():
+            for yaml_file in yaml_files:
+                with open(yaml_file) as f:
+                    load_yaml(f)
+
+        timings["yaml_parse"], _ = timeit(parse_all, repeat)
+        timings["load_cold"], _ = timeit(cold_load, repeat)
+        # with a warm parse cache, loading is mostly validation and building the model
+        timings["load_cached"], infra = timeit(lambda: Infrastructure(filename), repeat)
+        timings["dependencies"], _ = timeit(lambda: infra.service_dependencies(list(infra.dcompose_services)),
+                                            repeat)
+        timings["odi_env"], _ = timeit(lambda: infra.odi_env_contents(verbose=False), repeat)
+        timings["nginx_conf"], _ = timeit(lambda: infra.nginx_conf_contents(verbose=False), repeat)
+
+        # Stub docker with half the networks already created
+        stub = StubDockerClient(networks=["bench-net0"])
+        set_docker_client(stub)
+
+        def plan():
+            return [a for s in infra.dcompose_services.values() for a in s.plan()]
+
+        timings["setup_plan"], actions = timeit(plan, repeat)
+        set_docker_client(None)
+
+    return {"parameters": params, "timings": timings, "planned_actions": len(actions),
+            "docker_api_calls": stub.api.calls}
+
+
+def scaling_benchmark(max_services: int, steps: int, repeat=1) -> list:
+    """
+    Runs the benchmark for max_services, max_services/2, max_services/4... to check that every stage scales linearly
+    :returns: list of results
+    """
+    results = []
+    sizes = sorted([max(max_services // 2 ** i, 1) for i in range(steps)])
+    for n in sizes:
+        results.append(run_benchmark(1, max(n // 10, 1), n, 0, 1, 1, repeat=repeat))
+    return results
+
+
+def print_results(results: list):
+    stages = list(results[0]["timings"].keys())
+    rich.print(f"{'services':>8} " + " ".join([f"{s:>12}" for s in stages]) + "  (ms)")
+    for r in results:
+        line = f"{r['parameters']['services']:>8} "
+        line += " ".join([f"{1000 * r['timings'][s]:>12.2f}" for s in stages])
+        rich.print(line)
+
+
+if __name__ == "__main__":
+    argparser = ArgumentParser()
+    argparser.add_argument("-N", "--networks", help="Number of networks", type=int, default=2)
+    argparser.add_argument("-M", "--hosts", help="Number of remote hosts", type=int, default=50)
+    argparser.add_argument("-K", "--services", help="Number of services", type=int, default=500)
+    argparser.add_argument("-l", "--local-services", help="Services running in this host", type=int, default=20)
+    argparser.add_argument("-c", "--containers", help="Containers per docker-compose file", type=int, default=10)
+    argparser.add_argument("-V", "--volumes", help="Volumes per container", type=int, default=10)
+    argparser.add_argument("-r", "--repeat", help="Repetitions per stage, best time is kept", type=int, default=3)
+    argparser.add_argument("-s", "--scaling", help="Run a scaling benchmark with n, n/2, n/4... services "
+                                                   "(this number of steps)", type=int, default=0)
+    argparser.add_argument("-o", "--output", help="Store the results in a JSON file", type=str, default="")
+    args = argparser.parse_args()
+
+    if args.scaling:
+        results = scaling_benchmark(args.services, args.scaling, repeat=args.repeat)
+    else:
+        results = [run_benchmark(args.networks, args.hosts, args.services, args.local_services, args.containers,
+                                 args.volumes, repeat=args.repeat)]
+    print_results(results)
+
+    if args.output:
+        report = {
+            "date": datetime.now().isoformat(),
+            "python": sys.version.split(" ")[0],
+            "platform": platform.platform(),
+            "results": results
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        rich.print(f"[green]results stored in {args.output}")
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Runs an ODI action in several hosts of the infrastructure concurrently. Every host runs its own odi_manager.py through a
+transport (SSH in production, a local subprocess to test it), the output is streamed with the host name as prefix.
+
+license: MIT
+"""
+import os
+import sys
+import shlex
+
+try:
+    from utils import run_subprocess_pipe
+    from scheduler import run_tasks, print_summary
+except ModuleNotFoundError:
+    from .utils import run_subprocess_pipe
+    from .scheduler import run_tasks, print_summary
+
+
+class SshTransport:
+    def __init__(self, user="", options=[]):
+        """
+        Runs odi_manager.py in a remote host through SSH, connecting to the IP address declared for the host in
+        infrastructure.yaml. The ODI repository is expected in the ODI path of every host and SSH must be able to log
+        in without a password
+        :param user: remote user, if not set the SSH default (or ~/.ssh/config) is used
+        :param options: extra SSH options, e.g. ["-p", "2222"]
+        """
+        self.user = user
+        self.options = options
+
+    def command(self, host: str, address: str, path: str, args: list) -> list:
+        """
+        :param host: host name in infrastructure.yaml
+        :param address: IP address declared for the host, the host name is used if empty
+        """
+        address = address or host
+        target = f"{self.user}@{address}" if self.user else address
+        remote = f"cd {shlex.quote(path)} && python3 odi_manager.py {shlex.join(args)}"
+        return ["ssh", "-o", "BatchMode=yes"] + self.options + [target, remote]
+
+
+class LocalTransport:
+    def __init__(self, odi_manager=""):
+        """
+        Runs odi_manager.py locally, pretending to be another host (--hostname). Used to test the fan-out without
+        remote hosts
+        :param odi_manager: path to odi_manager.py, defaults to the one of this repository
+        """
+        if not odi_manager:
+            odi_manager = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "odi_manager.py")
+        self.odi_manager = odi_manager
+
+    def command(self, host: str, address: str, path: str, args: list) -> list:
+        return [sys.executable, self.odi_manager, "--hostname", host] + args
+
+
+def fleet_hosts(infrastructure, services=[]) -> dict:
+    """
+    Selects the hosts involved in an action
+    :param infrastructure: Infrastructure object
+    :param services: services selected by the user, if empty all hosts with services or port mappings are selected
+    :returns: dict with {<host>: [services of the host selected by the user]}
+    """
+    hosts = {}
+    if services:
+        for service in services:
+            if service not in infrastructure.service_host.keys():
+                raise ValueError(f"Service '{service}' not declared in the infrastructure")
+            hosts.setdefault(infrastructure.service_host[service], []).append(service)
+        return hosts
+
+    for host in list(infrastructure.service_host.values()) + list(infrastructure.mappings.keys()):
+        hosts.setdefault(host, [])
+    return hosts
+
+
+def run_fleet(infrastructure, action: str, services: list, options: list, transport, jobs=8, debug=False) -> dict:
+    """
+    Runs an action in all the hosts at the same time
+    :param infrastructure: Infrastructure object
+    :param action: ODI action, e.g. "up", or action and subcommand, e.g. "db advise"
+    :param services: services selected by the user (each host only receives its own services)
+    :param options: extra odi_manager.py arguments forwarded to each host
+    :param transport: object with a command(host, address, path, args) method
+    :param jobs: max number of hosts running at the same time (--jobs)
+    :param debug: print the commands
+    :returns: dict with {<host>: TaskResult}
+    """
+    hosts = fleet_hosts(infrastructure, services)
+
+    def host_task(host):
+        def task():
+            # prefer the address in a network shared with this host
+            address = (infrastructure.routing.shared_ip(infrastructure.hostname, host) or
+                       infrastructure.host_ip.get(host, ""))
+            cmd = transport.command(host, address, infrastructure.path, action.split() + hosts[host] + options)
+            run_subprocess_pipe(cmd, debug=debug, prefix=host)
+        return task
+
+    tasks = {host: host_task(host) for host in sorted(hosts.keys())}
+    results = run_tasks(tasks, {}, jobs=jobs)
+    print_summary(results, label="host")
+    return results
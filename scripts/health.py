@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Waits until the containers of a set of services are healthy, following the health_status transitions in the docker
+events stream (a single subscription for all the containers, no polling)
+
+license: MIT
+"""
+from datetime import datetime
+import rich
+
+try:
+    from utils import docker_client
+except ModuleNotFoundError:
+    from .utils import docker_client
+
+
+class ContainerHealth:
+    def __init__(self, name, service, container_id, has_healthcheck):
+        """
+        Health of a container while waiting for it
+        :param name: container name
+        :param service: ODI service of the container
+        :param container_id: docker container id
+        :param has_healthcheck: if False, the container is ready as soon as it is running
+        """
+        self.name = name
+        self.service = service
+        self.id = container_id
+        self.has_healthcheck = has_healthcheck
+        self.status = "starting"  # starting, healthy, running (no healthcheck)
+        self.elapsed = 0.0  # time to healthy since the action started
+
+
+def has_healthcheck(config: dict) -> bool:
+    """
+    Checks if a container runs a healthcheck, from the Config of its inspect attributes. Healthchecks disabled with
+    HEALTHCHECK NONE (or 'disable: true' in docker compose) are kept in the config with test ["NONE"], and an empty
+    test inherits the healthcheck of the image, which is already merged in the config
+    """
+    test = (config.get("Healthcheck") or {}).get("Test") or []
+    return bool(test) and test[0] != "NONE"
+
+
+def last_healthcheck_output(client, container_id: str) -> str:
+    """
+    Returns the output of the last healthcheck run of a container
+    """
+    state = client.api.inspect_container(container_id)["State"]
+    log = (state.get("Health") or {}).get("Log") or []
+    return log[-1]["Output"].strip() if log else ""
+
+
+def docker_timestamp(value: str) -> float:
+    """
+    Converts a docker timestamp (RFC 3339 with nanoseconds, e.g. 2026-10-18T10:00:00.123456789Z) into a UNIX time
+    """
+    value = value.replace("Z", "+00:00")
+    if "." in value:
+        # fromisoformat only accepts up to microseconds
+        seconds, rest = value.split(".", 1)
+        digits = len(rest) - len(rest.lstrip("0123456789"))
+        value = f"{seconds}.{rest[:digits][:6]:0<6}{rest[digits:]}"
+    return datetime.fromisoformat(value).timestamp()
+
+
+def healthy_since(health_state: dict, since: float) -> float:
+    """
+    Returns the time to healthy of a container that is already healthy: the end of its first passing healthcheck
+    after 'since' (within the last probes kept by docker), or 0 if it was already healthy before 'since'
+    """
+    ends = []
+    for probe in health_state.get("Log") or []:
+        try:
+            if probe.get("ExitCode") == 0:
+                ends.append(docker_timestamp(probe["End"]) - since)
+        except (KeyError, ValueError):
+            continue
+    after = [t for t in ends if t >= 0]
+    return min(after) if after and len(after) == len(ends) else 0.0
+
+
+def wait_healthy(containers: dict, since: float, timeout=600) -> dict:
+    """
+    Waits until all the containers are healthy. Containers without a healthcheck only need to be running. The events
+    are replayed from 'since', so transitions that happened before calling this function are not lost.
+    :param containers: dict with {<container name>: <service name>}
+    :param since: timestamp when the containers were started (e.g. before running docker compose up)
+    :param timeout: max time (in seconds since 'since') to wait
+    :returns: dict with {<container name>: ContainerHealth}
+    :raises: ValueError if a container is not found, unhealthy, dies or does not get healthy before the timeout
+    """
+    client = docker_client()
+    from docker.errors import NotFound  # docker is already imported by docker_client
+    health = {}
+    for name, service in containers.items():
+        try:
+            attrs = client.api.inspect_container(name)
+        except NotFound:
+            raise ValueError(f"Container '{name}' of service '{service}' not found")
+        state = attrs["State"]
+        if not state["Running"] and state["Status"] != "restarting":
+            raise ValueError(f"Container '{name}' of service '{service}' is not running "
+                             f"(status {state['Status']}, exit code {state['ExitCode']})")
+        h = ContainerHealth(name, service, attrs["Id"], has_healthcheck(attrs["Config"]))
+        # the current health status, transitions that happened before 'since' are not in the events stream
+        status = (state.get("Health") or {}).get("Status", "")
+        if not h.has_healthcheck:
+            h.status = "running"
+        elif status == "healthy":
+            h.status = "healthy"
+            h.elapsed = healthy_since(state["Health"], since)
+            rich.print(f"[green]  {h.name} healthy after {h.elapsed:.1f} s")
+        elif status == "unhealthy":
+            output = last_healthcheck_output(client, attrs["Id"])
+            raise ValueError(f"Container '{name}' of service '{service}' is unhealthy, last healthcheck output:\n"
+                             f"{output}")
+        health[attrs["Id"]] = h
+
+    pending = {cid for cid, h in health.items() if h.status == "starting"}
+    if pending:
+        rich.print(f"Waiting for {len(pending)} containers to be healthy...")
+        events = client.events(since=int(since), until=int(since + timeout) + 1, decode=True,
+                               filters={"type": "container", "container": list(pending),
+                                        "event": ["health_status", "die"]})
+        try:
+            for event in events:
+                cid = event["id"]
+                if cid not in pending:
+                    continue
+                h = health[cid]
+                action = event.get("Action", event.get("status", ""))
+                elapsed = event["timeNano"] / 1e9 - since
+                if action == "die":
+                    code = event["Actor"]["Attributes"].get("exitCode", "?")
+                    raise ValueError(f"Container '{h.name}' of service '{h.service}' died (exit code {code})")
+                elif action.endswith("unhealthy"):
+                    output = last_healthcheck_output(client, cid)
+                    raise ValueError(f"Container '{h.name}' of service '{h.service}' is unhealthy after "
+                                     f"{elapsed:.1f} s, last healthcheck output:\n{output}")
+                elif action.endswith("healthy"):
+                    h.status = "healthy"
+                    h.elapsed = elapsed
+                    pending.remove(cid)
+                    rich.print(f"[green]  {h.name} healthy after {elapsed:.1f} s")
+                    if not pending:
+                        break
+        finally:
+            events.close()
+
+    if pending:
+        names = ", ".join([health[cid].name for cid in pending])
+        raise ValueError(f"Timeout ({timeout} s) waiting for containers to be healthy: {names}")
+    return {h.name: h for h in health.values()}
+
+
+def print_time_to_healthy(health: dict):
+    """
+    Prints the time to healthy of each service (the slowest of its containers)
+    :param health: dict with {<container name>: ContainerHealth}
+    """
+    services = {}
+    for h in health.values():
+        services.setdefault(h.service, []).append(h)
+    width = max([len(s) for s in services.keys()] + [7])
+    rich.print(f"\n{'service':<{width}}  time to healthy")
+    for service, containers in services.items():
+        checked = [h.elapsed for h in containers if h.has_healthcheck]
+        elapsed = f"{max(checked):.1f} s" if checked else "no healthcheck"
+        rich.print(f"{service:<{width}}  {elapsed}")
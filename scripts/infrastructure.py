@@ -1,20 +1,31 @@
-from multiprocessing.managers import Value
-
-import yaml
 import os
 import rich
-import traceback
 import json
+import time
 import getpass
-import docker
+from datetime import datetime
 
 
 try:
-    from utils import check_optional_keys, check_required_keys, run_subprocess, run_subprocess_pipe
-    from nginx import nginx_server_start, service_nginx_config, nginx_conf_start, nginx_server_end, nginx_conf_end
+    from utils import check_optional_keys, check_required_keys, run_subprocess, run_subprocess_pipe, docker_client, \
+        docker_index, load_yaml, content_hash, file_changed, write_if_changed, container_exec
+    from state import OdiState
+    from routing import RoutingGraph, docker_host_ip
+    from nginx import nginx_server_start, service_nginx_config, nginx_conf_start, nginx_server_end, nginx_conf_end, \
+        nginx_upstream_name, nginx_upstream_config, nginx_profile_config, nginx_profile_keys, keepalive_headers, \
+        nginx_cache_keys, nginx_cache_path_config, nginx_cache_config, nginx_split_config, nginx_variable_proxy_pass, \
+        nginx_tls_keys, nginx_tls_config, nginx_ssl_folder, nginx_logging_keys, nginx_logging_defaults, \
+        nginx_logging_config, nginx_log_sample_config, nginx_log_folder
 except ModuleNotFoundError:
-    from .utils import check_optional_keys, check_required_keys, run_subprocess, run_subprocess_pipe
-    from .nginx import nginx_server_start, service_nginx_config, nginx_conf_start, nginx_server_end, nginx_conf_end
+    from .utils import check_optional_keys, check_required_keys, run_subprocess, run_subprocess_pipe, docker_client, \
+        docker_index, load_yaml, content_hash, file_changed, write_if_changed, container_exec
+    from .state import OdiState
+    from .routing import RoutingGraph, docker_host_ip
+    from .nginx import nginx_server_start, service_nginx_config, nginx_conf_start, nginx_server_end, nginx_conf_end, \
+        nginx_upstream_name, nginx_upstream_config, nginx_profile_config, nginx_profile_keys, keepalive_headers, \
+        nginx_cache_keys, nginx_cache_path_config, nginx_cache_config, nginx_split_config, nginx_variable_proxy_pass, \
+        nginx_tls_keys, nginx_tls_config, nginx_ssl_folder, nginx_logging_keys, nginx_logging_defaults, \
+        nginx_logging_config, nginx_log_sample_config, nginx_log_folder
 
 
 
@@ -83,6 +94,12 @@ class Volume:
             rich.print(f"        changing owner to {self.user}")
             run_subprocess(f"sudo chown {self.user}:{self.user} {self.source}")
 
+    def pending(self) -> bool:
+        """
+        Returns True if the volume is ODI-managed and has not been created yet
+        """
+        return self.odi_managed and not os.path.exists(self.source)
+
     def remove(self):
         if not self.odi_managed:
             return
@@ -118,8 +135,18 @@ class Container:
         if "networks" in conf.keys():
             self.networks += conf["networks"]
 
+        self.build_conf = {}  # context, dockerfile, args and target
         if "build" in conf.keys():
             self.requires_build = True
+            build = conf["build"]
+            if isinstance(build, str):
+                build = {"context": build}
+            args = build.get("args", {})
+            if isinstance(args, list):
+                # bare args (no value) are taken from the environment when the image is built
+                args = dict([a.split("=", 1) if "=" in a else (a, None) for a in args])
+            self.build_conf = {"context": build.get("context", "."), "dockerfile": build.get("dockerfile", ""),
+                               "args": args, "target": build.get("target", "")}
 
         if "volumes" in conf.keys():
             for v in conf["volumes"]:
@@ -133,54 +160,51 @@ class Container:
         for v in self.volumes:
             v.setup()
 
-    def build(self):
+    def build(self, cache_root):
+        """
+        Builds the image with docker compose. If the ODI BuildKit builder is available (see 'odi prepare'), the image
+        is built with it instead, using a persistent local build cache
+        :param cache_root: build cache folder
+        """
         if not self.requires_build:
             return
         # Check if there's an image with that name
-        dclient = docker.from_env()
-        images = dclient.images.list()
-        image_names = []
-        for img in images:
-            if len(img.tags) == 0:
-                continue
-            name = img.tags[0]
-            if "/" in name:
-                name = name.split("/")[1]
-            name = name.split(":")[0]
-            image_names.append(name)
-
-        if self.container_name in image_names:
+        if docker_index().has_image(self.image):
             # no need to build the container, already an image created
             rich.print(f"Image '{self.image}' already built")
             return
         rich.print(f"Building image: '{self.image}'")
-        run_subprocess(f"docker compose build {self.service_name}")
-
-
+        try:
+            from prepare import builder_available, build_image
+        except ModuleNotFoundError:
+            from .prepare import builder_available, build_image
+        if builder_available():
+            build_image(self, cache_root)
+        else:
+            run_subprocess(f"docker compose build {self.service_name}", cwd=self.path)
+        docker_index().invalidate()
 
     def remove(self):
-
-        dclient = docker.from_env()
         # Remove image
         if self.requires_build:
-            try:
-                img = dclient.images.get(self.image)
+            if docker_index().has_image(self.image):
                 rich.print(f"      removing image: {self.image}")
-                img.remove()
-            except docker.errors.NotFound:
+                docker_client().images.remove(self.image)
+                docker_index().invalidate()
+            else:
                 rich.print(f"[yellow]      image not found: {self.image}")
-                pass
 
         for v in self.volumes:
             v.remove()
 
 
 class Service:
-    def __init__(self, path, force_ownerships={}):
+    def __init__(self, path, force_ownerships={}, state=None):
         """
         Parses a docker-compose file defining a service. Each service may have one or more containers
         :param filename: docker-compose file
         :param force_ownerships: ownerships of docker volumes. Useful for multi-user containers key=path value=owner
+        :param state: OdiState object, if set the docker-compose file is loaded through its parse cache
         """
         self.path = path
         self.docker_compose = os.path.join(path, "docker-compose.yaml")
@@ -191,8 +215,11 @@ class Service:
         if not os.path.exists(self.docker_compose):
             raise FileNotFoundError(f"{self.docker_compose} does not exist")
 
-        with open(self.docker_compose) as f:
-            compose = yaml.safe_load(f)
+        if state:
+            compose = state.load_yaml(self.docker_compose)
+        else:
+            with open(self.docker_compose) as f:
+                compose = load_yaml(f)
 
         for docker_service, container in (compose["services"].items()):
             c = Container(docker_service, container, self.path)
@@ -212,12 +239,11 @@ class Service:
         :return:
         """
         rich.print(f"   setting up service '{self.name}'")
-        dclient = docker.from_env()
-        existing_networks = [n.name for n in dclient.networks.list()]
         for network in self.networks:
-            if network not in existing_networks:
+            if not docker_index().has_network(network):
                 rich.print(f"    Creating network {network}")
-                dclient.networks.create(network)
+                docker_client().networks.create(network)
+                docker_index().invalidate()
             else:
                 rich.print(f"    [grey42]Network {network} already exists")
 
@@ -228,26 +254,60 @@ class Service:
             rich.print(f"    Forcing ownership of '{path}' to user '{user}'")
             run_subprocess(f"sudo chown {user}:{user} {path}")
 
-    def build(self):
+    def plan(self) -> list:
+        """
+        Lists the setup actions pending for this service (networks and volumes to be created), without changing
+        anything
+        :return: list of strings describing the pending actions
+        """
+        actions = []
+        for network in self.networks:
+            if not docker_index().has_network(network):
+                actions.append(f"create network {network}")
         for c in self.containers:
-            c.build()
+            for v in c.volumes:
+                if v.pending():
+                    actions.append(f"create volume {v.source}")
+        return actions
+
+    def build(self, cache_root):
+        for c in self.containers:
+            c.build(cache_root)
 
     def remove(self):
         for c in self.containers:
             c.remove()
 
 
+class SetupStep:
+    def __init__(self, name, inputs, changes, run):
+        """
+        A single step of the infrastructure setup
+        :param name: unique step name, used as key in the setup journal
+        :param inputs: str with everything the step depends on, its hash is stored in the journal
+        :param changes: list of strings describing the differences between the desired and the current state
+        :param run: callable that executes the step
+        """
+        self.name = name
+        self.inputs_hash = content_hash(inputs)
+        self.changes = changes
+        self.run = run
+
+
 class Infrastructure:
-    def __init__(self, file):
+    def __init__(self, file, hostname=""):
         """
         High-level class to manage ODI deployments
         :param file: infrastructure.yaml file
+        :param hostname: act as this host, defaults to the current hostname
         """
-        with open(file) as f:
-            conf = yaml.safe_load(f)["infrastructure"]
+        # infrastructure.yaml is loaded through the parse cache of the state next to it, which is the ODI state as
+        # long as the file is kept in the ODI path (the usual setup, e.g. /opt/odi/infrastructure.yaml)
+        state = OdiState(os.path.join(os.path.dirname(os.path.abspath(file)), ".stat.json"))
+        conf = state.load_yaml(file)["infrastructure"]
 
         self.conf = conf
-        self.hostname = os.uname().nodename
+        self.hostname = hostname if hostname else os.uname().nodename
 
         required_keys = {"path": str, "networks": dict, "port_mappings": dict, "services": dict, "soft_links": dict}
         check_required_keys(conf, required_keys)
@@ -262,19 +322,34 @@ class Infrastructure:
         self.dcompose_services = {}
         self.dns = {}
 
+        # Indexes shared by all the configuration generators
+        self.host_network = {}  # key hostname, value network name (the first one if it belongs to several)
+        self.host_ip = {}  # key hostname, value IP address (in its first network)
+        self.host_networks = {}  # key hostname, value dict with {network name: IP address}
+        self.dns_networks = {}  # key DNS name, value set of networks where it is declared
+        self.service_host = {}  # key service name, value hostname
+        self.dns_services = {}  # key DNS name, value list of services
+
         self.service_alias = {}  # key alias, value service name (the real one)
 
         # Make sure that the path exists
         path = conf["path"]
 
         self.odi_config = os.path.join(path, ".stat.json")
+        self.build_cache = os.path.join(path, ".buildcache")  # BuildKit cache shared by all the builds
+        if os.path.abspath(self.odi_config) == state.filename:
+            self.state = state
+        else:
+            state.save()  # only holds the parse cache of infrastructure.yaml
+            self.state = OdiState(self.odi_config)
+        self.migrate_setup_journal()
 
         if not os.path.isdir(path):
             ValueError(f"Path {path} does not exist")
 
         # Check the network
         for net_name, network in conf["networks"].items():
-            net_ips = []
+            net_ips = set()
             self.networks[net_name] = network
             for server_name, server_conf in network.items():
                 self.servers[server_name] = server_conf
@@ -283,13 +358,19 @@ class Infrastructure:
 
                 if server_conf["ip"] in net_ips:
                     raise ValueError(f"Duplicated IP address '{server_conf['ip']}' in network '{net_name}'")
-                net_ips.append(server_conf["ip"])
+                net_ips.add(server_conf["ip"])
+                self.host_network.setdefault(server_name, net_name)
+                self.host_ip.setdefault(server_name, server_conf["ip"])
+                self.host_networks.setdefault(server_name, {})[net_name] = server_conf["ip"]
 
                 if "dns" in server_conf.keys():
                     for dns in server_conf["dns"]:
                         if net_name not in self.dns.keys():
                             self.dns[net_name] = []
                         self.dns[net_name].append(dns)
+                        if dns not in self.dns_networks.keys():
+                            self.dns_networks[dns] = set()
+                        self.dns_networks[dns].add(net_name)
 
         # Process port mappings #
         if conf["port_mappings"]:
@@ -317,11 +398,50 @@ class Infrastructure:
                         "dst_port": dest_port,
                     })
 
+        # Routes from every host to every service, through shared networks or port mappings
+        self.routing = RoutingGraph(self.host_networks, self.mappings)
+
+        # TLS profiles of the proxy servers, by DNS name ('default' applies to all of them)
+        self.tls = conf.get("tls", {})
+        for dns_name, tls in self.tls.items():
+            if dns_name != "default" and dns_name not in self.dns_networks.keys():
+                raise ValueError(f"TLS profile for unknown DNS '{dns_name}'")
+            check_optional_keys(tls, nginx_tls_keys)
+
+        # Logging profiles of the proxy servers, by DNS name ('default' applies to all of them)
+        self.logging = conf.get("logging", {})
+        for dns_name, logging in self.logging.items():
+            if dns_name != "default" and dns_name not in self.dns_networks.keys():
+                raise ValueError(f"Logging profile for unknown DNS '{dns_name}'")
+            check_optional_keys(logging, nginx_logging_keys)
+            nginx_logging_config(logging)  # validate the values
+
         # Process services
         service_dirs = [d for d in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, d))]
         for service_name, service_conf in conf["services"].items():
             check_required_keys(service_conf, {"host": str})
-            check_optional_keys(service_conf, {"host": str, "dns": str, "port": int, "force_ownership": list})
+            check_optional_keys(service_conf, {"host": str, "dns": str, "port": int, "force_ownership": list,
+                                               "depends_on": list, "nginx": dict, "role": str, "weight": int,
+                                               "timescale": dict})
+            if service_conf.get("role", "master") not in ["master", "replica"]:
+                raise ValueError(f"Service '{service_name}' role should be 'master' or 'replica'")
+            if service_conf.get("weight", 1) < 1:
+                raise ValueError(f"Service '{service_name}' weight should be greater than 0")
+            if "nginx" in service_conf.keys():
+                check_optional_keys(service_conf["nginx"], nginx_profile_keys)
+                if "cache" in service_conf["nginx"].keys():
+                    check_optional_keys(service_conf["nginx"]["cache"], nginx_cache_keys)
+            if "timescale" in service_conf.keys():
+                try:
+                    from timescale import timescale_keys, check_timescale_conf
+                except ModuleNotFoundError:
+                    from .timescale import timescale_keys, check_timescale_conf
+                check_optional_keys(service_conf["timescale"], timescale_keys)
+                check_timescale_conf(service_conf["timescale"])
+                # same default role as service_role()
+                if service_conf.get("role", "replica" if "slave" in service_name else "master") == "replica":
+                    raise ValueError(f"Service '{service_name}' is a replica, the 'timescale' configuration must be "
+                                     f"declared in its master")
 
             local_service = False
 
@@ -346,12 +466,18 @@ class Infrastructure:
                     force_ownerships[path] = user
 
             if local_service:
-                s = Service(os.path.join(self.path, service_name), force_ownerships=force_ownerships)
+                s = Service(os.path.join(self.path, service_name), force_ownerships=force_ownerships,
+                            state=self.state)
                 self.dcompose_services[service_name] = s
                 self.odi_services[service_name] = service_conf
             else:
                 pass
             self.all_odi_services[service_name] = service_conf
+            self.service_host[service_name] = service_conf["host"]
+            if "dns" in service_conf.keys():
+                if service_conf["dns"] not in self.dns_services.keys():
+                    self.dns_services[service_conf["dns"]] = []
+                self.dns_services[service_conf["dns"]].append(service_name)
 
 
         # Process SoftLinks
@@ -365,7 +491,13 @@ class Infrastructure:
                     self.soft_links[server] = []
                 self.soft_links[server].append((src, dst))
 
-        # self.docker = docker.from_env()
+        # Resolve the routes from this host to every service, shared by the configuration generators
+        self.routing.precompute([self.hostname], {name: (conf["host"], conf["port"])
+                                                  for name, conf in self.all_odi_services.items() if "port" in conf})
+
+        # Store the parse cache for the next run
+        self.state.prune_parse_cache()
+        self.state.save()
 
     def __repr__(self):
         repr = ""
@@ -385,57 +517,111 @@ class Infrastructure:
         :param target_host:
         :return: tuple (network_name, network_conf)
         """
-        for network_name, network_conf in self.networks.items():
-            for host in network_conf.keys():
-                if host == target_host:
-                    return network_name, network_conf
-        raise LookupError(f"network for {target_host} not found")
+        if target_host not in self.host_network.keys():
+            raise LookupError(f"network for {target_host} not found")
+        network_name = self.host_network[target_host]
+        return network_name, self.networks[network_name]
 
     def ip_from_host(self, target_host):
         """
-        takes a hostname and retunrs it's IP
-        :param name:
-        :return:
+        takes a hostname and retunrs it's IP from the current host point of view. Both hosts must share a network, use
+        route_to_service to reach services in other networks
+        :param target_host: hostname
+        :return: IP address
         """
-        # First get the current network
         assert type(target_host) is str, f"Expected str got {type(target_host)}"
 
-        _, current_network = self.get_host_network(self.hostname)
-
         if target_host == self.hostname:
             # If same machine, use the docker parent IP
-            return "172.17.0.1"
+            return docker_host_ip
 
-        # Now that we have the network, check if current host and target_host are in the same network
-        if target_host in current_network.keys() and self.hostname in current_network.keys():
-            return current_network[target_host]["ip"]
-        else:
+        ip = self.routing.shared_ip(self.hostname, target_host)
+        if not ip:
             rich.print(f"[yellow]Error while trying to resolve '{target_host}' from '{self.hostname}' point of view")
-            raise ValueError("Resolving hosts from different networks not yet implemented!")
+            raise ValueError(f"Hosts '{self.hostname}' and '{target_host}' do not share any network")
+        return ip
+
+    def route_to_service(self, service_name: str, from_host=""):
+        """
+        Resolves how a host reaches a service, directly or through port mappings (routes are memoised)
+        :param service_name: service name
+        :param from_host: source host, defaults to the current host
+        :return: Route (with ip and port) or None if the service is not reachable
+        """
+        service = self.all_odi_services[service_name]
+        if "port" not in service.keys():
+            raise ValueError(f"Service '{service_name}' has no port")
+        return self.routing.route(from_host if from_host else self.hostname, service["host"], service["port"])
+
+    def service_dependencies(self, services: list) -> dict:
+        """
+        Builds the dependency graph between services. Explicit dependencies are declared with the 'depends_on' key
+        in infrastructure.yaml. On top of that, some implicit dependencies are added:
+            - proxies depend on all the other services
+            - SensorThings timeseries services (sta-ts-xxx) depend on its SensorThings service (sta-xxx)
+            - sta-slave depends on sta-master
+        Only dependencies within the services list are taken into account.
+        :param services: list of service names
+        :return: dict with {<service name>: set(<services it depends on>)}
+        """
+        dependencies = {s: set() for s in services}
+        for service in services:
+            conf = self.all_odi_services[service]
+            if "depends_on" in conf.keys():
+                for d in conf["depends_on"]:
+                    if d not in self.all_odi_services.keys():
+                        raise ValueError(f"Service '{service}' depends on unknown service '{d}'")
+                    dependencies[service].add(d)
+
+            if service.startswith("proxy"):
+                dependencies[service].update([s for s in services if not s.startswith("proxy")])
+            elif service.startswith("sta-ts-"):
+                dependencies[service].add(service.replace("sta-ts-", "sta-", 1))
+            elif service.startswith("sta-slave"):
+                dependencies[service].add("sta-master")
+
+        # Discard dependencies with services that have not been selected
+        return {s: deps & set(services) for s, deps in dependencies.items()}
+
+    def port_mappings(self) -> list:
+        """
+        Returns the port mappings of this host, with the destination IP address from this host point of view
+        """
+        mappings = []
+        for m in self.mappings.get(self.hostname, []):
+            mappings.append({"protocol": m["protocol"], "src_port": m["src_port"],
+                             "dst_ip": self.ip_from_host(m["dst_host"]), "dst_port": m["dst_port"]})
+        return mappings
+
+    def port_mappings_applied(self) -> bool:
+        """
+        Checks in the setup journal if any port mapping was applied in this host by a previous setup
+        """
+        entry = self.state.host_section("setup_journal", self.hostname).get("port_mappings")
+        return entry is not None and entry["hash"] != content_hash(json.dumps([]))
 
     def create_port_mappings(self):
         """
-        Creates port mapping in the machine
+        Creates port mapping in the machine. All the rules are applied in a single iptables-restore transaction and
+        only if they differ from the live ones
         """
-        if self.hostname not in self.mappings.keys():
+        mappings = self.port_mappings()
+        if not mappings and not self.port_mappings_applied():
             rich.print(f"[grey42]No mapping for host '{self.hostname}'")
             return None
+        try:
+            from nat import apply_port_mappings
+        except ModuleNotFoundError:
+            from .nat import apply_port_mappings
+        # if all the mappings of the host were removed, the ODI chains are emptied
+        apply_port_mappings(mappings)
 
-        # Check that all
-        for m in self.mappings[self.hostname]:
-            script = os.path.join(self.path, "scripts", "add_nat_rule.sh")
-            dst_ip = self.ip_from_host(m["dst_host"])
-            cmd = f"sudo {script} {m['src_port']} '{dst_ip}' {m['dst_port']} {m['protocol']}"
-            rich.print(f"  calling external iptables handler: {cmd}")
-            # Run script as a subprocess
-            run_subprocess(cmd, allow_fail=False)
-
-    def create_odi_env_file(self):
+    def odi_env_contents(self, verbose=True) -> str:
         """
-        Creates the odi.env file where the ports and IPs are defined
-        :return:
+        Generates the contents of the odi.env file
+        :param verbose: print the services being processed
+        :return: odi.env contents
         """
-        rich.print("Generating odi.env file...")
         lines = [
             f"#!/bin/bash\n",
             f"# ============================================ #\n",
@@ -445,23 +631,24 @@ class Infrastructure:
             f"# ODI Services IPs and ports\n"
         ]
 
-        for service_name, service_conf in self.odi_services.items():
-            try:
-                if service_name.startswith("proxy"):
-                    rich.print(f"[grey42]    skipping proxy service {service_name}'")
-                    continue
-                rich.print(f"    adding service: '{service_name}'")
-                ip = self.ip_from_host(service_conf["host"])
-                port = service_conf["port"]
-                name = service_name.upper().replace("-", "_")
-                lines.append("\n")
-                lines.append(f"# Network config for ODI service {name}\n")
-                lines.append(f"ODI_{name}_IP={ip}\n")
-                lines.append(f"ODI_{name}_PORT={port}\n")
-
-            except ValueError:
-                rich.print(f"[red]Error processing service {service_name}")
+        for service_name, service_conf in self.all_odi_services.items():
+            if service_name.startswith("proxy") or "port" not in service_conf.keys():
+                if verbose:
+                    rich.print(f"[grey42]    skipping service {service_name}'")
                 continue
+            name = service_name.upper().replace("-", "_")
+            route = self.route_to_service(service_name)
+            if not route:
+                if verbose:
+                    rich.print(f"[yellow]    service '{service_name}' not reachable from '{self.hostname}'")
+                lines.append(f"\n# ODI service {name} not reachable from this host\n")
+                continue
+            if verbose:
+                rich.print(f"    adding service: '{service_name}' {route}")
+            lines.append("\n")
+            lines.append(f"# Network config for ODI service {name}\n")
+            lines.append(f"ODI_{name}_IP={route.ip}\n")
+            lines.append(f"ODI_{name}_PORT={route.port}\n")
 
         lines.append(f"\n#ODI Domain Name services\n")
         for service_name, service_conf in self.all_odi_services.items():
@@ -469,22 +656,22 @@ class Infrastructure:
             if "dns" in service_conf.keys():
                 name = service_name.upper().replace("-", "_")
                 lines.append(f"ODI_{name}_DNS={service_conf['dns']}\n")
+        return "".join(lines)
 
+    def create_odi_env_file(self):
+        """
+        Creates the odi.env file where the ports and IPs are defined
+        :return:
+        """
+        rich.print("Generating odi.env file...")
         odi_env_file = os.path.join(self.path, "odi.env")
-        with open(odi_env_file, "w") as f:
-            f.writelines(lines)
-
-        with open(odi_env_file, "w") as f:
-            f.writelines(lines)
+        if write_if_changed(odi_env_file, self.odi_env_contents()):
+            rich.print(f"{odi_env_file} updated")
+        else:
+            rich.print(f"[grey42]{odi_env_file} did not change")
 
         # Now add this to ~/.bashrc
-        odi_env = os.path.join(self.path, "odi.env")
-        secrets_env = os.path.join(self.path, "secrets.env")
-        magic_lines = f"\n\n# Load and export ODI env variables\n"
-        magic_lines += f"export $(grep -v '^#' {odi_env} | xargs -0)\n"
-        magic_lines += f"export $(grep -v '^#' {secrets_env} | xargs -0)\n"
-
-        bash_rc_file = f"/home/{getpass.getuser()}/.bashrc"
+        bash_rc_file, magic_lines = self.bashrc_lines()
         with open(bash_rc_file) as f:
             contents = f.read()
         if magic_lines not in contents:
@@ -492,75 +679,376 @@ class Infrastructure:
             with open(bash_rc_file, "a") as f:
                 f.write(magic_lines)
 
-    def create_nginx_conf(self):
+    def bashrc_lines(self) -> (str, str):
         """
-        Creates the file nginx.conf
-        :return:
+        Returns the user's .bashrc file and the lines that load the ODI env files
+        """
+        odi_env = os.path.join(self.path, "odi.env")
+        secrets_env = os.path.join(self.path, "secrets.env")
+        magic_lines = f"\n\n# Load and export ODI env variables\n"
+        magic_lines += f"export $(grep -v '^#' {odi_env} | xargs -0)\n"
+        magic_lines += f"export $(grep -v '^#' {secrets_env} | xargs -0)\n"
+        bash_rc_file = f"/home/{getpass.getuser()}/.bashrc"
+        return bash_rc_file, magic_lines
+
+    def proxy_instance(self) -> str:
+        """
+        Returns the name of the proxy service running on this machine (empty string if there is none)
         """
         proxy_instance = ""
-        # Get proxy instances that run on this machine
         for service_name, service_conf in self.all_odi_services.items():
             if service_conf["host"] == self.hostname and service_name.startswith("proxy"):
                 proxy_instance = service_name
+        return proxy_instance
 
-        if not proxy_instance:
-            rich.print(f"[grey42]No proxies to be configured for host '{self.hostname}'")
-            return
-
-        rich.print(f"[cyan]Creating nginx config")
+    def nginx_conf_contents(self, verbose=True) -> str:
+        """
+        Generates the contents of the nginx.conf file for the proxy running in this machine
+        :param verbose: print the services being processed
+        :return: nginx.conf contents
+        """
         dns = {
             # Dict where keys are dns names and values are a list of service names
         }
 
-        current_network_name, _ = self.get_host_network(self.hostname)
-        rich.print(f"Current network name: '{current_network_name}' ")
-        for service_name, service_conf in self.all_odi_services.items():
-
-            # Skip all services that are not running on this machine or that do not have a DNS
-            service_host = service_conf["host"]
-            net_name, _ = self.get_host_network(service_host)
-
-            if "dns" in service_conf.keys() and service_conf["dns"] not in self.dns[net_name]:
-                raise ValueError(f"Error in service {service_name}, DNS '{service_conf['dns']}' not declared in"
-                                 f" network '{net_name}'")
-
-            if current_network_name != net_name or "dns" not in service_conf.keys():
-                rich.print(f"[grey42]    skipping {service_name}")
+        current_networks = set(self.host_networks.get(self.hostname, {}).keys())
+        if verbose:
+            rich.print(f"Current networks: {', '.join(sorted(current_networks))}")
+        for dns_name, services in self.dns_services.items():
+            if dns_name not in self.dns_networks.keys():
+                raise ValueError(f"Error in service {services[0]}, DNS '{dns_name}' not declared in any network")
+            # Skip the DNS names that are not served by the networks of this proxy
+            if not self.dns_networks[dns_name] & current_networks:
+                if verbose:
+                    rich.print(f"[grey42]    skipping {', '.join(services)}")
                 continue
 
-            dns_name = service_conf["dns"]
-            if dns_name not in dns.keys():
-                dns[dns_name] = [service_name]
-            else:
-                dns[dns_name].append(service_name)
+            for service_name in services:
+                host = self.service_host[service_name]
+                if service_name.startswith("proxy"):
+                    reachable = host == self.hostname or self.routing.shared_ip(self.hostname, host)
+                else:
+                    reachable = self.route_to_service(service_name) is not None
+                if not reachable:
+                    rich.print(f"[yellow]    service '{service_name}' not reachable from '{self.hostname}', skipping")
+                    continue
+                dns.setdefault(dns_name, []).append(service_name)
 
-        contents = nginx_conf_start
+        upstreams = ""  # upstream blocks and cache zones, declared before the servers
+        servers = ""
+        quic_listener = False  # reuseport can only be set in the first QUIC listener
+        samples = []  # access log sample rates, their variables are declared once
 
         # Then configure the rest of the services
         for dns, services in dns.items():
-            contents += nginx_server_start.format(dns=dns)
+            tls = {**self.tls.get("default", {}), **self.tls.get(dns, {})}
+            reuseport = tls.get("http3", False) and not quic_listener
+            quic_listener = quic_listener or tls.get("http3", False)
+            logging = {**self.logging.get("default", {}), **self.logging.get(dns, {})}
+            sample = logging.get("sample", nginx_logging_defaults["sample"])
+            if sample < 1 and sample not in samples:
+                samples.append(sample)
+                upstreams += nginx_log_sample_config(sample)
+            servers += nginx_server_start.format(dns=dns, tls=nginx_tls_config(tls, reuseport=reuseport),
+                                                 logging=nginx_logging_config(logging))
+            # Services with the same DNS and location (e.g. sta-master and sta-slave) are served by the same location
+            groups = {}
             for service_name in services:
-                service = self.all_odi_services[service_name]
-
                 if service_name.startswith("proxy"):
                     # For the proxy configure only the GoAcess report
-                    service_conf = service_nginx_config("goaccess").format()
+                    groups[service_name] = [service_name]
                 else:
-                    # For the rest of the services specify port and ip
-                    port = service["port"]
-                    hostname = service["host"]
-                    ip = self.ip_from_host(hostname)  # get the IP address from the proxy point of view
-                    service_conf = service_nginx_config(service_name).format(port=port, ip=ip)
-                contents += service_conf
-
-            contents += nginx_server_end  # add finishing block for server
+                    groups.setdefault(service_nginx_config(service_name), []).append(service_name)
+
+            for group in groups.values():
+                if group[0].startswith("proxy"):
+                    servers += service_nginx_config("goaccess").format()
+                    continue
+                group_upstreams, service_conf = self.nginx_group_config(group)
+                upstreams += group_upstreams
+                servers += service_conf
+
+            servers += nginx_server_end  # add finishing block for server
+        contents = nginx_conf_start + upstreams + servers
         contents += nginx_conf_end  # add finishing block for overall configuration file
+        return contents
+
+    def service_role(self, service_name: str) -> str:
+        """
+        Returns the role of a service ('master' or 'replica'). If not declared, services with 'slave' in their name are
+        replicas, e.g. sta-slave
+        """
+        service = self.all_odi_services[service_name]
+        if "role" in service.keys():
+            return service["role"]
+        return "replica" if "slave" in service_name else "master"
+
+    def nginx_group_config(self, group: list) -> (str, str):
+        """
+        Generates the NGINX config for a group of services sharing DNS and location. A single service gets its own
+        upstream. If there are several services, GET/HEAD requests are balanced across masters and replicas while the
+        rest of methods always go to the masters. The profile of the first master is used for the whole group.
+        :param group: list of service names
+        :returns: tuple with (upstreams and cache zones, location config)
+        """
+        masters = [s for s in group if self.service_role(s) == "master"]
+        replicas = [s for s in group if self.service_role(s) == "replica"]
+        if len(group) == 1:
+            masters, replicas = group, []  # a replica with its own DNS name serves all its requests
+        elif not masters:
+            raise ValueError(f"Services {', '.join(group)} share the same location but none of them is a master")
+        service_name = masters[0]
+        service = self.all_odi_services[service_name]
+        profile = service.get("nginx", {})
+        upstream = nginx_upstream_name(service_name)
+
+        def servers(names):
+            # get the IP address from the proxy point of view
+            routes = [self.route_to_service(n) for n in names]
+            return [(r.ip, r.port, self.all_odi_services[n].get("weight", 1)) for n, r in zip(names, routes)]
+
+        if len(group) == 1:
+            upstreams = nginx_upstream_config(upstream, [(ip, port) for ip, port, _ in servers(group)], profile)
+            target = upstream
+        else:
+            upstreams, target = nginx_split_config(upstream, servers(masters), servers(replicas), profile)
+
+        location_conf = nginx_profile_config(profile)
+        if len(group) > 1:
+            # failing servers are counted (and ejected) also on 502/503, idempotent requests are retried
+            location_conf += "\n      proxy_next_upstream error timeout http_502 http_503;"
+        if "cache" in profile.keys():
+            upstreams += nginx_cache_path_config(service_name, profile["cache"])
+            # nested locations also proxy through the method map, so writes still go to the masters
+            location_conf += nginx_cache_config(service_name, target, profile["cache"])
+        service_conf = service_nginx_config(service_name).format(
+            upstream=target, keepalive=keepalive_headers, profile=location_conf)
+        if len(group) > 1:
+            service_conf = nginx_variable_proxy_pass(service_conf, target)
+        return upstreams, service_conf
+
+    def create_nginx_conf(self) -> bool:
+        """
+        Creates the file nginx.conf. If the file already exists, the previous version is kept in nginx.conf.bak
+        :return: True if the file changed
+        """
+        proxy_instance = self.proxy_instance()
+        if not proxy_instance:
+            rich.print(f"[grey42]No proxies to be configured for host '{self.hostname}'")
+            return False
+
+        rich.print(f"[cyan]Creating nginx config")
+        contents = self.nginx_conf_contents()
 
         # now let's create the nginx.conf
         nginx_file = os.path.join(self.path, proxy_instance, "nginx.conf")
-        with open(nginx_file, "w") as f:
-            f.write(contents)
+        if not file_changed(nginx_file, contents):
+            rich.print(f"[grey42]{nginx_file} for proxy {proxy_instance} did not change")
+            return False
+
+        if os.path.exists(nginx_file):
+            with open(nginx_file) as f:
+                write_if_changed(nginx_file + ".bak", f.read())
+        write_if_changed(nginx_file, contents)
         rich.print(f"{nginx_file} for proxy {proxy_instance} created!")
+        return True
+
+    def check_nginx_conf(self, nginx_bin="nginx"):
+        """
+        Renders the nginx.conf for this host and validates it offline with a local nginx binary (nginx -t). The paths
+        of the proxy container are mapped to a temporary folder with self-signed certificates, so neither the proxy
+        container nor the real certificates are needed.
+        :param nginx_bin: nginx binary
+        :raises: ValueError if the configuration is not valid
+        """
+        import re
+        import shutil
+        import tempfile
+        for binary in [nginx_bin, "openssl"]:
+            if not shutil.which(binary):
+                raise ValueError(f"'{binary}' not found, it is required to validate nginx.conf offline")
+
+        contents = self.nginx_conf_contents(verbose=False)
+        with tempfile.TemporaryDirectory() as tmp:
+            ssl_folder = os.path.join(tmp, "ssl_keys")
+            cache_folder = os.path.join(tmp, "cache")
+            log_folder = os.path.join(tmp, "log")
+            os.makedirs(ssl_folder)
+            os.makedirs(cache_folder)
+            os.makedirs(log_folder)
+            contents = contents.replace(nginx_ssl_folder + "/", ssl_folder + "/")
+            contents = contents.replace(nginx_log_folder + "/", log_folder + "/")
+            contents = contents.replace("/var/cache/nginx/odi/", cache_folder + "/")
+            contents = contents.replace("/var/goaccess", tmp)
+
+            certificates = re.findall(r"ssl_certificate (\S+);\s*ssl_certificate_key (\S+);", contents)
+            certificates += [(c, c + ".key") for c in re.findall(r"ssl_trusted_certificate (\S+);", contents)]
+            for cert, key in set(certificates):
+                if not os.path.exists(cert):
+                    run_subprocess(f"openssl req -x509 -newkey rsa:2048 -nodes -days 1 -subj /CN=odi-check "
+                                   f"-keyout {key} -out {cert}", quiet=True)
+
+            nginx_file = os.path.join(tmp, "nginx.conf")
+            with open(nginx_file, "w") as f:
+                f.write(contents)
+            rich.print(f"Validating nginx configuration with '{nginx_bin}'...")
+            if not run_subprocess(f"{nginx_bin} -t -q -p {tmp} -e stderr -c {nginx_file} -g 'pid {tmp}/nginx.pid;'",
+                                  allow_fail=True):
+                raise ValueError("nginx configuration test failed")
+        rich.print("[green]nginx configuration is valid")
+
+    def proxy_container(self) -> str:
+        """
+        Returns the name of the nginx container of the proxy running in this machine
+        """
+        proxy_instance = self.proxy_instance()
+        if not proxy_instance or proxy_instance not in self.dcompose_services.keys():
+            raise LookupError(f"No proxy service running in host '{self.hostname}'")
+        return self.dcompose_services[proxy_instance].containers[0].container_name
+
+    def database_container(self, service_name: str):
+        """
+        Returns the database container of a service (e.g. sta_db_master for sta-master)
+        :raises: ValueError if the service is not deployed in this host or has no database container
+        """
+        if service_name not in self.dcompose_services.keys():
+            raise ValueError(f"Service '{service_name}' not deployed in host '{self.hostname}'")
+        for container in self.dcompose_services[service_name].containers:
+            if "db" in container.container_name.split("_"):
+                return container
+        raise ValueError(f"Service '{service_name}' has no database container")
+
+    def database_psql(self, service_name: str):
+        """
+        Returns a Psql object to run SQL in the database container of a service, with the SensorThings credentials
+        (STA_DB_USER and STA_DB_NAME from secrets.env)
+        """
+        try:
+            from postgres import Psql
+        except ModuleNotFoundError:
+            from .postgres import Psql
+        container = self.database_container(service_name)
+        return Psql(container=container.container_name, user=os.environ.get("STA_DB_USER", ""),
+                    database=os.environ.get("STA_DB_NAME", ""))
+
+    def provision_timescale(self, service_name: str, benchmark=False):
+        """
+        Applies the 'timescale' configuration of a service to its database
+        :param service_name: service with a 'timescale' key in infrastructure.yaml
+        :param benchmark: measure typical queries before and after the provisioning
+        """
+        conf = self.all_odi_services[service_name].get("timescale")
+        if conf is None:
+            raise ValueError(f"Service '{service_name}' has no 'timescale' configuration in infrastructure.yaml")
+        if self.service_role(service_name) == "replica":
+            raise ValueError(f"Service '{service_name}' is a replica, TimescaleDB must be provisioned in the master")
+        try:
+            from timescale import provision_timescale, benchmark_queries, print_benchmark
+        except ModuleNotFoundError:
+            from .timescale import provision_timescale, benchmark_queries, print_benchmark
+        psql = self.database_psql(service_name)
+        rich.print(f"Provisioning TimescaleDB for service '{service_name}'")
+        before = benchmark_queries(psql) if benchmark else {}
+        provision_timescale(psql, conf)
+        if benchmark:
+            print_benchmark(before, benchmark_queries(psql, aggregates="hourly" in conf.get("aggregates", ["hourly"])))
+
+    def advise_indexes(self, service_name: str, apply=False):
+        """
+        Ranks the slowest statements of the database of a service and proposes indexes for them. Indexes created by
+        ODI are tracked in the ODI state to report the latency change of their statements.
+        :param service_name: SensorThings service (e.g. sta-master)
+        :param apply: create the proposed indexes (master databases only, replicas get them through replication)
+        """
+        if apply and self.service_role(service_name) == "replica":
+            raise ValueError(f"Service '{service_name}' is a replica, indexes must be created in the master")
+        try:
+            from advisor import check_pg_stat_statements, top_statements, advise, print_statements, print_advice, \
+                apply_advice, report_latency
+        except ModuleNotFoundError:
+            from .advisor import check_pg_stat_statements, top_statements, advise, print_statements, print_advice, \
+                apply_advice, report_latency
+        psql = self.database_psql(service_name)
+        check_pg_stat_statements(psql)
+        statements = top_statements(psql)
+        rich.print(f"Top statements of '{service_name}' by total execution time:")
+        print_statements(statements)
+        advices = advise(psql, statements)
+        print_advice(advices)
+        state = self.state.section("db_advise").setdefault(service_name, {})
+        if apply and advices:
+            apply_advice(psql, advices, state)
+            self.state.touch()
+            self.state.save()
+        elif advices:
+            rich.print("\nRun with --apply to create them")
+        report_latency(psql, state)
+
+    def proxy_running(self) -> bool:
+        """
+        Checks if the proxy container is running
+        """
+        try:
+            return docker_index().container(self.proxy_container()).status == "running"
+        except Exception:
+            return False
+
+    def reload_proxy(self):
+        """
+        Validates the nginx.conf file within the running proxy container (nginx -t) and then sends a graceful reload
+        (nginx -s reload), so in-flight connections are not dropped. If the validation fails, the previous nginx.conf
+        is restored.
+        :raises: ValueError if the configuration is not valid
+        """
+        container = self.proxy_container()
+        nginx_file = os.path.join(self.path, self.proxy_instance(), "nginx.conf")
+        rich.print(f"Validating nginx configuration in container '{container}'...")
+        exit_code, output = container_exec(container, "nginx -t")
+        if exit_code != 0:
+            rich.print(f"[red]Invalid nginx configuration:\n{output.decode(errors='replace')}")
+            backup = nginx_file + ".bak"
+            if os.path.exists(backup):
+                rich.print(f"[yellow]Rolling back to previous configuration {backup}")
+                with open(backup) as f:
+                    write_if_changed(nginx_file, f.read())
+            raise ValueError("nginx configuration test failed, proxy not reloaded")
+
+        exit_code, output = container_exec(container, "nginx -s reload")
+        if exit_code != 0:
+            raise ValueError(f"nginx reload failed: {output.decode(errors='replace')}")
+        rich.print(f"[green]Proxy '{container}' reloaded")
+
+    def update_proxy(self):
+        """
+        Generates the nginx.conf file and reloads the proxy (only if its contents changed and the proxy is running)
+        """
+        if self.create_nginx_conf() and self.proxy_running():
+            self.reload_proxy()
+
+    def proxy_log_folder(self) -> str:
+        """
+        Returns the folder where the proxy of this host writes its logs
+        """
+        return os.path.join(self.path, self.proxy_instance(), "volumes", "log")
+
+    def rotate_proxy_logs(self):
+        """
+        Rotates the proxy logs bigger than the 'rotate_size' of the default logging profile and tells nginx to reopen
+        its log files (otherwise it would keep writing into the rotated ones)
+        """
+        try:
+            from logrotate import pending_rotations, rotate_log
+        except ModuleNotFoundError:
+            from .logrotate import pending_rotations, rotate_log
+        logging = {**nginx_logging_defaults, **self.logging.get("default", {})}
+        rotated = pending_rotations(self.proxy_log_folder(), logging["rotate_size"])
+        for filename in rotated:
+            rich.print(f"Rotating {filename}")
+            rotate_log(filename, logging["rotate_keep"])
+        if rotated and self.proxy_running():
+            exit_code, output = container_exec(self.proxy_container(), "nginx -s reopen")
+            if exit_code != 0:
+                raise ValueError(f"nginx reopen failed: {output.decode(errors='replace')}")
 
     def create_soft_links(self):
         """
@@ -587,19 +1075,216 @@ class Infrastructure:
             else:
                 rich.print(f"[grey42]    link {alias}->{dst} already exists")
 
-    def setup(self):
-        rich.print("Setting up Infrastructure:")
-        self.create_port_mappings()
-        self.create_odi_env_file()
-        self.create_nginx_conf()
-
-        rich.print("Setting up Services:")
-        for s in self.dcompose_services.values():
-            s.setup()
+    def pending_soft_links(self) -> list:
+        """
+        Returns the list of soft links (src, dst) that have not been created yet
+        """
+        links = []
+        for src, dst in self.soft_links.get(self.hostname, []):
+            if not os.path.exists(src):
+                links.append((src, dst))
+        for alias, dst in self.service_alias.items():
+            alias = os.path.join(self.path, alias)
+            if not os.path.exists(alias):
+                links.append((alias, os.path.join(self.path, dst)))
+        return links
 
-        self.create_soft_links()
+    def setup_steps(self) -> list:
+        """
+        Computes the setup steps for this host, comparing the desired state with the current one. Generated files are
+        compared by content hash, steps that cannot be compared against the system (e.g. NAT rules or ownerships) are
+        compared against the inputs hash stored in the setup journal.
+        :return: list of SetupStep
+        """
+        journal = self.state.host_section("setup_journal", self.hostname)
+
+        def journal_changed(name, inputs):
+            return name not in journal.keys() or journal[name]["hash"] != content_hash(inputs)
+
+        steps = []
+
+        # NAT rules
+        rules = [f"{m['protocol']}:{m['src_port']}:{m['dst_ip']}:{m['dst_port']}" for m in self.port_mappings()]
+        inputs = json.dumps(rules)
+        changes = []
+        if (rules or self.port_mappings_applied()) and journal_changed("port_mappings", inputs):
+            changes = [f"NAT rule {r}" for r in rules]
+        steps.append(SetupStep("port_mappings", inputs, changes, self.create_port_mappings))
+
+        # odi.env file
+        contents = self.odi_env_contents(verbose=False)
+        changes = []
+        if file_changed(os.path.join(self.path, "odi.env"), contents):
+            changes.append(f"update {os.path.join(self.path, 'odi.env')}")
+        bash_rc_file, magic_lines = self.bashrc_lines()
+        if not os.path.exists(bash_rc_file) or magic_lines not in open(bash_rc_file).read():
+            changes.append(f"load ODI env files in {bash_rc_file}")
+        steps.append(SetupStep("odi_env", contents, changes, self.create_odi_env_file))
+
+        # nginx.conf file
+        proxy_instance = self.proxy_instance()
+        if proxy_instance:
+            contents = self.nginx_conf_contents(verbose=False)
+            nginx_file = os.path.join(self.path, proxy_instance, "nginx.conf")
+            changes = [f"update {nginx_file}"] if file_changed(nginx_file, contents) else []
+            steps.append(SetupStep("nginx_conf", contents, changes, self.update_proxy))
+
+            # proxy logs rotation
+            try:
+                from logrotate import pending_rotations
+            except ModuleNotFoundError:
+                from .logrotate import pending_rotations
+            logging = {**nginx_logging_defaults, **self.logging.get("default", {})}
+            rotations = pending_rotations(self.proxy_log_folder(), logging["rotate_size"])
+            changes = [f"rotate {f} ({os.path.getsize(f) / 2**20:.1f} MB)" for f in rotations]
+            steps.append(SetupStep("proxy_logs", json.dumps(rotations), changes, self.rotate_proxy_logs))
+
+        # Services (networks, volumes and ownerships)
+        for name, service in self.dcompose_services.items():
+            inputs = json.dumps({
+                "networks": service.networks,
+                "volumes": [v.source for c in service.containers for v in c.volumes if v.odi_managed],
+                "ownerships": service.force_ownerships
+            })
+            changes = service.plan()
+            if service.force_ownerships and journal_changed(f"service:{name}", inputs):
+                changes += [f"force ownership of {path} to {user}" for path, user in service.force_ownerships.items()]
+            steps.append(SetupStep(f"service:{name}", inputs, changes, service.setup))
+
+        # TimescaleDB provisioning, only possible while the database is running
+        for name, service in self.dcompose_services.items():
+            conf = self.all_odi_services.get(name, {}).get("timescale")
+            if conf is None:
+                continue
+            inputs = json.dumps(conf, sort_keys=True)
+            try:
+                container = self.database_container(name).container_name
+                running = docker_index().container(container).status == "running"
+            except Exception:
+                running = False
+            if not running:
+                # not added, so it is not recorded in the journal and the next apply will provision it
+                if journal_changed(f"timescale:{name}", inputs):
+                    rich.print(f"[yellow]TimescaleDB for '{name}' will be provisioned once its database is running")
+                continue
+            changes = []
+            if journal_changed(f"timescale:{name}", inputs):
+                changes.append(f"provision TimescaleDB in {container}")
+            steps.append(SetupStep(f"timescale:{name}", inputs, changes,
+                                   lambda name=name: self.provision_timescale(name)))
+
+        # Soft links
+        links = self.pending_soft_links()
+        inputs = json.dumps(self.soft_links.get(self.hostname, []) + list(self.service_alias.items()))
+        changes = [f"create link {src}->{dst}" for src, dst in links]
+        steps.append(SetupStep("soft_links", inputs, changes, self.create_soft_links))
+        return steps
+
+    def plan(self) -> list:
+        """
+        Shows the differences between the desired and the current state of this host
+        :return: list of steps with changes
+        """
+        steps = [s for s in self.setup_steps() if s.changes]
+        if not steps:
+            rich.print(f"[green]Host '{self.hostname}' is up to date, nothing to do")
+        for step in steps:
+            rich.print(f"[cyan]{step.name}")
+            for change in step.changes:
+                rich.print(f"    [yellow]~ {change}")
+        return steps
+
+    def apply(self, force=False, resume=False):
+        """
+        Runs the setup steps whose inputs changed. Every step is recorded in the setup journal (.stat.json) with its
+        inputs hash, outcome and duration, right after it finishes
+        :param force: run all steps, even if nothing changed
+        :param resume: skip the steps already completed by the last setup run, if it did not finish
+        """
+        journal = self.state.host_section("setup_journal", self.hostname)
+        run = self.state.host_section("setup_run", self.hostname)
+        if resume and run.get("finished", True):
+            rich.print("[grey42]No interrupted setup found, nothing to resume")
+            resume = False
+        if not resume:
+            run.update({"started": datetime.now().isoformat(), "finished": False})
+            self.state.touch()
+            self.state.save()
+
+        for step in self.setup_steps():
+            entry = journal.get(step.name, {})
+            if resume and entry.get("status") == "ok" and entry["hash"] == step.inputs_hash and \
+                    entry["date"] >= run["started"]:
+                rich.print(f"[grey42]{step.name} already completed, skipping")
+                continue
+            if not step.changes and not force:
+                rich.print(f"[grey42]{step.name} up to date, skipping")
+                continue
 
+            init = time.time()
+            try:
+                step.run()
+                journal[step.name] = {"hash": step.inputs_hash, "date": datetime.now().isoformat(), "status": "ok",
+                                      "elapsed": round(time.time() - init, 3)}
+            except BaseException as e:  # also record interrupted steps (e.g. ctrl+c on a sudo prompt)
+                journal[step.name] = {"hash": entry.get("hash", ""), "date": datetime.now().isoformat(),
+                                      "status": "failed", "elapsed": round(time.time() - init, 3),
+                                      "error": str(e) if str(e) else type(e).__name__}
+                raise
+            finally:
+                self.state.touch()
+                self.state.save()
+
+        run["finished"] = True
+        run["finished_date"] = datetime.now().isoformat()
+        self.state.touch()
+        self.state.save()
+
+    def setup(self, resume=False):
+        """
+        Runs all the setup steps
+        :param resume: continue an interrupted setup, skipping the steps already completed
+        """
+        rich.print("Setting up Infrastructure:")
+        self.apply(force=True, resume=resume)
 
+    def migrate_setup_journal(self):
+        """
+        Setup journals written before they were keyed by host belong to the current host
+        """
+        journal = self.state.data.get("setup_journal", {})
+        if any(isinstance(entry, dict) and "hash" in entry.keys() for entry in journal.values()):
+            self.state.data["setup_journal"] = {self.hostname: journal}
+            self.state.touch()
+        run = self.state.data.get("setup_run", {})
+        if "started" in run.keys():
+            self.state.data["setup_run"] = {self.hostname: run}
+            self.state.touch()
+
+    def print_setup_timings(self):
+        """
+        Prints the outcome and duration of each setup step recorded in the journal
+        """
+        journal = self.state.host_section("setup_journal", self.hostname)
+        run = self.state.host_section("setup_run", self.hostname)
+        if not journal:
+            rich.print(f"[grey42]No setup recorded for host '{self.hostname}'")
+            return
+        if run:
+            status = "finished" if run.get("finished") else "[yellow]interrupted[/yellow]"
+            rich.print(f"Last setup started {run['started']} ({status})")
+        colors = {"ok": "green", "failed": "red"}
+        width = max([len(name) for name in journal.keys()] + [4])
+        rich.print(f"\n{'step':<{width}}  {'status':<8}  {'time':>9}  date")
+        for name, entry in journal.items():
+            status = entry.get("status", "ok")  # entries recorded before timings were stored
+            elapsed = f"{entry['elapsed']:.2f} s" if "elapsed" in entry.keys() else "-"
+            rich.print(f"{name:<{width}}  [{colors[status]}]{status:<8}[/{colors[status]}]  {elapsed:>9}  "
+                       f"{entry['date'][:19]}")
+            if status == "failed":
+                rich.print(f"{'':<{width}}  [red]{entry.get('error', '')}")
+        total = sum([e.get("elapsed", 0) for e in journal.values()])
+        rich.print(f"{'total':<{width}}  {'':<8}  {total:>7.2f} s")
 
     def setup_service(self, service):
         """
@@ -623,7 +1308,7 @@ class Infrastructure:
         :param service:
         :return:
         """
-        self.dcompose_services[service].build()
+        self.dcompose_services[service].build(self.build_cache)
 
     def remove(self, service_name):
         service = self.dcompose_services[service_name]
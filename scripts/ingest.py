@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Bulk loads observations into the SensorThings database (FROST schema) with parallel COPY transactions. The input
+(CSV or Parquet) is streamed into chunk files in the COPY staging folder, each chunk is loaded in its own transaction
+and recorded as a checkpoint, so an interrupted ingestion continues where it stopped.
+
+Input columns:
+    datastream: datastream name or ID
+    phenomenon_time: ISO 8601 timestamp
+    result: numeric or string result
+    result_time (optional): ISO 8601 timestamp
+    result_quality (optional): JSON string
+    feature_id (optional): FeatureOfInterest ID, defaults to the one of the last observation of the datastream
+
+license: MIT
+"""
+import os
+import csv
+import gzip
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import rich
+
+try:
+    from utils import content_hash
+    from postgres import sql_array
+except ModuleNotFoundError:
+    from .utils import content_hash
+    from .postgres import sql_array
+
+# Folder mounted in the database container to perform SQL COPY transactions (see sta-master/docker-compose.yaml)
+ingest_staging = "/tmp/sta_db_copy/data"
+
+observations_table = '"OBSERVATIONS"'
+observation_columns = ["PHENOMENON_TIME_START", "PHENOMENON_TIME_END", "RESULT_TIME", "RESULT_TYPE", "RESULT_NUMBER",
+                       "RESULT_STRING", "RESULT_QUALITY", "DATASTREAM_ID", "FEATURE_ID"]
+
+# FROST result types
+result_type_number = 0
+result_type_string = 3
+
+
+def read_csv(filename: str):
+    """
+    Yields the rows of a CSV file (with header) as dicts, gzip-compressed files (.gz) are also accepted
+    """
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rt", newline="") as f:
+        yield from csv.DictReader(f)
+
+
+def read_parquet(filename: str, batch_size=65536):
+    """
+    Yields the rows of a Parquet file as dicts, reading one batch at a time
+    """
+    try:
+        import pyarrow.parquet as pq
+    except ModuleNotFoundError:
+        raise ValueError("Parquet input requires pyarrow, install it with 'pip install pyarrow'")
+    for batch in pq.ParquetFile(filename).iter_batches(batch_size=batch_size):
+        yield from batch.to_pylist()
+
+
+def read_rows(filename: str):
+    if filename.endswith(".parquet") or filename.endswith(".pq"):
+        return read_parquet(filename)
+    return read_csv(filename)
+
+
+def chunked(rows, size: int):
+    """
+    Groups an iterable into lists of 'size' elements
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class DatastreamResolver:
+    def __init__(self, psql):
+        """
+        Resolves datastream names into IDs (and their default FeatureOfInterest) with one query per batch of unknown
+        names, results are kept for the whole ingestion
+        :param psql: Psql object
+        """
+        self.psql = psql
+        self.ids = {}  # key datastream name or ID (str), value ID (int)
+        self.features = {}  # key datastream ID, value FeatureOfInterest ID of its last observation
+
+    def resolve(self, datastreams: set):
+        """
+        Resolves the datastreams not seen yet
+        :raises: ValueError if a datastream does not exist
+        """
+        unknown = {str(d) for d in datastreams} - self.ids.keys()
+        if not unknown:
+            return
+        ids = [d for d in unknown if d.isdigit()]
+        names = [d for d in unknown if not d.isdigit()]
+        found = {}
+        if names:
+            rows = self.psql.query(f'SELECT "NAME", "ID" FROM "DATASTREAMS" WHERE "NAME" = ANY({sql_array(names)});')
+            found.update({name: int(ds_id) for name, ds_id in rows})
+        if ids:
+            rows = self.psql.query(f'SELECT "ID" FROM "DATASTREAMS" WHERE "ID" = ANY({sql_array(ids)}::bigint[]);')
+            found.update({ds_id: int(ds_id) for ds_id, in rows})
+        missing = sorted(unknown - found.keys())
+        if missing:
+            raise ValueError(f"{len(missing)} datastreams not found: {', '.join(missing[:10])}")
+        self.ids.update(found)
+
+        new_ids = sorted(set(found.values()) - self.features.keys())
+        rows = self.psql.query(
+            f'SELECT DISTINCT ON ("DATASTREAM_ID") "DATASTREAM_ID", "FEATURE_ID" FROM {observations_table} '
+            f'WHERE "DATASTREAM_ID" = ANY({sql_array(new_ids)}::bigint[]) '
+            f'ORDER BY "DATASTREAM_ID", "PHENOMENON_TIME_START" DESC;')
+        self.features.update({int(ds_id): int(feature_id) for ds_id, feature_id in rows})
+
+    def observation(self, row: dict) -> list:
+        """
+        Converts an input row into the values of the observation_columns
+        """
+        ds_id = self.ids[str(row["datastream"])]
+        feature_id = row.get("feature_id") or self.features.get(ds_id)
+        if not feature_id:
+            raise ValueError(f"Datastream {row['datastream']} has no observations, feature_id column required")
+        timestamp = row["phenomenon_time"]
+        if hasattr(timestamp, "isoformat"):  # Parquet timestamps
+            timestamp = timestamp.isoformat()
+        result_time = row.get("result_time") or None
+        if hasattr(result_time, "isoformat"):
+            result_time = result_time.isoformat()
+        result = row["result"]
+        try:
+            number = float(result)
+            result_type = result_type_number
+        except (TypeError, ValueError):
+            number = None
+            result_type = result_type_string
+        # FROST also stores numeric results as strings
+        return [timestamp, timestamp, result_time, result_type, number, str(result), row.get("result_quality") or None,
+                ds_id, feature_id]
+
+
+def write_chunk(filename: str, rows: list):
+    """
+    Writes a chunk in CSV format (without header), None values are written as NULLs
+    """
+    with open(filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerows([["" if v is None else v for v in row] for row in rows])
+    os.chmod(filename, 0o644)  # readable by the database server
+
+
+def ingest_file(filename: str, psql, state, staging: str, staging_db: str, chunk_rows=100000, jobs=4):
+    """
+    Loads a file into the OBSERVATIONS table with parallel COPY transactions. Completed chunks are recorded in the
+    'ingest' section of the ODI state, so the ingestion can be resumed
+    :param filename: CSV or Parquet file
+    :param psql: Psql object
+    :param state: OdiState object
+    :param staging: folder where the chunks are written
+    :param staging_db: same folder as seen by the database server
+    :param chunk_rows: rows per chunk (and transaction)
+    :param jobs: COPY transactions running at the same time
+    :returns: number of rows loaded
+    """
+    st = os.stat(filename)
+    key = content_hash(f"{os.path.abspath(filename)}:{st.st_size}:{st.st_mtime}")[:16]
+    checkpoint = state.section("ingest").setdefault(key, {"file": os.path.abspath(filename), "chunk_rows": chunk_rows,
+                                                          "done": [], "rows": 0, "finished": False})
+    if checkpoint["finished"]:
+        rich.print(f"[grey42]{filename} already ingested ({checkpoint['rows']} rows), skipping")
+        return 0
+    if checkpoint["chunk_rows"] != chunk_rows:
+        rich.print(f"[yellow]Resuming {filename} with its original chunk size {checkpoint['chunk_rows']}")
+        chunk_rows = checkpoint["chunk_rows"]
+    done = set(checkpoint["done"])
+    if done:
+        rich.print(f"Resuming {filename}, {len(done)} chunks already loaded")
+
+    os.makedirs(staging, exist_ok=True)
+    resolver = DatastreamResolver(psql)
+    init = time.time()
+    loaded = 0
+
+    def copy_chunk(index, rows):
+        name = f"{key}_{index:06d}.csv"
+        write_chunk(os.path.join(staging, name), rows)
+        try:
+            psql.copy_from(observations_table, observation_columns, os.path.join(staging_db, name))
+        finally:
+            os.remove(os.path.join(staging, name))
+        return index, len(rows)
+
+    def completed(futures):
+        """
+        Records the chunks loaded, then raises the first COPY error (if any)
+        """
+        nonlocal loaded
+        errors = []
+        for future in futures:
+            if future.cancelled():
+                continue
+            if future.exception():
+                errors.append(future.exception())
+                continue
+            index, count = future.result()
+            with state.lock:
+                checkpoint["done"].append(index)
+                checkpoint["rows"] += count
+                state.touch()
+                state.save()
+            loaded += count
+            elapsed = time.time() - init
+            rich.print(f"    chunk {index}: {loaded} rows loaded, {loaded / elapsed:.0f} rows/s")
+        if errors:
+            raise errors[0]
+
+    pending = set()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        try:
+            for index, chunk in enumerate(chunked(read_rows(filename), chunk_rows)):
+                if index in done:
+                    continue
+                resolver.resolve({row["datastream"] for row in chunk})
+                rows = [resolver.observation(row) for row in chunk]
+                # bounded number of chunks in the staging folder
+                while len(pending) >= 2 * jobs:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    completed(finished)
+                pending.add(executor.submit(copy_chunk, index, rows))
+            finished, pending = wait(pending)
+            completed(finished)
+        except BaseException:
+            # COPY transactions already running may still commit, wait for them to record their checkpoints
+            for future in pending:
+                future.cancel()
+            completed_ok = wait(pending).done
+            try:
+                completed(completed_ok)
+            except Exception:
+                pass  # the original error is raised
+            raise
+
+    checkpoint.update({"finished": True, "done": []})
+    state.touch()
+    state.save()
+    elapsed = time.time() - init
+    rich.print(f"[green]{filename}: {loaded} rows in {elapsed:.1f} s ({loaded / max(elapsed, 1e-6):.0f} rows/s)")
+    return loaded
+
+
+def ingest_files(files: list, psql, state, staging: str, staging_db: str, chunk_rows=100000, jobs=4):
+    """
+    Loads several files one after the other (the chunks of each file are loaded in parallel)
+    """
+    init = time.time()
+    total = 0
+    for filename in files:
+        if not os.path.exists(filename):
+            raise ValueError(f"Input file '{filename}' not found")
+        total += ingest_file(filename, psql, state, staging, staging_db, chunk_rows=chunk_rows, jobs=jobs)
+    elapsed = time.time() - init
+    rich.print(f"Ingested {total} rows from {len(files)} files in {elapsed:.1f} s "
+               f"({total / max(elapsed, 1e-6):.0f} rows/s)")
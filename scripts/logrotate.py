@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Rotates the proxy logs during the setup: logs bigger than a size are renamed to <log>.1 and older copies are shifted
+and compressed (<log>.2.gz ...). The first rotated copy stays uncompressed and keeps its inode, so 'odi analytics'
+can finish reading it. nginx is then asked to reopen its logs.
+
+license: MIT
+"""
+import os
+import re
+import gzip
+import shutil
+
+proxy_logs = ["access.log", "odi_access.log", "error.log"]
+
+
+def parse_size(size: str) -> int:
+    """
+    Parses an nginx-like size, e.g. "512k", "100m" or "1g"
+    """
+    match = re.fullmatch(r"(\d+)([kmg]?)", str(size).strip().lower())
+    if not match:
+        raise ValueError(f"Invalid size '{size}', expected e.g. '512k', '100m' or '1g'")
+    return int(match.group(1)) * {"": 1, "k": 2**10, "m": 2**20, "g": 2**30}[match.group(2)]
+
+
+def pending_rotations(folder: str, max_size: str) -> list:
+    """
+    Returns the logs in the folder bigger than max_size
+    """
+    limit = parse_size(max_size)
+    files = [os.path.join(folder, f) for f in proxy_logs]
+    return [f for f in files if os.path.exists(f) and os.path.getsize(f) > limit]
+
+
+def is_gzip(filename: str) -> bool:
+    """
+    Checks if a file starts with a gzip member (nginx access_log with gzip=N)
+    """
+    with open(filename, "rb") as f:
+        return f.read(2) == b"\x1f\x8b"
+
+
+def rotated_name(filename: str, n: int) -> str:
+    return f"{filename}.1" if n == 1 else f"{filename}.{n}.gz"
+
+
+def rotate_log(filename: str, keep: int):
+    """
+    Rotates a log: <log>.1 is compressed into <log>.2.gz, <log>.2.gz is renamed to <log>.3.gz and so on, and <log> is
+    renamed to <log>.1. Only 'keep' rotated copies are kept.
+    """
+    oldest = rotated_name(filename, keep)
+    if os.path.exists(oldest):
+        os.remove(oldest)
+    for n in range(keep - 1, 1, -1):
+        if os.path.exists(rotated_name(filename, n)):
+            os.rename(rotated_name(filename, n), rotated_name(filename, n + 1))
+    first = rotated_name(filename, 1)
+    if os.path.exists(first):
+        if keep > 1 and is_gzip(first):
+            os.rename(first, rotated_name(filename, 2))  # written by nginx with gzip=N, already compressed
+        elif keep > 1:
+            with open(first, "rb") as src, gzip.open(rotated_name(filename, 2), "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        if os.path.exists(first):
+            os.remove(first)
+    if keep > 0:
+        os.rename(filename, first)
+    else:
+        os.remove(filename)
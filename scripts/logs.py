@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Streams the logs of several containers at the same time through the docker API. Every container is read by its own
+thread, lines are filtered as they arrive and merged by timestamp (k-way merge). Queues are bounded, so the memory
+used does not depend on the size of the logs.
+
+license: MIT
+"""
+import re
+import sys
+import time
+import heapq
+import queue
+import threading
+from datetime import datetime
+import rich
+
+try:
+    from utils import docker_client
+except ModuleNotFoundError:
+    from .utils import docker_client
+
+_end = None  # sentinel put in the queue when a stream finishes
+
+
+def parse_since(since: str) -> int | datetime | None:
+    """
+    Parses the --since option, a relative time (e.g. "30s", "10m", "2h", "1d") or an ISO date
+    """
+    if not since:
+        return None
+    match = re.fullmatch(r"(\d+)([smhd])", since)
+    if match:
+        seconds = int(match.group(1)) * {"s": 1, "m": 60, "h": 3600, "d": 86400}[match.group(2)]
+        return int(time.time()) - seconds
+    try:
+        return datetime.fromisoformat(since)
+    except ValueError:
+        raise ValueError(f"Invalid since '{since}', expected e.g. '10m', '2h' or '2024-05-01T10:00:00'")
+
+
+def sort_key(timestamp: str) -> str:
+    """
+    Docker timestamps (RFC3339Nano) trim the trailing zeros of the fraction, pad it so they can be compared as strings
+    """
+    date, _, fraction = timestamp.rstrip("Z").partition(".")
+    return date + "." + fraction.ljust(9, "0")
+
+
+class LogReader(threading.Thread):
+    def __init__(self, name: str, container: str, options: dict, grep, notify: threading.Condition, maxsize=1000):
+        """
+        Reads the logs of a container into a bounded queue. Each element of the queue is a tuple with
+        (sort key, timestamp, line)
+        :param name: name displayed as prefix
+        :param container: container name
+        :param options: docker logs options (since, tail, follow)
+        :param grep: compiled regex, only matching lines are kept (None keeps all lines)
+        :param notify: condition notified every time a line is queued
+        :param maxsize: max number of lines waiting in the queue
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.name = name
+        self.container = container
+        self.options = options
+        self.grep = grep
+        self.notify = notify
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.stream = None
+        self.error = ""
+
+    def put(self, item):
+        self.queue.put(item)
+        with self.notify:
+            self.notify.notify()
+
+    def run(self):
+        try:
+            self.stream = docker_client().api.logs(self.container, stream=True, timestamps=True, **self.options)
+            pending = b""
+            for chunk in self.stream:
+                lines = (pending + chunk).split(b"\n")
+                pending = lines.pop()  # incomplete line, wait for the next chunk
+                for raw in lines:
+                    timestamp, _, line = raw.decode(errors="replace").rstrip("\r").partition(" ")
+                    if self.grep and not self.grep.search(line):
+                        continue
+                    self.put((sort_key(timestamp), timestamp, line))
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            self.put(_end)
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+
+
+def merge_logs(readers: list, follow=False, lag=1.0):
+    """
+    Merges the lines of several readers ordered by timestamp. Holds at most one line per reader. When following, a
+    reader may stay silent forever, so lines waiting for more than 'lag' seconds are emitted anyway.
+    :param readers: list of LogReader (already started)
+    :param follow: streams do not end
+    :param lag: max seconds that a line waits for silent readers
+    :returns: generator of (reader name, timestamp, line)
+    """
+    heap = []  # (sort key, arrival, reader index, timestamp, line)
+    waiting = set(range(len(readers)))  # readers without a line in the heap
+    notify = readers[0].notify if readers else threading.Condition()
+    while waiting or heap:
+        for i in list(waiting):
+            try:
+                # when not following, all streams end, so the exact merge can block
+                item = readers[i].queue.get(block=not follow)
+            except queue.Empty:
+                continue
+            waiting.remove(i)
+            if item is not _end:
+                heapq.heappush(heap, (item[0], time.monotonic(), i, item[1], item[2]))
+            elif readers[i].error:
+                rich.print(f"[red]ERROR reading logs from {readers[i].container}: {readers[i].error}")
+
+        if heap and (not waiting or time.monotonic() - heap[0][1] > lag):
+            key, _, i, timestamp, line = heapq.heappop(heap)
+            waiting.add(i)
+            yield readers[i].name, timestamp, line
+        elif waiting:
+            with notify:
+                notify.wait(timeout=lag / 4)
+
+
+def stream_logs(containers: dict, since="", tail: int | str = 100, follow=False, grep=""):
+    """
+    Prints the logs of several containers, merged by timestamp
+    :param containers: dict with {<container name>: <prefix>}
+    :param since: show logs since a relative time (e.g. "10m") or ISO date
+    :param tail: number of lines from the end of the logs of each container ("all" for the whole log)
+    :param follow: keep streaming new lines
+    :param grep: regular expression, only matching lines are shown
+    """
+    options = {"follow": follow, "tail": tail}  # validated by the --tail argument type
+    if since:
+        options["since"] = parse_since(since)
+    regex = re.compile(grep) if grep else None
+    notify = threading.Condition()
+    readers = [LogReader(prefix, name, options, regex, notify) for name, prefix in containers.items()]
+    for r in readers:
+        r.start()
+
+    width = max([len(r.name) for r in readers] + [1])
+    out = sys.stdout
+    try:
+        for name, timestamp, line in merge_logs(readers, follow=follow):
+            out.write(f"{name:<{width}} {sort_key(timestamp)[11:23]} | {line}\n")
+            if follow:
+                out.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for r in readers:
+            r.close()
+        out.flush()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Programs the port mappings (NAT rules) of a host. All the rules are kept in dedicated ODI chains, which are rendered
+at once, compared with the live tables (iptables-save) and only applied if they changed, in a single atomic
+iptables-restore transaction.
+
+license: MIT
+"""
+import subprocess
+import rich
+
+# ODI chains, key table, value list of (ODI chain, builtin or docker chain that jumps to it)
+odi_chains = {
+    "nat": [("ODI-PREROUTING", "PREROUTING"), ("ODI-POSTROUTING", "POSTROUTING")],
+    "filter": [("ODI-DOCKER-USER", "DOCKER-USER")]
+}
+
+
+def nat_rules(mappings: list) -> dict:
+    """
+    Compiles the port mappings into iptables rules, in the same form as they are listed by iptables-save
+    :param mappings: list of dicts with protocol, src_port, dst_ip and dst_port
+    :returns: dict with {<chain>: [rules]}
+    """
+    rules = {chain: [] for chains in odi_chains.values() for chain, _ in chains}
+    # replies of the forwarded connections
+    rules["ODI-DOCKER-USER"].append("-A ODI-DOCKER-USER -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT")
+    for m in mappings:
+        p = m["protocol"]
+        rules["ODI-PREROUTING"].append(f"-A ODI-PREROUTING -p {p} -m {p} --dport {m['src_port']} -j DNAT "
+                                       f"--to-destination {m['dst_ip']}:{m['dst_port']}")
+        rules["ODI-POSTROUTING"].append(f"-A ODI-POSTROUTING -d {m['dst_ip']}/32 -p {p} -m {p} "
+                                        f"--dport {m['dst_port']} -j MASQUERADE")
+        rules["ODI-DOCKER-USER"].append(f"-A ODI-DOCKER-USER -d {m['dst_ip']}/32 -p {p} -m {p} "
+                                        f"--dport {m['dst_port']} -j ACCEPT")
+    return rules
+
+
+def legacy_rules(mappings: list) -> dict:
+    """
+    Rules created by the former add_nat_rule.sh script directly in the builtin chains (possibly duplicated)
+    :param mappings: list of dicts with protocol, src_port, dst_ip and dst_port
+    :returns: dict with {<chain>: [rules]}
+    """
+    rules = {"PREROUTING": [], "POSTROUTING": [], "DOCKER-USER": []}
+    for m in mappings:
+        p = m["protocol"]
+        rules["PREROUTING"].append(f"-A PREROUTING -p {p} -m {p} --dport {m['src_port']} -j DNAT "
+                                   f"--to-destination {m['dst_ip']}:{m['dst_port']}")
+        rules["POSTROUTING"].append(f"-A POSTROUTING -p {p} -m {p} --dport {m['dst_port']} -j MASQUERADE")
+        rules["DOCKER-USER"].append(f"-A DOCKER-USER -p {p} -m {p} --dport {m['dst_port']} -j ACCEPT")
+    return rules
+
+
+def parse_iptables_save(text: str) -> dict:
+    """
+    Parses the output of iptables-save
+    :returns: dict with {<table>: {"chains": set of chains, "rules": {<chain>: [rules]}}}
+    """
+    tables = {}
+    table = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("*"):
+            table = {"chains": set(), "rules": {}}
+            tables[line[1:]] = table
+        elif line.startswith(":") and table is not None:
+            table["chains"].add(line[1:].split(" ")[0])
+        elif line.startswith("-A ") and table is not None:
+            chain = line.split(" ")[1]
+            table["rules"].setdefault(chain, []).append(line)
+    return tables
+
+
+def render_ruleset(mappings: list, current: dict) -> (str, list):
+    """
+    Compares the desired ODI chains with the live tables and renders the iptables-restore input to apply the
+    differences. ODI chains that changed are declared (and therefore flushed) and written again as a whole, jumps
+    to the ODI chains are only added if missing and rules left by the former add_nat_rule.sh script are removed.
+    :param mappings: list of dicts with protocol, src_port, dst_ip and dst_port
+    :param current: parsed iptables-save output
+    :returns: tuple with (iptables-restore input, list of changes). The input is empty if nothing changed
+    """
+    desired = nat_rules(mappings)
+    legacy = legacy_rules(mappings)
+    lines = []
+    changes = []
+    for table_name, chains in odi_chains.items():
+        table = current.get(table_name, {"chains": set(), "rules": {}})
+        declarations = []  # chain declarations go before the rules
+        table_lines = []
+        for chain, parent in chains:
+            if chain not in table["chains"] or table["rules"].get(chain, []) != desired[chain]:
+                declarations.append(f":{chain} - [0:0]")
+                table_lines += desired[chain]
+                changes.append(f"{table_name}/{chain}: {len(desired[chain])} rules")
+
+            if parent not in table["chains"]:
+                if parent == "DOCKER-USER":
+                    # usually created by docker, which will keep using it
+                    declarations.insert(0, f":{parent} - [0:0]")
+                    changes.append(f"{table_name}/{parent}: create chain")
+                else:
+                    raise ValueError(f"chain {parent} not found in table {table_name}")
+            jump = f"-A {parent} -j {chain}"
+            if jump not in table["rules"].get(parent, []):
+                table_lines.append(f"-I {parent} 1 -j {chain}")
+                changes.append(f"{table_name}/{parent}: jump to {chain}")
+
+            for rule in table["rules"].get(parent, []):
+                if rule in legacy[parent]:
+                    table_lines.append(rule.replace("-A ", "-D ", 1))
+                    changes.append(f"{table_name}/{parent}: remove legacy rule '{rule[3:]}'")
+
+        if declarations or table_lines:
+            lines += [f"*{table_name}"] + declarations + table_lines + ["COMMIT"]
+
+    if not lines:
+        return "", []
+    return "\n".join(lines) + "\n", changes
+
+
+def iptables_save() -> dict:
+    """
+    Returns the parsed live tables
+    """
+    proc = subprocess.run(["sudo", "iptables-save"], capture_output=True)
+    if proc.returncode != 0:
+        raise ValueError(f"iptables-save failed: {proc.stderr.decode(errors='replace')}")
+    return parse_iptables_save(proc.stdout.decode())
+
+
+def iptables_restore(ruleset: str):
+    """
+    Applies a ruleset in a single transaction, the rest of the rules are kept
+    """
+    proc = subprocess.run(["sudo", "iptables-restore", "--noflush"], input=ruleset.encode(), capture_output=True)
+    if proc.returncode != 0:
+        rich.print(f"[red]Ruleset:\n{ruleset}")
+        raise ValueError(f"iptables-restore failed: {proc.stderr.decode(errors='replace')}")
+
+
+def enable_ip_forward():
+    """
+    Makes sure that IPv4 forwarding is enabled
+    """
+    with open("/proc/sys/net/ipv4/ip_forward") as f:
+        if f.read().strip() == "1":
+            return
+    rich.print("enabling ipv4 forwarding...")
+    proc = subprocess.run(["sudo", "sysctl", "net.ipv4.ip_forward=1"], capture_output=True)
+    if proc.returncode != 0:
+        raise ValueError(f"could not enable ipv4 forwarding: {proc.stderr.decode(errors='replace')}")
+
+
+def apply_port_mappings(mappings: list) -> list:
+    """
+    Programs the port mappings, only the ODI chains that changed are touched
+    :param mappings: list of dicts with protocol, src_port, dst_ip and dst_port
+    :returns: list of changes (empty if the live tables were already up to date)
+    """
+    if mappings:
+        enable_ip_forward()
+    ruleset, changes = render_ruleset(mappings, iptables_save())
+    if not ruleset:
+        rich.print("[grey42]NAT rules already up to date")
+        return []
+    for change in changes:
+        rich.print(f"  {change}")
+    iptables_restore(ruleset)
+    return changes
@@ -1,9 +1,63 @@
+import re
+
+
 nginx_conf_start = """
 events {
 }
 http {
+  # Keep upstream connections alive unless the client asks for a protocol upgrade (e.g. websockets)
+  map $http_upgrade $connection_upgrade {
+    default upgrade;
+    '' '';
+  }
+  # Structured access logs for 'odi analytics' (see scripts/analytics.py), the first 8 fields must not change
+  log_format odi_tsv '$time_iso8601\\t$host\\t$request_method\\t$uri\\t$status\\t$body_bytes_sent\\t$request_time\\t'
+                     '$upstream_response_time\\t$upstream_connect_time\\t$upstream_header_time\\t'
+                     '$upstream_cache_status\\t$upstream_addr';
+  log_format odi_json escape=json '{"time":"$time_iso8601","host":"$host","method":"$request_method","uri":"$uri",'
+                      '"status":$status,"bytes":$body_bytes_sent,"request_time":$request_time,'
+                      '"upstream_time":"$upstream_response_time","upstream_connect_time":"$upstream_connect_time",'
+                      '"upstream_header_time":"$upstream_header_time","cache":"$upstream_cache_status",'
+                      '"upstream":"$upstream_addr"}';
+"""
+
+# Sampled access logs: a request is logged if it is in the sample or if it failed
+nginx_log_sample = """
+  split_clients "$request_id" {name}_in {{
+    {percent}% 1;
+    * 0;
+  }}
+  map "$status:{name}_in" {name} {{
+    default 0;
+    ~^[45] 1;
+    ~:1$ 1;
+  }}
+"""
+
+# Upstream with a pool of keepalive connections, avoids opening a new TCP connection for every request
+nginx_upstream = """
+  upstream {name} {{
+{servers}    keepalive {keepalive};
+    keepalive_timeout {keepalive_timeout};
+  }}
+"""
+
+nginx_upstream_server = """    server {ip}:{port}{options};
 """
 
+# Services sharing a DNS name and a location are split by method: reads go to master and replicas, writes to master
+nginx_method_map = """
+  map $request_method ${name} {{
+    default {write};
+    GET {read};
+    HEAD {read};
+  }}
+"""
+
+# Directives added to every proxied location to reuse upstream connections
+keepalive_headers = """proxy_http_version 1.1;
+      proxy_set_header Connection $connection_upgrade;"""
+
 nginx_conf_end = """
 }
 """
@@ -12,14 +66,9 @@ nginx_server_start = """
   server {{
     server_name {dns};
     listen 80;
-    listen 443 ssl;
-    ssl_certificate /ssl_keys/ssl_certificate.pem;
-    ssl_certificate_key /ssl_keys/ssl_certificate.key;
+{tls}
+{logging}
     client_max_body_size 2048M;
-    ssl_session_cache builtin:1000 shared:SSL:10m; # Defining option to share SSL Connection with Passed Proxy
-    ssl_protocols   TLSv1 TLSv1.1 TLSv1.2 TLSv1.3;  # Defining used protocol versions.
-    ssl_ciphers HIGH:!aNULL:!eNULL:!EXPORT:!CAMELLIA:!DES:!MD5:!PSK:!RC4; # Defining ciphers to use.
-    ssl_prefer_server_ciphers on; # Enabling ciphers      
 """
 
 nginx_server_end = """
@@ -30,13 +79,14 @@ erddap_config = """
 
     # ERDDAP config
     location /erddap {{
-      proxy_pass http://{ip}:{port}/erddap;
+      proxy_pass http://{upstream}/erddap;
       proxy_set_header X-Real-IP $remote_addr;
       proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
       proxy_set_header X-Forwarded-Proto $scheme;
       proxy_set_header X-Forwarded-Server $host;
       proxy_set_header X-Forwarded-Host $host;
       proxy_set_header Host $host;
+      {keepalive}{profile}
     }}
 """
 
@@ -46,15 +96,17 @@ sensorthings_config = """
     location /FROST-Server {{
       proxy_set_header HOST $host;
       proxy_set_header X-Real-IP $remote_addr;
-      proxy_pass http://{ip}:{port}/FROST-Server;
+      proxy_pass http://{upstream}/FROST-Server;
+      {keepalive}{profile}
     }}
 """
 
 sensorthings_timeseries_config = """
     location /sta-timeseries {{
-       proxy_pass http://{ip}:{port}/sta-timeseries;
+       proxy_pass http://{upstream}/sta-timeseries;
        proxy_set_header HOST $host;
        proxy_set_header X-Real-IP $remote_addr;
+       {keepalive}{profile}
     }}
 """
 
@@ -62,11 +114,10 @@ grafana_config = """
 
      # Grafana
      location /grafana {{
-         proxy_pass http://{ip}:{port}/grafana;
+         proxy_pass http://{upstream}/grafana;
         proxy_set_header Host $http_host;
-        proxy_http_version 1.1;
         proxy_set_header Upgrade $http_upgrade;
-        proxy_set_header Connection "upgrade";
+        {keepalive}{profile}
     }}
 """
 
@@ -75,13 +126,14 @@ ckan_config = """
 
       # CKAN
       location / {{
-          proxy_pass http://{ip}:{port};
+          proxy_pass http://{upstream};
           proxy_set_header X-Real-IP $remote_addr;
           proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
           proxy_set_header X-Forwarded-Proto $scheme;
           proxy_set_header X-Forwarded-Server $host;
           proxy_set_header X-Forwarded-Host $host;
           proxy_set_header Host $host;
+          {keepalive}{profile}
       }}
 """
 
@@ -89,13 +141,14 @@ zabbix_config = """
 
        # Zabbix 
        location / {{
-           proxy_pass http://{ip}:{port};
+           proxy_pass http://{upstream};
            proxy_set_header X-Real-IP $remote_addr;
            proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
            proxy_set_header X-Forwarded-Proto $scheme;
            proxy_set_header X-Forwarded-Server $host;
            proxy_set_header X-Forwarded-Host $host;
            proxy_set_header Host $host;
+           {keepalive}{profile}
        }}  
 """
 
@@ -104,7 +157,8 @@ fileserver_config = """
     location / {{
       proxy_set_header HOST $host;
       proxy_set_header X-Real-IP $remote_addr;
-      proxy_pass http://{ip}:{port};
+      proxy_pass http://{upstream};
+      {keepalive}{profile}
     }}
 """
 
@@ -113,8 +167,9 @@ pgadmin_config = """
         proxy_set_header X-Script-Name /pgadmin;
         proxy_set_header X-Scheme $scheme;
         proxy_set_header Host $host;
-        proxy_pass http://{ip}:{port}/;
+        proxy_pass http://{upstream}/;
         proxy_redirect off;
+        {keepalive}{profile}
     }}
 """
 
@@ -123,7 +178,8 @@ mmapi_config = """
     location /mmapi/ {{
       proxy_set_header HOST $host;
       proxy_set_header X-Real-IP $remote_addr;
-      proxy_pass http://{ip}:{port}/mmapi/;
+      proxy_pass http://{upstream}/mmapi/;
+      {keepalive}{profile}
     }}
 """
 
@@ -136,22 +192,361 @@ goaccess_config = """
 """
 
 
-def service_nginx_config(name):
-    config = {
-        "grafana": grafana_config,
-        "erddap": erddap_config,
-        "sensorthings": sensorthings_config,
-        "sta-master": sensorthings_config,
-        "sta-slave": sensorthings_config,
-        "sta-ts-master": sensorthings_timeseries_config,
-        "sta-ts-slave": sensorthings_timeseries_config,
-        "zabbix": zabbix_config,
-        "ckan": ckan_config,
-        "fileserver": fileserver_config,
-        "pgadmin": pgadmin_config,
-        "mmapi": mmapi_config,
-        "goaccess": goaccess_config
-    }
-    if name not in config.keys():
+# Optional per-service tuning, declared under the 'nginx' key of each service in infrastructure.yaml
+nginx_profile_keys = {
+    "keepalive": int,  # idle keepalive connections kept in the upstream pool
+    "keepalive_timeout": str,  # idle time before closing an upstream keepalive connection
+    "proxy_buffering": bool,
+    "proxy_buffer_size": str,
+    "proxy_buffers": str,  # e.g. "16 64k"
+    "proxy_busy_buffers_size": str,
+    "proxy_max_temp_file_size": str,
+    "proxy_connect_timeout": str,
+    "proxy_read_timeout": str,
+    "proxy_send_timeout": str,
+    "gzip": bool,  # compress JSON/CSV responses
+    "max_fails": int,  # failed attempts before a replica is ejected from the read upstream
+    "fail_timeout": str,  # time a failing replica stays ejected (and window to count max_fails)
+    "cache": dict  # micro-cache options, see nginx_cache_keys
+}
+
+# TLS profile of the servers, declared under 'tls' in infrastructure.yaml with a DNS name or 'default' as key
+nginx_tls_keys = {
+    "certificate": str,  # certificate file within the ssl folder of the proxy
+    "certificate_key": str,  # key file within the ssl folder of the proxy
+    "http2": bool,
+    "http3": bool,  # HTTP/3 over QUIC (UDP 443)
+    "session_cache_size": str,  # shared session cache, 1 MB ~ 4000 sessions
+    "session_timeout": str,
+    "session_tickets": bool,
+    "ocsp_stapling": bool,
+    "trusted_certificate": str,  # CA chain to verify OCSP responses, within the ssl folder of the proxy
+    "resolver": str,  # DNS servers used to reach the OCSP responder
+    "protocols": str,
+    "ciphers": str
+}
+
+nginx_tls_defaults = {
+    "certificate": "ssl_certificate.pem",
+    "certificate_key": "ssl_certificate.key",
+    "http2": True,
+    "http3": False,
+    "session_cache_size": "10m",
+    "session_timeout": "1h",
+    "session_tickets": True,
+    "ocsp_stapling": False,
+    "trusted_certificate": "",
+    "resolver": "1.1.1.1 8.8.8.8",
+    "protocols": "TLSv1.2 TLSv1.3",
+    "ciphers": "HIGH:!aNULL:!eNULL:!EXPORT:!CAMELLIA:!DES:!MD5:!PSK:!RC4"
+}
+
+# Access and error logs, declared under 'logging' in infrastructure.yaml with a DNS name or 'default' as key
+nginx_logging_keys = {
+    "format": str,  # structured access log format, 'tsv' or 'json'
+    "buffer": str,  # access log lines are written in blocks of this size...
+    "flush": str,  # ...or when they are older than this
+    "gzip": int,  # compression level of the structured access log (0 disables it)
+    "sample": float,  # fraction of successful requests logged (errors are always logged)
+    "level": str,  # error log level (debug, info, notice, warn, error, crit)
+    "combined": bool,  # also write access.log in the combined format (GoAccess report)
+    "rotate_size": str,  # logs bigger than this are rotated during the setup (e.g. 100m, 1g)
+    "rotate_keep": int  # rotated logs kept
+}
+
+nginx_logging_defaults = {
+    "format": "tsv",
+    "buffer": "64k",
+    "flush": "5s",
+    "gzip": 0,
+    "sample": 1.0,
+    "level": "warn",
+    "combined": True,
+    "rotate_size": "100m",
+    "rotate_keep": 7
+}
+
+# Folder where the proxy writes its logs, mounted from ./volumes/log
+nginx_log_folder = "/var/log/nginx"
+
+# Folder where the proxy mounts the certificates
+nginx_ssl_folder = "/ssl_keys"
+
+# Micro-cache options, declared under 'nginx: cache:' of each service in infrastructure.yaml
+nginx_cache_keys = {
+    "ttl": str,  # time that successful responses are cached (metadata entities)
+    "observations_ttl": str,  # time that observations are cached (SensorThings only)
+    "max_size": str,  # max disk space used by the cache
+    "keys_zone_size": str,  # shared memory for the cache keys (1 MB ~ 8000 keys)
+    "inactive": str,  # remove entries not accessed during this time
+    "stale": bool,  # serve stale entries while updating them in background or if the backend fails
+    "lock": bool,  # only one request at a time populates a cache entry (request coalescing)
+    "bypass_cookies": bool  # requests with cookies (e.g. session cookies) are not cached nor served from cache
+}
+
+nginx_cache_defaults = {
+    "ttl": "60s",
+    "observations_ttl": "5s",
+    "max_size": "1g",
+    "keys_zone_size": "10m",
+    "inactive": "10m",
+    "stale": True,
+    "lock": True,
+    "bypass_cookies": True
+}
+
+# Cache files are stored in an ODI-managed volume of the proxy (./volumes/cache)
+nginx_cache_path = """
+  proxy_cache_path /var/cache/nginx/odi/{name} levels=1:2 keys_zone={name}:{keys_zone_size}
+                   max_size={max_size} inactive={inactive} use_temp_path=off;
+"""
+
+# Paths with frequently updated data get a shorter TTL, key is the service type, value a list of regex
+nginx_cache_short_ttl_paths = {
+    "sensorthings": [r"^/FROST-Server/v1\.[01]/(.*/)?Observations"],
+    "sta-master": [r"^/FROST-Server/v1\.[01]/(.*/)?Observations"],
+    "sta-slave": [r"^/FROST-Server/v1\.[01]/(.*/)?Observations"],
+}
+
+gzip_types = "application/json text/csv text/plain application/xml text/xml application/geo+json"
+
+
+def nginx_tls_config(tls: dict, reuseport=False, indent=4) -> str:
+    """
+    Generates the TLS directives of a server
+    :param tls: TLS profile (see nginx_tls_keys), missing options are taken from nginx_tls_defaults
+    :param reuseport: add the reuseport option to the QUIC listener (only allowed once per address and port)
+    :param indent: indentation of the directives
+    """
+    tls = {**nginx_tls_defaults, **tls}
+    directives = ["listen 443 ssl;"]
+    if tls["http2"]:
+        directives.append("http2 on;")
+    if tls["http3"]:
+        directives += [f"listen 443 quic{' reuseport' if reuseport else ''};",
+                       "http3 on;",
+                       # locations with their own add_header would not inherit this one, none of them has
+                       "add_header Alt-Svc 'h3=\":443\"; ma=86400' always;"]
+    directives += [
+        f"ssl_certificate {nginx_ssl_folder}/{tls['certificate']};",
+        f"ssl_certificate_key {nginx_ssl_folder}/{tls['certificate_key']};",
+        # shared by all workers (no per-worker builtin cache), one zone per size
+        f"ssl_session_cache shared:odi_tls_{tls['session_cache_size']}:{tls['session_cache_size']};",
+        f"ssl_session_timeout {tls['session_timeout']};",
+        f"ssl_session_tickets {'on' if tls['session_tickets'] else 'off'};",
+        f"ssl_protocols {tls['protocols']};",
+        f"ssl_ciphers {tls['ciphers']};",
+        "ssl_prefer_server_ciphers on;"
+    ]
+    if tls["ocsp_stapling"]:
+        directives += ["ssl_stapling on;", "ssl_stapling_verify on;"]
+        if tls["trusted_certificate"]:
+            directives.append(f"ssl_trusted_certificate {nginx_ssl_folder}/{tls['trusted_certificate']};")
+        directives += [f"resolver {tls['resolver']} valid=300s;", "resolver_timeout 5s;"]
+    return "\n".join([" " * indent + d for d in directives])
+
+
+def nginx_log_sample_name(sample: float) -> str:
+    """
+    Name of the variable that flags the requests logged with a sample rate, e.g. 0.1 -> $odi_log_sample_10
+    """
+    return "$odi_log_sample_" + f"{100 * sample:g}".replace(".", "_")
+
+
+def nginx_log_sample_config(sample: float) -> str:
+    """
+    Generates the variables to sample the access log, declared once per sample rate
+    """
+    return nginx_log_sample.format(name=nginx_log_sample_name(sample), percent=f"{100 * sample:g}")
+
+
+def nginx_logging_config(logging: dict, indent=4) -> str:
+    """
+    Generates the log directives of a server. Access logs are buffered, so nginx does not write every request
+    :param logging: logging profile (see nginx_logging_keys), missing options are taken from nginx_logging_defaults
+    :param indent: indentation of the directives
+    """
+    logging = {**nginx_logging_defaults, **logging}
+    if logging["format"] not in ["tsv", "json"]:
+        raise ValueError(f"Invalid log format '{logging['format']}', expected 'tsv' or 'json'")
+    if not 0 < logging["sample"] <= 1:
+        raise ValueError(f"Invalid log sample {logging['sample']}, expected a value in (0, 1]")
+    buffered = f"buffer={logging['buffer']} flush={logging['flush']}"
+    sample = f" if={nginx_log_sample_name(logging['sample'])}" if logging["sample"] < 1 else ""
+    # the combined log is read by GoAccess as plain text, only the structured one is compressed
+    compress = f" gzip={logging['gzip']}" if logging["gzip"] else ""
+    directives = [f"access_log {nginx_log_folder}/odi_access.log odi_{logging['format']} {buffered}{compress}{sample};"]
+    if logging["combined"]:
+        directives.append(f"access_log {nginx_log_folder}/access.log combined {buffered}{sample};")
+    directives.append(f"error_log {nginx_log_folder}/error.log {logging['level']};")
+    return "\n".join([" " * indent + d for d in directives])
+
+
+def nginx_upstream_name(service: str) -> str:
+    """
+    Returns the name of the upstream block for a service, e.g. "sta-master" -> "odi_sta_master"
+    """
+    return "odi_" + service.replace("-", "_").replace(".", "_")
+
+
+def nginx_upstream_config(name: str, servers: list, profile: dict) -> str:
+    """
+    Generates an upstream block
+    :param name: upstream name
+    :param servers: list of (ip, port) or (ip, port, options) tuples, e.g. ("10.0.0.2", 8080, " weight=2")
+    :param profile: service profile (only keepalive options are used)
+    """
+    lines = "".join([nginx_upstream_server.format(ip=s[0], port=s[1], options=s[2] if len(s) > 2 else "")
+                     for s in servers])
+    return nginx_upstream.format(name=name, servers=lines, keepalive=profile.get("keepalive", 32),
+                                 keepalive_timeout=profile.get("keepalive_timeout", "60s"))
+
+
+def nginx_split_config(name: str, masters: list, replicas: list, profile: dict) -> (str, str):
+    """
+    Generates the upstreams for a group of services with a master and its read replicas. Writes go to the
+    '<name>' upstream (masters only), GET/HEAD requests are balanced by weight across masters and replicas in the
+    '<name>_read' upstream. Failing servers are ejected passively (max_fails / fail_timeout).
+    :param name: upstream name of the master
+    :param masters: list of (ip, port, weight) tuples
+    :param replicas: list of (ip, port, weight) tuples
+    :param profile: master profile
+    :returns: tuple with (upstream and map blocks, variable to be used in proxy_pass)
+    """
+    ejection = f" max_fails={profile.get('max_fails', 3)} fail_timeout={profile.get('fail_timeout', '30s')}"
+    write = [(ip, port, f" weight={weight}") for ip, port, weight in masters]
+    read = [(ip, port, f" weight={weight}{ejection}") for ip, port, weight in masters + replicas]
+    variable = f"{name}_upstream"
+    conf = nginx_upstream_config(name, write, profile)
+    conf += nginx_upstream_config(f"{name}_read", read, profile)
+    conf += nginx_method_map.format(name=variable, write=name, read=f"{name}_read")
+    return conf, "$" + variable
+
+
+def nginx_variable_proxy_pass(conf: str, variable: str) -> str:
+    """
+    Adapts a location rendered with a variable upstream. When proxy_pass contains variables nginx does not map the
+    location path into the URI, the URI in the directive replaces the whole request URI. Therefore the URI is removed,
+    so the original request URI is passed as is. This is only equivalent to the static config if the location path
+    and the proxy_pass URI are the same, e.g. "location /FROST-Server" -> "http://<upstream>/FROST-Server".
+    :param conf: location config rendered with upstream=variable
+    :param variable: variable with the upstream name, e.g. "$odi_sta_master_upstream"
+    :returns: location config
+    """
+    location = re.search(r"location\s+(\S+)\s*\{", conf).group(1)
+    match = re.search(r"proxy_pass http://" + re.escape(variable) + r"(\S*);", conf)
+    if match.group(1) not in ["", location]:
+        raise ValueError(f"Cannot split reads and writes for location '{location}', proxy_pass URI "
+                         f"'{match.group(1)}' does not match the location path")
+    return conf.replace(match.group(0), f"proxy_pass http://{variable};", 1)
+
+
+def nginx_profile_config(profile: dict, indent=6) -> str:
+    """
+    Generates the location directives for a service profile
+    :param profile: dict with the profile options (see nginx_profile_keys)
+    :param indent: indentation of the directives
+    """
+    directives = []
+    for key, value in profile.items():
+        if key in ["keepalive", "keepalive_timeout", "cache", "max_fails", "fail_timeout"]:
+            continue  # upstream and cache options, not location directives
+        elif key == "gzip":
+            if value:
+                directives += ["gzip on;", f"gzip_types {gzip_types};", "gzip_proxied any;", "gzip_min_length 1024;"]
+            else:
+                directives.append("gzip off;")
+        elif isinstance(value, bool):
+            directives.append(f"{key} {'on' if value else 'off'};")
+        else:
+            directives.append(f"{key} {value};")
+    if not directives:
+        return ""
+    return "\n" + "\n".join([" " * indent + d for d in directives])
+
+
+def nginx_cache_zone(service: str) -> str:
+    """
+    Returns the name of the cache zone for a service
+    """
+    return nginx_upstream_name(service).replace("odi_", "odi_cache_", 1)
+
+
+def nginx_cache_path_config(service: str, cache: dict) -> str:
+    """
+    Generates the proxy_cache_path directive (http context) for a service
+    """
+    cache = {**nginx_cache_defaults, **cache}
+    return nginx_cache_path.format(name=nginx_cache_zone(service), keys_zone_size=cache["keys_zone_size"],
+                                   max_size=cache["max_size"], inactive=cache["inactive"])
+
+
+def nginx_cache_config(service: str, upstream: str, cache: dict, indent=6) -> str:
+    """
+    Generates the location directives to cache anonymous GET/HEAD requests for a service. Authenticated requests
+    (Authorization header or, unless bypass_cookies is disabled, any cookie) are never cached nor served from cache,
+    other methods (POST, PATCH, DELETE...) are not cached.
+    :param service: service name
+    :param upstream: upstream name, or the method map variable if reads and writes are split
+    :param cache: cache options (see nginx_cache_keys)
+    :param indent: indentation of the directives
+    """
+    cache = {**nginx_cache_defaults, **cache}
+    bypass = "$http_authorization $http_cookie" if cache["bypass_cookies"] else "$http_authorization"
+    directives = [
+        f"proxy_cache {nginx_cache_zone(service)};",
+        "proxy_cache_key $scheme$host$request_uri;",
+        "proxy_cache_methods GET HEAD;",
+        f"proxy_cache_valid 200 {cache['ttl']};",
+        "proxy_cache_valid 404 10s;",
+        f"proxy_cache_bypass {bypass};",
+        f"proxy_no_cache {bypass};"
+    ]
+    if cache["lock"]:
+        directives += ["proxy_cache_lock on;", "proxy_cache_lock_timeout 5s;"]
+    if cache["stale"]:
+        directives += ["proxy_cache_use_stale updating error timeout http_500 http_502 http_503 http_504;",
+                       "proxy_cache_background_update on;"]
+
+    # Nested locations inherit all the cache settings but the TTL (proxy_pass is never inherited)
+    for regex in nginx_cache_short_ttl_paths.get(service_nginx_type(service), []):
+        directives += [f"location ~ {regex} {{",
+                       f"  proxy_pass http://{upstream};",
+                       f"  proxy_cache_valid 200 {cache['observations_ttl']};",
+                       "}"]
+
+    return "\n" + "\n".join([" " * indent + d for d in directives])
+
+
+def service_nginx_type(name):
+    """
+    Returns the service type used to select the NGINX configuration, e.g. "erddap-2" -> "erddap"
+    """
+    if name in nginx_service_configs.keys():
+        return name
+    # Numbered or suffixed instances of a service, e.g. "erddap-2" uses the "erddap" configuration
+    matches = [key for key in nginx_service_configs.keys() if name.startswith(key)]
+    if not matches:
         raise ValueError(f"NGINX configuration for service '{name}' not implemented!")
-    return config[name]
\ No newline at end of file
+    return max(matches, key=len)
+
+
+nginx_service_configs = {
+    "grafana": grafana_config,
+    "erddap": erddap_config,
+    "sensorthings": sensorthings_config,
+    "sta-master": sensorthings_config,
+    "sta-slave": sensorthings_config,
+    "sta-ts-master": sensorthings_timeseries_config,
+    "sta-ts-slave": sensorthings_timeseries_config,
+    "zabbix": zabbix_config,
+    "ckan": ckan_config,
+    "fileserver": fileserver_config,
+    "pgadmin": pgadmin_config,
+    "mmapi": mmapi_config,
+    "goaccess": goaccess_config
+}
+
+
+def service_nginx_config(name):
+    return nginx_service_configs[service_nginx_type(name)]
\ No newline at end of file
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Prepares the images of a set of services before starting them: registry images are pulled concurrently and local
+images are built in parallel with BuildKit, sharing a persistent local build cache
+
+license: MIT
+"""
+import os
+import time
+import threading
+import rich
+
+try:
+    from utils import docker_client, docker_index, run_subprocess, run_subprocess_pipe
+    from scheduler import run_tasks
+except ModuleNotFoundError:
+    from .utils import docker_client, docker_index, run_subprocess, run_subprocess_pipe
+    from .scheduler import run_tasks
+
+# BuildKit builder used by ODI, the default 'docker' driver cannot export the build cache
+odi_builder = "odi-builder"
+_builder_lock = threading.Lock()
+_builder_ready = False
+
+
+class ImageReport:
+    def __init__(self, image, kind):
+        """
+        Result of pulling or building an image
+        :param image: image name
+        :param kind: "pull" or "build"
+        """
+        self.image = image
+        self.kind = kind
+        self.bytes = 0  # bytes downloaded (pull only)
+        self.elapsed = 0.0
+        self.status = "pending"
+
+
+def split_image(image: str) -> (str, str):
+    """
+    Splits an image into repository and tag, e.g. "nginx:stable" -> ("nginx", "stable"). Registry ports are not
+    mistaken for tags, e.g. "registry:5000/image" -> ("registry:5000/image", "latest"). Digest references return the
+    digest as tag (the pull API accepts both), e.g. "nginx@sha256:ab..." -> ("nginx", "sha256:ab..."), a tag in
+    front of the digest is ignored
+    """
+    if "@" in image:
+        repository, _, digest = image.partition("@")
+        return split_image(repository)[0], digest
+    repository, _, tag = image.rpartition(":")
+    if not repository or "/" in tag:
+        return image, "latest"
+    return repository, tag
+
+
+def pull_image(image: str, report: ImageReport):
+    """
+    Pulls an image, counting the bytes downloaded (layers already present count as 0)
+    """
+    repository, tag = split_image(image)
+    layers = {}  # key layer id, value total bytes
+    for event in docker_client().api.pull(repository, tag=tag, stream=True, decode=True):
+        if "error" in event.keys():
+            raise ValueError(f"pull {image} failed: {event['error']}")
+        if event.get("status") == "Downloading" and event.get("progressDetail", {}).get("total"):
+            layers[event["id"]] = event["progressDetail"]["total"]
+    report.bytes = sum(layers.values())
+
+
+def ensure_builder():
+    """
+    Creates the ODI BuildKit builder (docker-container driver) if it does not exist
+    """
+    global _builder_ready
+    with _builder_lock:  # services may be built concurrently
+        if _builder_ready:
+            return
+        if not run_subprocess(f"docker buildx inspect {odi_builder}", allow_fail=True, quiet=True):
+            rich.print(f"Creating BuildKit builder '{odi_builder}'")
+            run_subprocess(f"docker buildx create --name {odi_builder} --driver docker-container")
+        _builder_ready = True
+
+
+def builder_available() -> bool:
+    """
+    Checks if the ODI BuildKit builder exists (it is created by 'odi prepare'), without creating it
+    """
+    global _builder_ready
+    with _builder_lock:
+        if not _builder_ready:
+            _builder_ready = run_subprocess(f"docker buildx inspect {odi_builder}", allow_fail=True, quiet=True)
+        return _builder_ready
+
+
+def buildx_command(image: str, build: dict, path: str, cache_dir: str) -> list:
+    """
+    Generates the docker buildx command to build an image, importing and exporting the local build cache
+    :param image: image name
+    :param build: build config from the docker-compose file (context, dockerfile, args, target)
+    :param path: service folder, relative paths are resolved from it
+    :param cache_dir: build cache folder of this image
+    :returns: command as a list
+    """
+    context = os.path.join(path, build["context"])
+    cmd = ["docker", "buildx", "build", "--builder", odi_builder, "--load", "-t", image,
+           "--cache-from", f"type=local,src={cache_dir}",
+           "--cache-to", f"type=local,dest={cache_dir},mode=max"]
+    if build.get("dockerfile"):
+        cmd += ["-f", os.path.join(context, build["dockerfile"])]
+    if build.get("target"):
+        cmd += ["--target", build["target"]]
+    for key, value in build.get("args", {}).items():
+        # resolved now, after odi.env and secrets.env are loaded, like docker compose does
+        value = os.environ.get(key, "") if value is None else os.path.expandvars(str(value))
+        cmd += ["--build-arg", f"{key}={value}"]
+    return cmd + [context]
+
+
+def build_image(container, cache_root: str, report: ImageReport = None):
+    """
+    Builds the image of a container with BuildKit. Every image has its own cache folder, so parallel builds do not
+    overwrite each other's cache
+    :param container: Container object
+    :param cache_root: build cache folder
+    :param report: if set, the build output is only shown if it fails
+    """
+    cache_dir = os.path.join(cache_root, container.image.replace("/", "_").replace(":", "_"))
+    os.makedirs(cache_dir, exist_ok=True)
+    cmd = buildx_command(container.image, container.build_conf, container.path, cache_dir)
+    run_subprocess_pipe(cmd, prefix=container.image, quiet=report is not None)
+
+
+def prepare_images(containers: list, cache_root: str, jobs=4, force=False) -> list:
+    """
+    Pulls the registry images and builds the local images of a list of containers concurrently
+    :param containers: list of Container objects
+    :param cache_root: folder for the BuildKit cache
+    :param jobs: max number of pulls and builds running at the same time
+    :param force: build images even if they already exist (the build cache makes unchanged builds fast)
+    :returns: list of ImageReport
+    """
+    reports = {}
+    tasks = {}
+
+    def timed(f, *args):
+        def task():
+            init = time.time()
+            try:
+                f(*args)
+            finally:
+                args[-1].elapsed = time.time() - init
+        return task
+
+    for c in containers:
+        if c.image in reports.keys():
+            continue
+        if c.requires_build:
+            if not force and docker_index().has_image(c.image):
+                rich.print(f"[grey42]Image '{c.image}' already built")
+                continue
+            reports[c.image] = ImageReport(c.image, "build")
+            tasks[c.image] = timed(build_image, c, cache_root, reports[c.image])
+        else:
+            reports[c.image] = ImageReport(c.image, "pull")
+            tasks[c.image] = timed(pull_image, c.image, reports[c.image])
+
+    if any(r.kind == "build" for r in reports.values()):
+        ensure_builder()
+    rich.print(f"Pulling {sum(r.kind == 'pull' for r in reports.values())} images and building "
+               f"{sum(r.kind == 'build' for r in reports.values())} images ({jobs} jobs)...")
+    results = run_tasks(tasks, {}, jobs=jobs)
+    for image, result in results.items():
+        reports[image].status = result.status
+    docker_index().invalidate()
+    return list(reports.values())
+
+
+def print_report(reports: list):
+    """
+    Prints the bytes pulled and time spent for each image
+    """
+    colors = {"ok": "green", "failed": "red", "skipped": "yellow", "pending": "grey42"}
+    width = max([len(r.image) for r in reports] + [5])
+    rich.print(f"\n{'image':<{width}}  {'action':<6}  {'status':<8}  {'MB':>8}  time")
+    for r in reports:
+        size = f"{r.bytes / 1e6:.1f}" if r.kind == "pull" else "-"
+        rich.print(f"{r.image:<{width}}  {r.kind:<6}  [{colors[r.status]}]{r.status:<8}[/{colors[r.status]}]  "
+                   f"{size:>8}  {r.elapsed:.1f} s")
+    total = sum([r.bytes for r in reports])
+    rich.print(f"total pulled: {total / 1e6:.1f} MB")
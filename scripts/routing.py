@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Routing model of an ODI deployment. Answers how a host reaches a service: directly if both hosts share a network
+(hosts may belong to several networks) or through the port mappings of gateway hosts.
+
+license: MIT
+"""
+from collections import deque
+
+# IP address of the host from the containers point of view (docker bridge)
+docker_host_ip = "172.17.0.1"
+
+
+class Route:
+    def __init__(self, ip: str, port: int, kind: str, via: list):
+        """
+        Route from a host to a service
+        :param ip: IP address to be used
+        :param port: port to be used
+        :param kind: "local" (same host), "direct" (shared network) or "port_mapping"
+        :param via: list of gateway hosts, from the first hop to the last one
+        """
+        self.ip = ip
+        self.port = port
+        self.kind = kind
+        self.via = via
+
+    def __repr__(self):
+        via = f" via {' -> '.join(self.via)}" if self.via else ""
+        return f"{self.ip}:{self.port} ({self.kind}{via})"
+
+
+class RoutingGraph:
+    def __init__(self, host_networks: dict, mappings: dict):
+        """
+        Builds the routing graph
+        :param host_networks: dict with {<host>: {<network>: <ip>}}
+        :param mappings: port mappings, dict with {<gateway host>: [{"src_port", "dst_host", "dst_port", ...}]}
+        """
+        self.host_networks = host_networks
+        # key (destination host, destination port), value list of (gateway, source port)
+        self.forwards = {}
+        for gateway, gateway_mappings in mappings.items():
+            for m in gateway_mappings:
+                key = (m["dst_host"], int(m["dst_port"]))
+                self.forwards.setdefault(key, []).append((gateway, int(m["src_port"])))
+        self.routes = {}  # memoised routes, key (source host, destination host, destination port)
+
+    def shared_ip(self, source: str, target: str) -> str:
+        """
+        Returns the IP of target in a network shared with source, or an empty string if they share no network
+        """
+        source_networks = self.host_networks.get(source, {})
+        for network, ip in self.host_networks.get(target, {}).items():
+            if network in source_networks:
+                return ip
+        return ""
+
+    def route(self, source: str, target: str, port: int) -> Route | None:
+        """
+        Resolves how source reaches target:port. Port mappings are explored breadth-first, so the route with fewer
+        hops is selected. Results are memoised.
+        :param source: source host
+        :param target: host running the service
+        :param port: service port
+        :returns: Route or None if the service is not reachable
+        """
+        key = (source, target, int(port))
+        if key not in self.routes.keys():
+            self.routes[key] = self.__resolve(source, target, int(port))
+        return self.routes[key]
+
+    def __resolve(self, source: str, target: str, port: int) -> Route | None:
+        queue = deque([(target, port, [])])  # endpoint and gateways between the endpoint and the service
+        visited = set()
+        while queue:
+            host, host_port, via = queue.popleft()
+            if (host, host_port) in visited:
+                continue
+            visited.add((host, host_port))
+            kind = "port_mapping" if via else "direct"
+            if host == source:
+                return Route(docker_host_ip, host_port, "local" if not via else kind, via)
+            ip = self.shared_ip(source, host)
+            if ip:
+                return Route(ip, host_port, kind, via)
+            for gateway, src_port in self.forwards.get((host, host_port), []):
+                queue.append((gateway, src_port, [gateway] + via))
+        return None
+
+    def precompute(self, sources: list, services: dict):
+        """
+        Resolves the routes for all (source host, service) pairs
+        :param sources: list of source hosts
+        :param services: dict with {<service>: (host, port)}
+        """
+        for source in sources:
+            for host, port in services.values():
+                self.route(source, host, port)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Runs ODI actions over several services concurrently, taking into account the dependencies between them
+
+license: MIT
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import rich
+
+
+class TaskResult:
+    def __init__(self, name):
+        """
+        Outcome of a task run by the scheduler
+        :param name: task name (usually the service name)
+        """
+        self.name = name
+        self.status = "pending"  # pending, ok, failed or skipped
+        self.elapsed = 0.0
+        self.error = ""
+
+
+def reverse_dependencies(dependencies: dict) -> dict:
+    """
+    Inverts a dependency graph, e.g. {"a": {"b"}} -> {"a": set(), "b": {"a"}}. Useful to stop services in the opposite
+    order in which they were started
+    :param dependencies: dict with {<task>: set(<tasks it depends on>)}
+    :returns: inverted graph
+    """
+    reverse = {name: set() for name in dependencies.keys()}
+    for name, deps in dependencies.items():
+        for d in deps:
+            reverse[d].add(name)
+    return reverse
+
+
+def check_dependencies(dependencies: dict):
+    """
+    Makes sure that the dependency graph is complete and has no cycles
+    :param dependencies: dict with {<task>: set(<tasks it depends on>)}
+    :raises: ValueError if error
+    """
+    for name, deps in dependencies.items():
+        for d in deps:
+            if d not in dependencies.keys():
+                raise ValueError(f"'{name}' depends on unknown service '{d}'")
+
+    pending = {name: set(deps) for name, deps in dependencies.items()}
+    while pending:
+        ready = [name for name, deps in pending.items() if not deps]
+        if not ready:
+            raise ValueError(f"Circular dependency between services: {', '.join(pending.keys())}")
+        for name in ready:
+            pending.pop(name)
+        for deps in pending.values():
+            deps.difference_update(ready)
+
+
+def run_tasks(tasks: dict, dependencies: dict, jobs=1) -> dict:
+    """
+    Runs a set of tasks in a worker pool. A task is only started when all its dependencies finished successfully. If a
+    dependency fails, all the tasks depending on it are skipped.
+    :param tasks: dict with {<task name>: <callable without arguments>}
+    :param dependencies: dict with {<task name>: set(<tasks it depends on>)}
+    :param jobs: max number of tasks running at the same time
+    :returns: dict with {<task name>: TaskResult}, in the same order as tasks
+    """
+    assert jobs > 0, f"jobs should be greater than 0, got {jobs}"
+    dependencies = {name: set(dependencies.get(name, [])) & set(tasks.keys()) for name in tasks.keys()}
+    check_dependencies(dependencies)
+
+    results = {name: TaskResult(name) for name in tasks.keys()}
+    waiting = list(tasks.keys())
+    running = {}  # key future, value task name
+
+    def timed(name):
+        init = time.time()
+        try:
+            tasks[name]()
+        finally:
+            results[name].elapsed = time.time() - init
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while waiting or running:
+            for name in list(waiting):
+                states = [results[d].status for d in dependencies[name]]
+                if any(s in ["failed", "skipped"] for s in states):
+                    rich.print(f"[yellow]Skipping '{name}', one of its dependencies failed")
+                    results[name].status = "skipped"
+                    waiting.remove(name)
+                elif all(s == "ok" for s in states):
+                    waiting.remove(name)
+                    running[executor.submit(timed, name)] = name
+
+            if not running:
+                continue
+
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    results[name].status = "ok"
+                except Exception as e:
+                    rich.print(f"[red]ERROR in '{name}': {e}")
+                    results[name].status = "failed"
+                    results[name].error = str(e)
+    return results
+
+
+def print_summary(results: dict, label="service"):
+    """
+    Prints the wall-clock time spent by each task
+    :param results: dict with {<task name>: TaskResult}
+    :param label: header of the task names column
+    """
+    colors = {"ok": "green", "failed": "red", "skipped": "yellow", "pending": "grey42"}
+    width = max([len(name) for name in results.keys()] + [len(label)])
+    rich.print(f"\n{label:<{width}}  {'status':<8}  time")
+    for name, r in results.items():
+        rich.print(f"{name:<{width}}  [{colors[r.status]}]{r.status:<8}[/{colors[r.status]}]  {r.elapsed:.1f} s")
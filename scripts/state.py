@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Persistent ODI state, stored as a JSON file (.stat.json) in the ODI path
+
+license: MIT
+"""
+import os
+import json
+import fcntl
+import hashlib
+import threading
+import rich
+
+try:
+    from utils import load_yaml
+except ModuleNotFoundError:
+    from .utils import load_yaml
+
+
+class OdiState:
+    def __init__(self, filename):
+        """
+        Persistent state of an ODI deployment. The state is a dict of sections (e.g. the parse cache), each
+        section is a JSON-serializable dict.
+        :param filename: JSON file (usually <odi_path>/.stat.json)
+        """
+        self.filename = filename
+        self.data = {}
+        self.modified = False
+        self.lock = threading.RLock()
+        self.host_sections = {}  # key section name, value set of hosts used by this process (see host_section)
+
+        if os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    self.data = json.load(f)
+            except (ValueError, OSError) as e:
+                rich.print(f"[yellow]WARNING: could not load ODI state from {filename}, ignoring it ({e})")
+                self.data = {}
+
+    def section(self, name: str) -> dict:
+        """
+        Returns a section of the state, creating it if it does not exist
+        """
+        with self.lock:
+            if name not in self.data.keys():
+                self.data[name] = {}
+            return self.data[name]
+
+    def host_section(self, name: str, host: str) -> dict:
+        """
+        Returns the part of a section that belongs to a host, e.g. its setup journal. Several processes acting as
+        different hosts may share the same state file (e.g. the local transport of --all-hosts), the entries of the
+        other hosts are preserved when the state is saved.
+        """
+        with self.lock:
+            self.host_sections.setdefault(name, set()).add(host)
+            return self.section(name).setdefault(host, {})
+
+    def touch(self):
+        """
+        Flags the state as modified, so it is written in the next save()
+        """
+        self.modified = True
+
+    def save(self):
+        """
+        Writes the state file (only if it has been modified). The file is first written to a temporary file and then
+        renamed, so a crash never leaves a half-written state.
+        """
+        with self.lock:
+            if not self.modified:
+                return
+            tmp = f"{self.filename}.{os.getpid()}.tmp"
+            try:
+                with open(self.filename + ".lock", "w") as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)  # other processes may be saving the same file
+                    self.merge_other_hosts()
+                    with open(tmp, "w") as f:
+                        json.dump(self.data, f, separators=(",", ":"))
+                    os.replace(tmp, self.filename)
+                self.modified = False
+            except OSError as e:
+                rich.print(f"[yellow]WARNING: could not write ODI state to {self.filename} ({e})")
+
+    def merge_other_hosts(self):
+        """
+        Copies the host sections of the hosts not used by this process from the state file, so they are not lost
+        """
+        if not self.host_sections or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename) as f:
+                current = json.load(f)
+        except (ValueError, OSError):
+            return
+        for name, hosts in self.host_sections.items():
+            for host, entry in current.get(name, {}).items():
+                if host not in hosts:
+                    self.data[name][host] = entry
+
+    def load_yaml(self, filename: str):
+        """
+        Loads a YAML file through the parse cache. The cache is keyed by file path, mtime and content hash: if the mtime
+        did not change the cached contents are returned straight away, otherwise the file is hashed and only parsed
+        again if its contents actually changed.
+        :param filename: YAML file
+        :returns: parsed contents
+        """
+        cache = self.section("parse_cache")
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        with self.lock:
+            entry = cache.get(filename)
+            if entry and entry["mtime"] == st.st_mtime_ns and entry["size"] == st.st_size:
+                return entry["contents"]
+
+        with open(filename, "rb") as f:
+            raw = f.read()
+        sha256 = hashlib.sha256(raw).hexdigest()
+
+        with self.lock:
+            if entry and entry["sha256"] == sha256:
+                contents = entry["contents"]  # file touched but not modified
+            else:
+                contents = load_yaml(raw)
+                try:
+                    serializable = json.loads(json.dumps(contents)) == contents
+                except TypeError:
+                    serializable = False
+                if not serializable:
+                    return contents  # contents cannot be stored as JSON, do not cache them
+
+            cache[filename] = {"mtime": st.st_mtime_ns, "size": st.st_size, "sha256": sha256, "contents": contents}
+            self.touch()
+        return contents
+
+    def prune_parse_cache(self):
+        """
+        Removes cached files that no longer exist
+        """
+        cache = self.section("parse_cache")
+        with self.lock:
+            for filename in list(cache.keys()):
+                if not os.path.exists(filename):
+                    cache.pop(filename)
+                    self.touch()
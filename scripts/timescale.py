@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Provisions TimescaleDB in the SensorThings database: the OBSERVATIONS table is converted into a hypertable, native
+compression is enabled (segmented by datastream) and continuous aggregates per datastream are created with their
+refresh policies. Every function checks the current state first, so provisioning can be applied to existing
+databases as many times as needed.
+
+license: MIT
+"""
+import json
+import time
+import rich
+
+try:
+    from postgres import sql_literal
+except ModuleNotFoundError:
+    from .postgres import sql_literal
+
+# Options declared under the 'timescale' key of a service in infrastructure.yaml
+timescale_keys = {
+    "chunk_interval": str,  # time covered by each chunk of the hypertable
+    "compression": bool,
+    "compress_after": str,  # chunks older than this are compressed
+    "aggregates": list  # continuous aggregates, 'hourly' and/or 'daily'
+}
+
+timescale_defaults = {
+    "chunk_interval": "7 days",
+    "compression": True,
+    "compress_after": "30 days",
+    "aggregates": ["hourly", "daily"]
+}
+
+# Continuous aggregates, the refresh window (start offset) should be shorter than compress_after
+timescale_aggregates = {
+    "hourly": {"bucket": "1 hour", "start_offset": "3 days", "end_offset": "1 hour", "schedule": "30 minutes"},
+    "daily": {"bucket": "1 day", "start_offset": "7 days", "end_offset": "1 day", "schedule": "1 hour"}
+}
+
+observations = '"OBSERVATIONS"'
+time_column = "PHENOMENON_TIME_START"
+
+continuous_aggregate = """
+CREATE MATERIALIZED VIEW IF NOT EXISTS {view} WITH (timescaledb.continuous) AS
+SELECT "DATASTREAM_ID" AS datastream_id,
+       time_bucket(INTERVAL {bucket}, "PHENOMENON_TIME_START") AS bucket,
+       count(*) AS observations,
+       avg("RESULT_NUMBER") AS avg,
+       min("RESULT_NUMBER") AS min,
+       max("RESULT_NUMBER") AS max
+FROM "OBSERVATIONS"
+GROUP BY 1, 2
+WITH NO DATA;
+"""
+
+
+def check_timescale_conf(conf: dict):
+    """
+    Validates the values of a timescale configuration
+    :raises: ValueError if not valid
+    """
+    for name in conf.get("aggregates", []):
+        if name not in timescale_aggregates.keys():
+            raise ValueError(f"Unknown continuous aggregate '{name}', expected {', '.join(timescale_aggregates)}")
+
+
+def aggregate_view(name: str) -> str:
+    return f"observations_{name}"
+
+
+def is_hypertable(psql) -> bool:
+    rows = psql.query("SELECT 1 FROM timescaledb_information.hypertables WHERE hypertable_name = 'OBSERVATIONS';")
+    return bool(rows)
+
+
+def create_hypertable(psql, chunk_interval: str):
+    """
+    Converts OBSERVATIONS into a hypertable partitioned by phenomenon time. Unique indexes of a hypertable must
+    include the partitioning column, so the primary key (ID) is replaced by (ID, PHENOMENON_TIME_START). Everything
+    is done in a single transaction, existing rows are moved into chunks.
+
+    The transaction holds an ACCESS EXCLUSIVE lock on OBSERVATIONS until all the rows are migrated: reads and writes
+    of SensorThings block meanwhile, so large tables should be converted in a maintenance window.
+    :raises: ValueError if any observation has no phenomenon time (it can not be part of the primary key)
+    """
+    nulls = psql.query(f'SELECT count(*) FROM {observations} WHERE "{time_column}" IS NULL;')
+    if int(nulls[0][0]):
+        raise ValueError(f"{nulls[0][0]} observations have a NULL {time_column}, they must be fixed or removed "
+                         f"before converting OBSERVATIONS into a hypertable")
+    rows = psql.query(f"SELECT conname FROM pg_constraint WHERE conrelid = '{observations}'::regclass AND "
+                      f"contype = 'p';")
+    pkey = rows[0][0] if rows else "OBSERVATIONS_PKEY"
+    sql = "BEGIN;\n"
+    if rows:
+        sql += f'ALTER TABLE {observations} DROP CONSTRAINT "{pkey}";\n'
+    sql += f'ALTER TABLE {observations} ADD CONSTRAINT "{pkey}" PRIMARY KEY ("ID", "{time_column}");\n'
+    sql += (f"SELECT create_hypertable('{observations}', '{time_column}', "
+            f"chunk_time_interval => INTERVAL {sql_literal(chunk_interval)}, migrate_data => true);\n")
+    sql += "COMMIT;\n"
+    psql.run(sql)
+
+
+def configure_compression(psql, compress_after: str):
+    """
+    Enables native compression segmented by datastream and ordered by time, so the observations of a datastream in a
+    time range are stored (and decompressed) together. The settings are only changed if they differ, since they can
+    not be altered while there are compressed chunks.
+    """
+    rows = psql.query("SELECT attname, segmentby_column_index, orderby_column_index, orderby_asc "
+                      "FROM timescaledb_information.compression_settings WHERE hypertable_name = 'OBSERVATIONS';")
+    segmentby = [r[0] for r in rows if r[1]]
+    orderby = [(r[0], r[3]) for r in rows if r[2]]
+    if segmentby != ["DATASTREAM_ID"] or orderby[:1] != [(time_column, "f")]:
+        rich.print("    enabling compression (segment by DATASTREAM_ID)")
+        psql.run(f"ALTER TABLE {observations} SET (timescaledb.compress, "
+                 f"timescaledb.compress_segmentby = '\"DATASTREAM_ID\"', "
+                 f"timescaledb.compress_orderby = '\"{time_column}\" DESC');")
+    # policies are recreated, so changes in compress_after are applied
+    psql.run(f"SELECT remove_compression_policy('{observations}', if_exists => true);\n"
+             f"SELECT add_compression_policy('{observations}', INTERVAL {sql_literal(compress_after)});")
+
+
+def create_aggregate(psql, name: str):
+    """
+    Creates a continuous aggregate (and its refresh policy). When created, the aggregate is refreshed with all the
+    existing data, the policy only refreshes the recent buckets.
+    """
+    view = aggregate_view(name)
+    options = timescale_aggregates[name]
+    exists = psql.query(f"SELECT 1 FROM timescaledb_information.continuous_aggregates WHERE view_name = '{view}';")
+    if not exists:
+        rich.print(f"    creating continuous aggregate {view}")
+        psql.run(continuous_aggregate.format(view=view, bucket=sql_literal(options["bucket"])))
+        # refresh_continuous_aggregate can not run within a transaction, psql runs it in autocommit
+        psql.run(f"CALL refresh_continuous_aggregate('{view}', NULL, NULL);")
+    psql.run(f"SELECT remove_continuous_aggregate_policy('{view}', if_exists => true);\n"
+             f"SELECT add_continuous_aggregate_policy('{view}', "
+             f"start_offset => INTERVAL {sql_literal(options['start_offset'])}, "
+             f"end_offset => INTERVAL {sql_literal(options['end_offset'])}, "
+             f"schedule_interval => INTERVAL {sql_literal(options['schedule'])});")
+
+
+def provision_timescale(psql, conf: dict) -> bool:
+    """
+    Applies a timescale configuration to the SensorThings database
+    :param psql: Psql object connected to the database
+    :param conf: timescale configuration (see timescale_keys), missing options are taken from timescale_defaults
+    :returns: True if OBSERVATIONS has been converted into a hypertable now
+    :raises: ValueError if the OBSERVATIONS table does not exist yet (FROST creates it on its first start)
+    """
+    conf = {**timescale_defaults, **conf}
+    if not psql.query("SELECT to_regclass('public.\"OBSERVATIONS\"');"):  # NULL rows are empty lines
+        raise ValueError("OBSERVATIONS table does not exist yet, start the SensorThings service first")
+    psql.run("CREATE EXTENSION IF NOT EXISTS timescaledb;")
+    converted = False
+    if not is_hypertable(psql):
+        rich.print(f"    converting OBSERVATIONS into a hypertable (chunks of {conf['chunk_interval']})...")
+        rich.print("[yellow]    OBSERVATIONS is locked (no reads nor writes) until all its rows are migrated")
+        init = time.time()
+        create_hypertable(psql, conf["chunk_interval"])
+        rich.print(f"    hypertable created in {time.time() - init:.1f} s")
+        converted = True
+    else:
+        psql.run(f"SELECT set_chunk_time_interval('{observations}', INTERVAL {sql_literal(conf['chunk_interval'])});")
+
+    if conf["compression"]:
+        configure_compression(psql, conf["compress_after"])
+    else:
+        psql.run(f"SELECT remove_compression_policy('{observations}', if_exists => true);")
+
+    for name in conf["aggregates"]:
+        create_aggregate(psql, name)
+    return converted
+
+
+def explain_ms(psql, sql: str) -> float:
+    """
+    Runs a query with EXPLAIN ANALYZE and returns its execution time in milliseconds
+    """
+    output = psql.run(f"EXPLAIN (ANALYZE, FORMAT JSON) {sql}")
+    return json.loads(output)[0]["Execution Time"]
+
+
+def benchmark_queries(psql, aggregates=False) -> dict:
+    """
+    Measures typical long-range queries over the most recently written datastream
+    :param psql: Psql object
+    :param aggregates: also query the continuous aggregates
+    :returns: dict with {<query name>: execution time in ms}
+    """
+    rows = psql.query(f'SELECT "DATASTREAM_ID" FROM {observations} ORDER BY "ID" DESC LIMIT 1;')
+    if not rows:
+        return {}
+    ds = int(rows[0][0])
+    since = "now() - INTERVAL '365 days'"
+    queries = {
+        "datastream 1 year": f'SELECT "{time_column}", "RESULT_NUMBER" FROM {observations} WHERE "DATASTREAM_ID" = '
+                             f'{ds} AND "{time_column}" >= {since} ORDER BY "{time_column}";',
+        "hourly avg 1 year": f'SELECT date_trunc(\'hour\', "{time_column}") AS h, avg("RESULT_NUMBER") FROM '
+                             f'{observations} WHERE "DATASTREAM_ID" = {ds} AND "{time_column}" >= {since} GROUP BY h;',
+        "last observation": f'SELECT * FROM {observations} WHERE "DATASTREAM_ID" = {ds} ORDER BY "{time_column}" '
+                            f'DESC LIMIT 1;'
+    }
+    if aggregates:
+        queries["hourly avg 1 year (aggregate)"] = (f"SELECT bucket, avg FROM {aggregate_view('hourly')} WHERE "
+                                                    f"datastream_id = {ds} AND bucket >= {since};")
+    results = {}
+    for name, sql in queries.items():
+        try:
+            results[name] = explain_ms(psql, sql)
+        except ValueError as e:
+            rich.print(f"[yellow]    query '{name}' failed: {e}")
+    return results
+
+
+def print_benchmark(before: dict, after: dict):
+    """
+    Prints the execution times before and after the provisioning
+    """
+    names = list(before.keys()) + [n for n in after.keys() if n not in before.keys()]
+    if not names:
+        rich.print("[grey42]No observations, nothing to benchmark")
+        return
+    width = max([len(n) for n in names] + [5])
+    rich.print(f"\n{'query':<{width}}  {'before':>10}  {'after':>10}  speedup")
+    for name in names:
+        # aggregate queries are compared with the raw query they replace
+        b = before.get(name, before.get(name.replace(" (aggregate)", "")))
+        a = after.get(name)
+        speedup = f"{b / a:.1f}x" if a and b else "-"
+        b = f"{b:.1f} ms" if b is not None else "-"
+        a = f"{a:.1f} ms" if a is not None else "-"
+        rich.print(f"{name:<{width}}  {b:>10}  {a:>10}  {speedup}")
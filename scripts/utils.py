@@ -8,15 +8,16 @@ email: enoc.martinez@upc.edu
 license: MIT
 created: 14/11/23
 """
-import docker
-import ipaddress
-import traceback
 import rich
 import os
 import subprocess
+import shlex
+import selectors
+import collections
+from datetime import datetime
 import logging
-from logging.handlers import TimedRotatingFileHandler
 import time
+import threading
 
 
 def check_required_keys(conf: dict, required_keys: dict):
@@ -54,6 +55,58 @@ def check_optional_keys(conf: dict, keys: dict):
             raise ValueError(e)
 
 
+def load_yaml(stream):
+    """
+    Parses a YAML document, using the libyaml C loader when available
+    :param stream: file object, str or bytes
+    :returns: parsed contents
+    """
+    import yaml
+    try:
+        loader = yaml.CSafeLoader
+    except AttributeError:
+        loader = yaml.SafeLoader  # PyYAML built without libyaml
+    return yaml.load(stream, Loader=loader)
+
+
+def content_hash(contents: str | bytes) -> str:
+    """
+    Returns the sha256 of a string or bytes object
+    """
+    import hashlib
+    if isinstance(contents, str):
+        contents = contents.encode()
+    return hashlib.sha256(contents).hexdigest()
+
+
+def file_changed(filename: str, contents: str) -> bool:
+    """
+    Checks if the contents of a file differ from contents (comparing its hashes)
+    :param filename: file to check
+    :param contents: expected contents
+    :returns: True if the file does not exist or its contents are different
+    """
+    if not os.path.exists(filename):
+        return True
+    with open(filename, "rb") as f:
+        return content_hash(f.read()) != content_hash(contents)
+
+
+def write_if_changed(filename: str, contents: str) -> bool:
+    """
+    Writes a file only if its contents changed, so file watchers and reloads are not triggered for nothing. The file is
+    written in place (not renamed) to keep its inode, as some files are bind-mounted into docker containers.
+    :param filename: file to write
+    :param contents: new contents
+    :returns: True if the file has been written
+    """
+    if not file_changed(filename, contents):
+        return False
+    with open(filename, "w") as f:
+        f.write(contents)
+    return True
+
+
 def split_command(cmd: str) -> list:
     """
     Splits a command into a list, taking into account literals, e.g.
@@ -73,17 +126,18 @@ def split_command(cmd: str) -> list:
     return [s.replace("$#%", " ") for s in slices]  # convert back $#% to space
 
 
-def run_subprocess(cmd: str, allow_fail=False, verbose=False, quiet=False):
+def run_subprocess(cmd: str, allow_fail=False, verbose=False, quiet=False, cwd=None):
     """
     Runs a command as a subprocess. If the process retunrs 0 returns True. Otherwise prints stderr and stdout and returns False
     :param cmd: command
+    :param cwd: working directory for the subprocess (defaults to the current one)
     :return: True/False
     """
     assert (type(cmd) is str)
     cmd_list = split_command(cmd)
     if verbose:
         rich.print(f"[purple]{cmd}")
-    proc = subprocess.run(cmd_list, capture_output=True)
+    proc = subprocess.run(cmd_list, capture_output=True, cwd=cwd)
     if proc.returncode != 0:
         if not quiet:
             rich.print(f"\n[red]ERROR while running command '{cmd}'")
@@ -99,38 +153,81 @@ def run_subprocess(cmd: str, allow_fail=False, verbose=False, quiet=False):
     return True
 
 
-def run_subprocess_pipe(command: list | str, allow_fail=False, debug=False):
+def run_subprocess_pipe(command: list | str, allow_fail=False, debug=False, cwd=None, prefix="", quiet=False,
+                        history=200):
+    """
+    Runs a command as a subprocess, printing its output in real-time. Both stdout and stderr are drained as soon as
+    data arrives (no stream can block the other one). Every line is tagged with its timestamp and its source stream.
+    Only the last lines are kept in memory, and they are shown again if the command fails.
+    :param command: command as str or list
+    :param allow_fail: if False, raise ValueError when the command fails
+    :param debug: print the command before running it
+    :param cwd: working directory for the subprocess (defaults to the current one)
+    :param prefix: tag added to every output line, useful when several commands run concurrently
+    :param quiet: do not print the output in real-time, only the last lines if the command fails
+    :param history: number of lines kept to be shown if the command fails
+    :returns: process return code
+    """
+    from rich.markup import escape
     assert isinstance(command, str) or isinstance(command, list), f"expected list or str, got {type(command)}"
 
-    # if isinstance(command, str):
-    #     command = command.split(" ")
-
     if isinstance(command, list):
-        command = " ".join(command)
+        command = shlex.join(command)  # quote the arguments, the command is run through the shell
 
     if debug:
         rich.print(f"Running command [purple]'{command}'")
 
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True)
-
-    # Read and print the output in real-time
-    while True:
-        output = process.stdout.readline()
-        err = process.stderr.readline()
-        if output == '' and err == '' and process.poll() is not None:
-            break
-        if output:
-            rich.print(f"[grey42]>  {output.strip()}")
-        if err:
-            rich.print(f"[grey42]>  {err.strip()}")
-    retcode = process.poll()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, cwd=cwd)
+    if prefix:
+        prefix = f"[cyan]{escape(prefix)}[/cyan] "
+
+    selector = selectors.DefaultSelector()
+    selector.register(process.stdout, selectors.EVENT_READ, "out")
+    selector.register(process.stderr, selectors.EVENT_READ, "err")
+    partial = {"out": b"", "err": b""}  # incomplete lines (without \n) for each stream
+    recent = collections.deque(maxlen=history)  # ring buffer with the last lines
+
+    def format_line(source, line: bytes):
+        line = line.decode(errors="replace").rstrip()
+        if "\r" in line:
+            line = line.split("\r")[-1]  # progress bars, keep only the last update
+        timestamp = datetime.now().strftime("%H:%M:%S.%f")[:-3]
+        return f"{prefix}[grey42]{timestamp} {source}>  {escape(line)}"
+
+    while selector.get_map():
+        lines = []
+        for key, _ in selector.select():
+            data = os.read(key.fileobj.fileno(), 65536)
+            source = key.data
+            if not data:
+                # stream closed, flush the last incomplete line
+                selector.unregister(key.fileobj)
+                if partial[source]:
+                    lines.append(format_line(source, partial[source]))
+                continue
+            chunks = (partial[source] + data).split(b"\n")
+            partial[source] = chunks.pop()
+            lines += [format_line(source, c) for c in chunks]
+
+        recent.extend(lines)
+        if lines and not quiet:
+            # one write per batch of lines, chatty processes do not flood the terminal with small writes
+            rich.print("\n".join(lines))
+    selector.close()
+
+    retcode = process.wait()
     if retcode != 0:
         rich.print(f"[red]ERROR command '{command}' returned {retcode}")
+        if recent:
+            rich.print(f"[red]last {len(recent)} lines of output:")
+            rich.print("\n".join(recent))
         if not allow_fail:
             raise ValueError("subprocess failed, exit")
+    return retcode
 
 
 def setup_log(name, path, logger_name="logº"):
+    from logging.handlers import TimedRotatingFileHandler
     level = logging.INFO
     if not os.path.exists(path):
         os.makedirs(path)
@@ -156,41 +253,153 @@ def setup_log(name, path, logger_name="logº"):
     return logger
 
 
+class DockerIndex:
+    def __init__(self, client=None):
+        """
+        In-memory index of docker images, networks and containers. Everything is listed in a single pass (one API
+        call per object type), lookups by name are then O(1). The index must be invalidated after any operation that
+        modifies the docker objects (build, create, remove...), it will be refreshed on the next lookup.
+        :param client: docker client, by default the shared client from docker_client()
+        """
+        self.client = client
+        self.images = {}  # key image name (with and without tag), value image attributes
+        self.networks = {}  # key network name, value network attributes
+        self.containers = {}  # key container name, value container attributes
+        self.valid = False
+        self.generation = 0  # incremented by invalidate()
+        self.lock = threading.RLock()
+
+    def refresh(self):
+        """
+        Lists all images, networks and containers. The new dicts are built first and then swapped in, so concurrent
+        lookups never see a half-filled index
+        """
+        client = self.client or docker_client()
+        with self.lock:
+            generation = self.generation
+        images = {}
+        for img in client.api.images():
+            for tag in img["RepoTags"] or []:
+                if tag == "<none>:<none>":
+                    continue
+                images[tag] = img
+                images[tag.rsplit(":", 1)[0]] = img  # also register the name without tag
+        networks = {n["Name"]: n for n in client.api.networks()}
+        containers = {}
+        for c in client.api.containers(all=True):
+            for name in c["Names"]:
+                containers[name.lstrip("/")] = c
+        with self.lock:
+            self.images, self.networks, self.containers = images, networks, containers
+            # if it was invalidated during the round trip, the listing may be already outdated
+            self.valid = generation == self.generation
+
+    def invalidate(self):
+        """
+        Marks the index as outdated, it will be refreshed in the next lookup
+        """
+        with self.lock:
+            self.valid = False
+            self.generation += 1
+
+    def _check(self):
+        with self.lock:
+            if not self.valid:
+                self.refresh()
+
+    def has_image(self, name: str) -> bool:
+        self._check()
+        with self.lock:
+            return name in self.images.keys()
+
+    def has_network(self, name: str) -> bool:
+        self._check()
+        with self.lock:
+            return name in self.networks.keys()
+
+    def container(self, name: str):
+        """
+        Returns a container by name
+        :param name: container name
+        :returns: docker Container object
+        :raises: docker.errors.NotFound if the container does not exist
+        """
+        self._check()
+        client = self.client or docker_client()
+        with self.lock:
+            attrs = self.containers.get(name)
+        if attrs is None:
+            return client.containers.get(name)  # not indexed, ask the daemon (raises NotFound)
+        return client.containers.prepare_model(attrs)
+
+
+_docker_client = None
+_docker_index = None
+_docker_lock = threading.Lock()
+
+
+def docker_client():
+    """
+    Returns the docker client shared by the whole process
+    """
+    global _docker_client
+    with _docker_lock:
+        if _docker_client is None:
+            import docker  # imported on demand, it is the slowest import of the whole CLI
+            _docker_client = docker.from_env()
+    return _docker_client
+
+
+def set_docker_client(client):
+    """
+    Replaces the shared docker client (e.g. by a stub client in benchmarks) and resets the docker index
+    """
+    global _docker_client, _docker_index
+    with _docker_lock:
+        _docker_client = client
+        _docker_index = None
+
+
+def docker_index() -> DockerIndex:
+    """
+    Returns the docker index shared by the whole process
+    """
+    global _docker_index
+    with _docker_lock:
+        if _docker_index is None:
+            _docker_index = DockerIndex()
+    return _docker_index
+
+
 def container_stop(name):
     """
     Stops a container by name
     """
-    client = docker.DockerClient()
-    container = client.containers.get(name)
+    container = docker_index().container(name)
     container.stop()
+    docker_index().invalidate()
 
 
 def container_start(name):
     """
     Starts a container by name
     """
-    client = docker.DockerClient()
-    container = client.containers.get(name)
+    container = docker_index().container(name)
     container.start()
+    docker_index().invalidate()
 
 
 def container_exec(name, cmd) -> (int, bytes):
     """
     Runs a docker exec command
     """
-    client = docker.DockerClient()
-    container = client.containers.get(name)
+    container = docker_index().container(name)
     exit_code, output = container.exec_run(cmd)
     return exit_code, output
 
 
 def container_get_ip(name, docker_network=""):
     # find the IP from a docker container
-    client = docker.DockerClient()
-    container = client.containers.get(name)
+    container = docker_index().container(name)
     ip_address = container.attrs["NetworkSettings"]["Networks"][docker_network]["IPAddress"]
     return ip_address
-
-
-
-
@@ -23,6 +23,16 @@ echo "max_replication_slots = 10" >> $postgresql_conf
 echo "hot_standby_feedback = on" >> $postgresql_conf
 echo "password_encryption = 'scram-sha-256'" >> $postgresql_conf
 
+echo "ODI: Configuring pg_stat_statements"
+# keep the libraries already preloaded by the image (e.g. timescaledb), the last setting in the file wins
+preload=$(grep -E "^\s*shared_preload_libraries" $postgresql_conf | tail -n 1 | sed -E "s/^[^=]*=\s*'([^']*)'.*/\1/")
+if [[ ",${preload// /}," != *",pg_stat_statements,"* ]]; then
+  echo "shared_preload_libraries = '${preload:+$preload,}pg_stat_statements'" >> $postgresql_conf
+fi
+echo "pg_stat_statements.max = 10000" >> $postgresql_conf
+echo "pg_stat_statements.track = top" >> $postgresql_conf
+echo "track_io_timing = on" >> $postgresql_conf
+
 
 if "${sta_db_replicator}" ; then
   echo "ODI: Adding replicator user..."
@@ -41,6 +51,7 @@ psql -v ON_ERROR_STOP=1 --username "$POSTGRES_DB" <<-EOSQL
   CREATE DATABASE $sta_db_name WITH OWNER "$sta_db_user";
   \connect '$sta_db_name'
   CREATE EXTENSION IF NOT EXISTS postgis;
+  CREATE EXTENSION IF NOT EXISTS pg_stat_statements;
 EOSQL
 
 
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Tests of the incremental analytics of the proxy access log
+
+license: MIT
+"""
+import os
+import json
+import math
+from scripts.analytics import LogHistogram, parse_line, read_new_lines, update_aggregates
+
+
+def tsv_line(i: int, status=200) -> str:
+    return (f"2026-10-18T12:00:{i % 60:02d}+02:00\tdata.example.org\tGET\t/FROST-Server/v1.1/Things\t{status}\t"
+            f"512\t0.{i:03d}\t0.010, 0.020\t0.001\t0.002\tHIT\t10.0.0.2:8080\n")
+
+
+def test_histogram_quantiles():
+    h = LogHistogram()
+    for ms in range(1, 1001):
+        h.add(ms)
+    assert h.total() == 1000
+    for q in [0.5, 0.95, 0.99]:
+        # the bucket upper bound is within the growth factor of the exact quantile
+        assert 1000 * q <= h.quantile(q) <= 1000 * q * h.growth
+    assert h.quantile(0.0) == 1.0  # values <= 1 ms go to the first bucket
+    assert math.isnan(LogHistogram().quantile(0.5))
+
+
+def test_histogram_merge():
+    a, b, both = LogHistogram(), LogHistogram(), LogHistogram()
+    for ms in range(1, 500):
+        a.add(ms)
+        both.add(ms)
+    for ms in range(500, 3000, 7):
+        b.add(ms)
+        both.add(ms)
+    a.merge(LogHistogram(json.loads(json.dumps(b.to_json()))))  # as stored in the analytics state
+    assert a.counts == both.counts
+    assert a.quantile(0.9) == both.quantile(0.9)
+
+
+def test_parse_tsv():
+    r = parse_line(tsv_line(5, status=404))
+    assert r == {"hour": "2026-10-18T10", "location": "data.example.org/FROST-Server", "status": 404, "bytes": 512,
+                 "request_time": 0.005, "upstream_time": 0.03, "cache": "HIT"}
+    # upstream time of requests not proxied and the list format of retried upstreams
+    fields = tsv_line(5).split("\t")
+    fields[7], fields[10] = "-", "-"
+    r = parse_line("\t".join(fields))
+    assert r["upstream_time"] is None and r["cache"] == ""
+    fields[7] = "0.010 : 0.020"
+    assert parse_line("\t".join(fields))["upstream_time"] == 0.03
+    assert parse_line("not a log line") is None
+    assert parse_line("\t".join(fields[:4])) is None
+
+
+def test_parse_json():
+    line = json.dumps({"time": "2026-10-18T10:59:59Z", "host": "proxy.example.org", "method": "POST", "uri": "/",
+                       "status": 201, "bytes": 0, "request_time": 0.25, "upstream_time": "0.200", "cache": ""})
+    r = parse_line(line)
+    assert r["hour"] == "2026-10-18T10" and r["location"] == "proxy.example.org/"
+    assert r["status"] == 201 and r["upstream_time"] == 0.2 and r["cache"] == ""
+    assert parse_line('{"time": "2026-10-18T10:59:59Z"}') is None
+
+
+def test_update_aggregates():
+    aggregates = {}
+    assert update_aggregates(aggregates, [tsv_line(i) for i in range(10)] + ["garbage\n"]) == 10
+    agg = aggregates["data.example.org/FROST-Server"]["2026-10-18T10"]
+    assert agg["requests"] == 10 and agg["bytes"] == 5120
+    assert agg["status"] == {"2xx": 10} and agg["cache"] == {"HIT": 10}
+    assert LogHistogram(agg["latency"]).total() == LogHistogram(agg["upstream"]).total() == 10
+
+
+def test_read_new_lines(tmp_path):
+    filename = str(tmp_path / "odi_access.log")
+    with open(filename, "w") as f:
+        f.write(tsv_line(0) + tsv_line(1) + "2026-10-18T12:00:02")  # last line still being written
+    position = {}
+    assert len(list(read_new_lines(filename, position))) == 2
+    with open(filename, "a") as f:
+        f.write(tsv_line(2)[19:] + tsv_line(3))
+    lines = list(read_new_lines(filename, position))
+    assert lines == [tsv_line(2), tsv_line(3)]
+    assert list(read_new_lines(filename, position)) == []
+    assert position["offset"] == os.path.getsize(filename)
+
+
+def test_read_rotated(tmp_path):
+    filename = str(tmp_path / "odi_access.log")
+    with open(filename, "w") as f:
+        f.write(tsv_line(0))
+    position = {}
+    assert len(list(read_new_lines(filename, position))) == 1
+    # lines written before the rotation are read from the rotated file, then the new file from the beginning
+    with open(filename, "a") as f:
+        f.write(tsv_line(1))
+    os.rename(filename, filename + ".1")
+    with open(filename, "w") as f:
+        f.write(tsv_line(2))
+    assert list(read_new_lines(filename, position)) == [tsv_line(1), tsv_line(2)]
+    assert position == {"inode": os.stat(filename).st_ino, "offset": os.path.getsize(filename)}
+
+
+def test_read_truncated(tmp_path):
+    filename = str(tmp_path / "odi_access.log")
+    with open(filename, "w") as f:
+        f.write(tsv_line(0) + tsv_line(1))
+    position = {}
+    assert len(list(read_new_lines(filename, position))) == 2
+    with open(filename, "w") as f:  # copytruncate, same inode
+        f.write(tsv_line(2))
+    assert list(read_new_lines(filename, position)) == [tsv_line(2)]
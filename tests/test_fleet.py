@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Tests of the --all-hosts fan-out, every host runs its own odi_manager.py through the local transport
+
+license: MIT
+"""
+import os
+import yaml
+from scripts.infrastructure import Infrastructure
+from scripts.fleet import run_fleet, fleet_hosts, LocalTransport, SshTransport
+
+compose = {"services": {"app": {"container_name": "app", "image": "nginx:stable-bullseye"}}}
+
+
+def two_hosts(path: str) -> str:
+    """
+    Creates a deployment with two hosts, only 'svc-a' (host0) has its docker-compose folder in this machine
+    """
+    networks = {"net0": {
+        "host0": {"ip": "10.0.0.2", "dns": ["a.example.org"]},
+        "host1": {"ip": "10.0.0.3", "dns": ["b.example.org"]}
+    }}
+    services = {
+        "svc-a": {"host": "host0", "dns": "a.example.org", "port": 8080},
+        "svc-b": {"host": "host1", "dns": "b.example.org", "port": 8080}
+    }
+    conf = {"infrastructure": {"path": path, "networks": networks, "port_mappings": {}, "services": services,
+                               "soft_links": {}}}
+    os.makedirs(os.path.join(path, "svc-a"))
+    with open(os.path.join(path, "svc-a", "docker-compose.yaml"), "w") as f:
+        yaml.safe_dump(compose, f)
+    filename = os.path.join(path, "infrastructure.yaml")
+    with open(filename, "w") as f:
+        yaml.safe_dump(conf, f)
+    return filename
+
+
+def test_fleet_hosts(tmp_path):
+    infra = Infrastructure(two_hosts(str(tmp_path)), hostname="host0")
+    assert fleet_hosts(infra) == {"host0": [], "host1": []}
+    assert fleet_hosts(infra, ["svc-b"]) == {"host1": ["svc-b"]}
+
+
+def test_ssh_transport_uses_address():
+    cmd = SshTransport(user="odi").command("host1", "10.0.0.3", "/opt/odi", ["up", "svc-b"])
+    assert cmd[-2] == "odi@10.0.0.3"
+    assert cmd[-1] == "cd /opt/odi && python3 odi_manager.py up svc-b"
+    assert SshTransport().command("host1", "", "/opt/odi", ["up"])[-2] == "host1"
+
+
+def test_run_fleet_local(tmp_path, capsys):
+    filename = two_hosts(str(tmp_path))
+    infra = Infrastructure(filename, hostname="host0")
+    results = run_fleet(infra, "list", [], ["-i", filename], LocalTransport(), jobs=2)
+    assert sorted(results.keys()) == ["host0", "host1"]
+    assert all(r.status == "ok" for r in results.values())
+    out = capsys.readouterr().out
+    assert "Valid services for host 'host0': svc-a" in out
+    assert "Valid services for host 'host1':" in out
+
+
+def test_run_fleet_local_failure(tmp_path):
+    filename = two_hosts(str(tmp_path))
+    infra = Infrastructure(filename, hostname="host0")
+    # svc-b is not deployed in this machine, so the odi_manager.py acting as host1 rejects it
+    results = run_fleet(infra, "logs", ["svc-b"], ["-i", filename], LocalTransport())
+    assert list(results.keys()) == ["host1"]
+    assert results["host1"].status == "failed"
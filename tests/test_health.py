@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+"""
+Tests of the detection of container healthchecks
+
+license: MIT
+"""
+from scripts.health import has_healthcheck
+
+
+def test_has_healthcheck():
+    assert has_healthcheck({"Healthcheck": {"Test": ["CMD-SHELL", "curl -f http://localhost"], "Interval": 10 ** 10}})
+    assert has_healthcheck({"Healthcheck": {"Test": ["CMD", "pg_isready"]}})
+    assert not has_healthcheck({"Healthcheck": {"Test": ["NONE"]}})  # HEALTHCHECK NONE or disable: true
+    assert not has_healthcheck({"Healthcheck": {"Test": []}})
+    assert not has_healthcheck({"Healthcheck": None})
+    assert not has_healthcheck({"Image": "nginx"})
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Tests of the NAT rules of the port mappings, rendered against canned iptables-save outputs
+
+license: MIT
+"""
+from scripts.nat import parse_iptables_save, render_ruleset, nat_rules
+
+mappings = [{"protocol": "tcp", "src_port": 8022, "dst_ip": "10.0.0.3", "dst_port": 22}]
+
+# docker host without ODI rules, with a duplicated rule left by the former add_nat_rule.sh
+legacy_save = """# Generated by iptables-save v1.8.7 on Sun Oct 18 10:00:00 2026
+*nat
+:PREROUTING ACCEPT [0:0]
+:INPUT ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+:DOCKER - [0:0]
+-A PREROUTING -m addrtype --dst-type LOCAL -j DOCKER
+-A PREROUTING -p tcp -m tcp --dport 8022 -j DNAT --to-destination 10.0.0.3:22
+-A PREROUTING -p tcp -m tcp --dport 8022 -j DNAT --to-destination 10.0.0.3:22
+-A POSTROUTING -s 172.17.0.0/16 ! -o docker0 -j MASQUERADE
+-A POSTROUTING -p tcp -m tcp --dport 22 -j MASQUERADE
+COMMIT
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD DROP [0:0]
+:OUTPUT ACCEPT [0:0]
+:DOCKER-USER - [0:0]
+-A FORWARD -j DOCKER-USER
+-A DOCKER-USER -p tcp -m tcp --dport 22 -j ACCEPT
+-A DOCKER-USER -j RETURN
+COMMIT
+"""
+
+# the same host once the ODI chains are programmed
+odi_save = """*nat
+:PREROUTING ACCEPT [0:0]
+:INPUT ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+:DOCKER - [0:0]
+:ODI-PREROUTING - [0:0]
+:ODI-POSTROUTING - [0:0]
+-A PREROUTING -j ODI-PREROUTING
+-A PREROUTING -m addrtype --dst-type LOCAL -j DOCKER
+-A POSTROUTING -j ODI-POSTROUTING
+-A POSTROUTING -s 172.17.0.0/16 ! -o docker0 -j MASQUERADE
+-A ODI-PREROUTING -p tcp -m tcp --dport 8022 -j DNAT --to-destination 10.0.0.3:22
+-A ODI-POSTROUTING -d 10.0.0.3/32 -p tcp -m tcp --dport 22 -j MASQUERADE
+COMMIT
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD DROP [0:0]
+:OUTPUT ACCEPT [0:0]
+:DOCKER-USER - [0:0]
+:ODI-DOCKER-USER - [0:0]
+-A FORWARD -j DOCKER-USER
+-A DOCKER-USER -j ODI-DOCKER-USER
+-A DOCKER-USER -j RETURN
+-A ODI-DOCKER-USER -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT
+-A ODI-DOCKER-USER -d 10.0.0.3/32 -p tcp -m tcp --dport 22 -j ACCEPT
+COMMIT
+"""
+
+
+def test_parse_iptables_save():
+    tables = parse_iptables_save(legacy_save)
+    assert sorted(tables.keys()) == ["filter", "nat"]
+    assert {"PREROUTING", "POSTROUTING", "DOCKER"} <= tables["nat"]["chains"]
+    assert len(tables["nat"]["rules"]["PREROUTING"]) == 3
+    assert tables["filter"]["rules"]["DOCKER-USER"][-1] == "-A DOCKER-USER -j RETURN"
+
+
+def test_render_legacy():
+    ruleset, changes = render_ruleset(mappings, parse_iptables_save(legacy_save))
+    lines = ruleset.splitlines()
+    assert lines[0] == "*nat" and lines.count("COMMIT") == 2
+    for chain in ["ODI-PREROUTING", "ODI-POSTROUTING", "ODI-DOCKER-USER"]:
+        assert f":{chain} - [0:0]" in lines
+    for rules in nat_rules(mappings).values():
+        assert all(rule in lines for rule in rules)
+    assert "-I PREROUTING 1 -j ODI-PREROUTING" in lines
+    assert "-I DOCKER-USER 1 -j ODI-DOCKER-USER" in lines
+    # every copy of the legacy rules is deleted, docker's own rules are kept
+    assert lines.count("-D PREROUTING -p tcp -m tcp --dport 8022 -j DNAT --to-destination 10.0.0.3:22") == 2
+    assert "-D POSTROUTING -p tcp -m tcp --dport 22 -j MASQUERADE" in lines
+    assert "-D DOCKER-USER -p tcp -m tcp --dport 22 -j ACCEPT" in lines
+    assert not any(line.startswith("-D") and ("DOCKER " in line or "RETURN" in line) for line in lines)
+    assert len([c for c in changes if "legacy" in c]) == 4
+
+
+def test_render_idempotent():
+    assert render_ruleset(mappings, parse_iptables_save(odi_save)) == ("", [])
+
+
+def test_render_changed_mapping():
+    changed = [dict(mappings[0], dst_port=2222)]
+    ruleset, changes = render_ruleset(changed, parse_iptables_save(odi_save))
+    # the changed chains are flushed and written again, the jumps are already there
+    assert ":ODI-PREROUTING - [0:0]" in ruleset and ":ODI-DOCKER-USER - [0:0]" in ruleset
+    assert "--to-destination 10.0.0.3:2222" in ruleset
+    assert "-I " not in ruleset and "-D " not in ruleset
+    assert len(changes) == 3
+
+
+def test_render_without_docker_user():
+    save = legacy_save.replace(":DOCKER-USER - [0:0]\n", "").replace("-A DOCKER-USER -j RETURN\n", "")
+    ruleset, changes = render_ruleset([], parse_iptables_save(save))
+    filter_table = ruleset[ruleset.index("*filter"):]
+    assert filter_table.splitlines()[1] == ":DOCKER-USER - [0:0]"  # declared before the ODI chain
+    assert "filter/DOCKER-USER: create chain" in changes
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Tests of the NGINX config generated for groups of services with a master and read replicas
+
+license: MIT
+"""
+import os
+import re
+import shutil
+import yaml
+import pytest
+from scripts.infrastructure import Infrastructure
+
+proxy_compose = {"services": {"reverse": {"container_name": "proxy", "image": "nginx:stable-bullseye",
+                                          "volumes": ["./nginx.conf:/etc/nginx/nginx.conf:ro"]}}}
+
+
+def split_infrastructure(path: str, cache: bool) -> str:
+    """
+    Creates a deployment with a SensorThings master and a replica sharing the same DNS name
+    """
+    services = {
+        "proxy": {"host": "vm", "dns": "proxy.example.org"},
+        "sta-master": {"host": "host0", "dns": "data.example.org", "port": 8080},
+        "sta-slave": {"host": "host1", "dns": "data.example.org", "port": 8080}
+    }
+    if cache:
+        services["sta-master"]["nginx"] = {"cache": {}}
+    networks = {"net0": {
+        "vm": {"ip": "10.0.0.1", "dns": ["proxy.example.org"]},
+        "host0": {"ip": "10.0.0.2", "dns": ["data.example.org"]},
+        "host1": {"ip": "10.0.0.3", "dns": ["data.example.org"]}
+    }}
+    conf = {"infrastructure": {"path": path, "networks": networks, "port_mappings": {}, "services": services,
+                               "soft_links": {}}}
+    os.makedirs(os.path.join(path, "proxy"), exist_ok=True)
+    with open(os.path.join(path, "proxy", "docker-compose.yaml"), "w") as f:
+        yaml.safe_dump(proxy_compose, f)
+    filename = os.path.join(path, "infrastructure.yaml")
+    with open(filename, "w") as f:
+        yaml.safe_dump(conf, f)
+    return filename
+
+
+def method_map(conf: str, variable: str) -> dict:
+    """
+    Parses the map $request_method block of a variable, returns {<method or default>: <upstream>}
+    """
+    block = re.search(r"map \$request_method \$" + variable + r" \{(.*?)\}", conf, re.DOTALL).group(1)
+    return dict([line.strip().rstrip(";").split() for line in block.strip().splitlines()])
+
+
+def frost_location(conf: str) -> str:
+    init = conf.index("location /FROST-Server {")
+    return conf[init:conf.index("\n    }\n", init)]
+
+
+def check_writes_to_master(tmp_path, cache: bool):
+    infra = Infrastructure(split_infrastructure(str(tmp_path), cache), hostname="vm")
+    conf = infra.nginx_conf_contents(verbose=False)
+
+    methods = method_map(conf, "odi_sta_master_upstream")
+    assert methods["default"] == "odi_sta_master"  # POST, PATCH, DELETE...
+    assert methods["GET"] == methods["HEAD"] == "odi_sta_master_read"
+    assert re.search(r"upstream odi_sta_master \{[^}]*10\.0\.0\.2:8080[^}]*\}", conf)
+    assert not re.search(r"upstream odi_sta_master \{[^}]*10\.0\.0\.3[^}]*\}", conf)
+
+    # every location (including nested ones) must proxy through the method map
+    location = frost_location(conf)
+    proxy_passes = re.findall(r"proxy_pass (\S+);", location)
+    assert proxy_passes
+    assert all(p == "http://$odi_sta_master_upstream" for p in proxy_passes), proxy_passes
+    return location
+
+
+def test_split_writes_to_master(tmp_path):
+    check_writes_to_master(tmp_path, cache=False)
+
+
+def test_split_cached_writes_to_master(tmp_path):
+    location = check_writes_to_master(tmp_path, cache=True)
+    assert "location ~ ^/FROST-Server/v1\\.[01]/(.*/)?Observations" in location
+    assert "proxy_cache_methods GET HEAD;" in location
+
+
+def test_cache_bypass(tmp_path):
+    location = check_writes_to_master(tmp_path, cache=True)
+    assert "proxy_cache_bypass $http_authorization $http_cookie;" in location
+    assert "proxy_no_cache $http_authorization $http_cookie;" in location
+
+
+def test_cache_bypass_cookies_disabled(tmp_path):
+    filename = split_infrastructure(str(tmp_path), cache=True)
+    with open(filename) as f:
+        conf = yaml.safe_load(f)
+    conf["infrastructure"]["services"]["sta-master"]["nginx"]["cache"]["bypass_cookies"] = False
+    with open(filename, "w") as f:
+        yaml.safe_dump(conf, f)
+    location = frost_location(Infrastructure(filename, hostname="vm").nginx_conf_contents(verbose=False))
+    assert "proxy_cache_bypass $http_authorization;" in location
+    assert "proxy_no_cache $http_authorization;" in location
+
+
+def tls_infrastructure(path: str) -> str:
+    """
+    Creates a deployment with TLS profiles (HTTP/2, OCSP stapling, custom session cache) and cached services
+    """
+    filename = split_infrastructure(path, cache=True)
+    with open(filename) as f:
+        conf = yaml.safe_load(f)
+    conf["infrastructure"]["tls"] = {
+        "default": {"http2": True, "session_cache_size": "20m"},
+        "data.example.org": {"ocsp_stapling": True, "trusted_certificate": "chain.pem"}
+    }
+    conf["infrastructure"]["logging"] = {"default": {"gzip": 4}, "data.example.org": {"sample": 0.5}}
+    with open(filename, "w") as f:
+        yaml.safe_dump(conf, f)
+    return filename
+
+
+def test_tls_config(tmp_path):
+    conf = Infrastructure(tls_infrastructure(str(tmp_path)), hostname="vm").nginx_conf_contents(verbose=False)
+    assert "listen 443 ssl;" in conf
+    assert "http2 on;" in conf
+    assert "ssl_stapling on;" in conf
+
+
+@pytest.mark.skipif(not shutil.which(os.environ.get("ODI_TEST_NGINX", "nginx")) or not shutil.which("openssl"),
+                    reason="nginx and openssl binaries required")
+def test_nginx_check(tmp_path):
+    infra = Infrastructure(tls_infrastructure(str(tmp_path)), hostname="vm")
+    infra.check_nginx_conf(nginx_bin=os.environ.get("ODI_TEST_NGINX", "nginx"))  # raises ValueError if invalid
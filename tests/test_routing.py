@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Tests of the routes between hosts, directly through shared networks or through the port mappings of gateways
+
+license: MIT
+"""
+from scripts.routing import RoutingGraph, docker_host_ip
+
+# ext -(public)- gw1 -(dmz)- gw2 -(internal)- db, gw1 also reaches db through a shortcut mapping of port 5433
+host_networks = {
+    "ext": {"public": "192.0.2.10"},
+    "gw1": {"public": "192.0.2.1", "dmz": "10.1.0.1"},
+    "gw2": {"dmz": "10.1.0.2", "internal": "10.2.0.1"},
+    "db": {"internal": "10.2.0.5"},
+    "isolated": {"other": "10.9.0.1"}
+}
+mappings = {
+    "gw1": [{"src_port": 8000, "dst_host": "gw2", "dst_port": 9000},
+            {"src_port": 8001, "dst_host": "db", "dst_port": "5433"}],
+    "gw2": [{"src_port": 9000, "dst_host": "db", "dst_port": 5432},
+            {"src_port": 9001, "dst_host": "db", "dst_port": 5433}]
+}
+
+
+def test_local_and_direct():
+    graph = RoutingGraph(host_networks, mappings)
+    route = graph.route("db", "db", 5432)
+    assert (route.ip, route.port, route.kind, route.via) == (docker_host_ip, 5432, "local", [])
+    route = graph.route("gw2", "db", 5432)
+    assert (route.ip, route.port, route.kind, route.via) == ("10.2.0.5", 5432, "direct", [])
+    assert graph.shared_ip("ext", "gw1") == "192.0.2.1"
+    assert graph.shared_ip("ext", "db") == ""
+
+
+def test_multi_hop():
+    graph = RoutingGraph(host_networks, mappings)
+    route = graph.route("ext", "db", 5432)
+    assert (route.ip, route.port, route.kind, route.via) == ("192.0.2.1", 8000, "port_mapping", ["gw1", "gw2"])
+    route = graph.route("gw1", "db", 5432)
+    assert (route.ip, route.port, route.via) == ("10.1.0.2", 9000, ["gw2"])
+    # the gateway itself reaches the service through its own mapping
+    route = graph.route("gw2", "gw2", 9000)
+    assert route.kind == "local" and route.ip == docker_host_ip
+
+
+def test_fewer_hops():
+    graph = RoutingGraph(host_networks, mappings)
+    # 5433 is reachable through gw2 (two hops) and through the direct gw1 shortcut, the shortest one is selected
+    route = graph.route("ext", "db", 5433)
+    assert (route.ip, route.port, route.via) == ("192.0.2.1", 8001, ["gw1"])
+    assert repr(route) == "192.0.2.1:8001 (port_mapping via gw1)"
+
+
+def test_unreachable():
+    graph = RoutingGraph(host_networks, mappings)
+    assert graph.route("ext", "db", 22) is None  # no mapping for this port
+    assert graph.route("isolated", "db", 5432) is None
+
+
+def test_cycles_and_memoisation():
+    # mappings forwarding to each other must not loop forever
+    looped = {"gw1": [{"src_port": 1, "dst_host": "gw2", "dst_port": 2}],
+              "gw2": [{"src_port": 2, "dst_host": "gw1", "dst_port": 1}]}
+    graph = RoutingGraph({"gw1": {"a": "10.0.0.1"}, "gw2": {"b": "10.0.0.2"}, "x": {"c": "10.0.0.3"}}, looped)
+    assert graph.route("x", "gw1", 1) is None
+    graph = RoutingGraph(host_networks, mappings)
+    graph.precompute(["ext", "gw1"], {"db": ("db", 5432), "db-ro": ("db", "5433")})
+    assert len(graph.routes) == 4
+    assert graph.route("ext", "db", "5432") is graph.routes[("ext", "db", 5432)]
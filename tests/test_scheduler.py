@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Tests of the dependency-aware scheduler, with fake tasks recording the order in which they run
+
+license: MIT
+"""
+import time
+import threading
+import pytest
+from scripts.scheduler import run_tasks, check_dependencies, reverse_dependencies
+
+
+class FakeTasks:
+    def __init__(self, names: list, fail=(), delay=0.0):
+        """
+        Tasks that record when they start and finish, the ones in fail raise an exception
+        """
+        self.log = []
+        self.lock = threading.Lock()
+        self.tasks = {name: self.task(name, name in fail, delay) for name in names}
+
+    def task(self, name, fail, delay):
+        def f():
+            with self.lock:
+                self.log.append(("start", name))
+            time.sleep(delay)
+            with self.lock:
+                self.log.append(("end", name))
+            if fail:
+                raise ValueError(f"{name} failed")
+        return f
+
+    def index(self, event, name) -> int:
+        return self.log.index((event, name))
+
+
+def test_dependency_order():
+    dependencies = {"db": set(), "cache": set(), "api": {"db", "cache"}, "proxy": {"api"}}
+    fake = FakeTasks(["proxy", "api", "cache", "db"], delay=0.01)
+    results = run_tasks(fake.tasks, dependencies, jobs=4)
+    assert list(results.keys()) == ["proxy", "api", "cache", "db"]
+    assert all(r.status == "ok" for r in results.values())
+    assert fake.index("start", "api") > max(fake.index("end", "db"), fake.index("end", "cache"))
+    assert fake.index("start", "proxy") > fake.index("end", "api")
+    # independent tasks run concurrently
+    assert fake.index("start", "cache") < fake.index("end", "db")
+
+
+def test_skip_on_failed_dependency():
+    dependencies = {"db": set(), "api": {"db"}, "proxy": {"api"}, "other": set()}
+    fake = FakeTasks(["db", "api", "proxy", "other"], fail=["db"])
+    results = run_tasks(fake.tasks, dependencies, jobs=2)
+    assert results["db"].status == "failed" and results["db"].error == "db failed"
+    assert results["api"].status == results["proxy"].status == "skipped"  # transitively
+    assert results["other"].status == "ok"
+    assert ("start", "api") not in fake.log and ("start", "proxy") not in fake.log
+
+
+def test_dependencies_outside_tasks():
+    # only a subset of the services is run, dependencies on the rest are ignored
+    fake = FakeTasks(["api"])
+    assert run_tasks(fake.tasks, {"api": {"db"}})["api"].status == "ok"
+
+
+def test_cycles():
+    with pytest.raises(ValueError, match="Circular dependency"):
+        check_dependencies({"a": {"b"}, "b": {"c"}, "c": {"a"}, "d": set()})
+    with pytest.raises(ValueError, match="Circular dependency"):
+        run_tasks(FakeTasks(["a", "b"]).tasks, {"a": {"b"}, "b": {"a"}})
+    with pytest.raises(ValueError, match="unknown service 'x'"):
+        check_dependencies({"a": {"x"}})
+    check_dependencies({"a": {"b"}, "b": set()})
+
+
+def test_reverse_dependencies():
+    assert reverse_dependencies({"a": {"b"}, "b": set()}) == {"a": set(), "b": {"a"}}
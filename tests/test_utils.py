@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Tests of the streamed subprocess output, with a child process writing to both stdout and stderr
+
+license: MIT
+"""
+import re
+import sys
+import pytest
+from scripts.utils import run_subprocess_pipe
+
+child = """
+import sys
+for i in range(6):
+    stream = sys.stdout if i % 2 else sys.stderr
+    stream.write(f"line {i}\\n")
+    stream.flush()
+sys.stdout.write("progress 10%\\rprogress 100%\\n")
+sys.stderr.write("no newline")
+sys.exit(int(sys.argv[1]))
+"""
+
+line_re = re.compile(r"^(\S+ )?(\d\d:\d\d:\d\d\.\d{3}) (out|err)>  (.*)$")
+
+
+def run_child(tmp_path, capsys, retcode: int, **kwargs) -> list:
+    script = tmp_path / "child.py"
+    script.write_text(child)
+    result = run_subprocess_pipe([sys.executable, str(script), str(retcode)], **kwargs)
+    assert result == retcode
+    return [line_re.match(line).groups() for line in capsys.readouterr().out.splitlines() if line_re.match(line)]
+
+
+def test_prefixed_output(tmp_path, capsys):
+    lines = run_child(tmp_path, capsys, 0, prefix="svc")
+    assert all(prefix == "svc " for prefix, _, _, _ in lines)
+    sources = {text: source for _, _, source, text in lines}
+    assert sources == {"line 0": "err", "line 1": "out", "line 2": "err", "line 3": "out", "line 4": "err",
+                       "line 5": "out", "progress 100%": "out", "no newline": "err"}
+    # lines of the same stream keep their order
+    stdout = [text for _, _, source, text in lines if source == "out"]
+    assert stdout == ["line 1", "line 3", "line 5", "progress 100%"]
+    timestamps = [t for _, t, _, _ in lines]
+    assert timestamps == sorted(timestamps)  # stamped when read
+
+
+def test_quiet_ring_buffer(tmp_path, capsys):
+    # quiet commands only show the output when they fail, limited to the last lines
+    assert run_child(tmp_path, capsys, 0, quiet=True) == []
+    lines = run_child(tmp_path, capsys, 3, quiet=True, allow_fail=True, history=3)
+    assert len(lines) == 3
+    # the order between streams depends on the scheduling, a single stream is checked exactly
+    script = tmp_path / "count.py"
+    script.write_text("import sys\nfor i in range(50):\n    print(f'line {i}')\nsys.exit(2)\n")
+    assert run_subprocess_pipe([sys.executable, str(script)], quiet=True, allow_fail=True, history=5) == 2
+    out = capsys.readouterr().out.splitlines()
+    texts = [line_re.match(line).group(4) for line in out if line_re.match(line)]
+    assert texts == [f"line {i}" for i in range(45, 50)]
+    assert "last 5 lines of output:" in out
+
+
+def test_failure(tmp_path, capsys):
+    with pytest.raises(ValueError, match="subprocess failed"):
+        run_child(tmp_path, capsys, 1, quiet=True)
+    assert "returned 1" in capsys.readouterr().out